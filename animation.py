@@ -0,0 +1,135 @@
+"""
+Streaming processing of animated images and frame sequences
+"""
+
+from PIL import Image, ImageSequence, GifImagePlugin
+from pathlib import Path
+from typing import BinaryIO, Dict, Iterator, List, Optional, Sequence, Tuple, Union
+
+from downscale import downscale_image
+from palette_swap import CompiledJob, Dither, ImagePalette, _downscale_size, _downscaled_path, permutation_path, write_image
+from profiling import stage
+from quantize import PaletteMapper
+
+FRAME_SUFFIXES = ('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp')
+
+def iter_frames(input_path: Path, frame_duration: int = 100) -> Iterator[Tuple[Image.Image, int]]:
+    """
+    Decode frames one at a time, with their duration in milliseconds.
+
+    input_path is either an animated image or a directory whose image files,
+    in name order, are the frames of one clip shown for frame_duration each.
+    """
+    if input_path.is_dir():
+        frame_paths = sorted(p for p in input_path.iterdir() if p.suffix.lower() in FRAME_SUFFIXES)
+        for frame_path in frame_paths:
+            with stage('decode'), Image.open(frame_path) as frame:
+                rgb_frame = frame.convert('RGB')
+            yield rgb_frame, frame_duration
+        return
+    with Image.open(input_path) as image:
+        for frame in ImageSequence.Iterator(image):
+            with stage('decode'):
+                rgb_frame = frame.convert('RGB')
+            yield rgb_frame, frame.info.get('duration', frame_duration)
+
+class StreamingGifWriter:
+    """
+    Animated GIF writer that encodes each frame as soon as it is written.
+
+    Pillow's save_all keeps every frame until the end to optimize them; this
+    writer emits the header with the first frame and a local color table per
+    frame, so memory use does not grow with the clip length.
+    """
+
+    def __init__(self, path: Path, loop: int = 0):
+        self.path = path
+        self.loop = loop
+        self.paths: List[Path] = []
+        self._file: Optional[BinaryIO] = None
+
+    def write(self, frame: Image.Image, duration: int):
+        if frame.mode != 'P':
+            frame = frame.convert('P', palette=Image.Palette.ADAPTIVE, colors=256)
+        if self._file is None:
+            self._file = open(self.path, 'wb')
+            self.paths.append(self.path)
+            header, _ = GifImagePlugin.getheader(frame, info={'loop': self.loop, 'duration': duration})
+            self._file.writelines(header)
+        self._file.writelines(GifImagePlugin.getdata(frame, duration=duration, include_color_table=True))
+
+    def close(self):
+        if self._file is not None:
+            self._file.write(b';')  # GIF trailer
+            self._file.close()
+            self._file = None
+
+class FrameSequenceWriter:
+    """Writer saving every frame as its own numbered file next to path, with write_image"""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.paths: List[Path] = []
+
+    def write(self, frame: Image.Image, duration: int):
+        frame_path = self.path.with_name(f"{self.path.stem}_{len(self.paths):04d}{self.path.suffix}")
+        write_image(frame, frame_path)
+        self.paths.append(frame_path)
+
+    def close(self):
+        pass
+
+FrameWriter = Union[StreamingGifWriter, FrameSequenceWriter]
+
+def open_frame_writer(path: Path) -> FrameWriter:
+    """Animated GIF writer for .gif paths, numbered frame files otherwise"""
+    if path.suffix.lower() == '.gif':
+        return StreamingGifWriter(path)
+    return FrameSequenceWriter(path)
+
+def process_animation(input_path: Path, output_path: Path, downscale_width_resolution: int, dither: Union[int, Sequence[Dither]], colors: Optional[List[int]] = None, saturation: Optional[List[float]] = None, constrast: Optional[List[float]] = None, palettes: Optional[List[ImagePalette]] = None, auto_detect_pixel_size: bool = False, mapper: Optional[PaletteMapper] = None, stable_colors: bool = True, frame_duration: int = 100, save_downscaled: bool = True, save_full_size: bool = True, downscale: str = 'nearest', enhancer: str = 'pillow', detect_samples: int = 0) -> List[Path]:
+    """
+    Process every frame of an animation like process_picture, streaming the results.
+
+    Frames are decoded, processed and written one at a time, so memory use
+    does not depend on the number of frames. The downscale size (and any
+    detected pixel size) comes from the first frame. Palettes, and the lookup
+    tables of the lut quantizer, are shared by all frames; with stable_colors,
+    the colors picked by the color count reduction of the first frame are
+    reused for the following ones instead of being chosen again per frame.
+    Returns the paths of all the files written.
+    """
+    # Palettes are prepared once for all the frames
+    job = CompiledJob(None, dither, colors, saturation, constrast, palettes, mapper=mapper, enhancer=enhancer)
+    reference_palettes: Optional[Dict[str, Image.Image]] = {} if stable_colors else None
+    # Downscaled and full-size writer for every permutation, None for skipped outputs
+    writers: Dict[Path, Tuple[Optional[FrameWriter], Optional[FrameWriter]]] = {}
+    downscale_size = None
+
+    try:
+        for frame, duration in iter_frames(input_path, frame_duration):
+            og_size = frame.size
+            if downscale_size is None:
+                downscale_size = _downscale_size(frame, downscale_width_resolution, auto_detect_pixel_size, detect_samples=detect_samples)
+            with stage('downscale'):
+                frame = downscale_image(frame, downscale_size, downscale)
+            for params, processed_image in job.permutations(frame, reference_palettes):
+                processed_path = permutation_path(output_path, params['name'])
+                if processed_path not in writers:
+                    writers[processed_path] = (
+                        open_frame_writer(_downscaled_path(processed_path)) if save_downscaled else None,
+                        open_frame_writer(processed_path) if save_full_size else None,
+                    )
+                downscaled_writer, writer = writers[processed_path]
+                if downscaled_writer:
+                    with stage('save_downscaled'):
+                        downscaled_writer.write(processed_image, duration)
+                if writer:
+                    with stage('save_full_size'):
+                        writer.write(processed_image.resize(og_size, Image.Resampling.NEAREST), duration)
+    finally:
+        for frame_writers in writers.values():
+            for frame_writer in frame_writers:
+                if frame_writer:
+                    frame_writer.close()
+    return [path for frame_writers in writers.values() for frame_writer in frame_writers if frame_writer for path in frame_writer.paths]
@@ -0,0 +1,81 @@
+"""
+Many palettes applied to one image at once: shared color matching and contact sheets
+"""
+
+import math
+import numpy as np
+from PIL import Image
+from pathlib import Path
+from typing import List, Optional, Sequence, Tuple
+
+from quantize import PaletteMapper, get_palette_lut, indices_to_image, nearest_palette_indices, palette_array, unique_colors
+
+def palette_index_table(colors: np.ndarray, palettes: Sequence, mapper: Optional[PaletteMapper] = None) -> np.ndarray:
+    """
+    (P, U) palette indices of U distinct (U, 3) uint8 colors in each of P palettes.
+
+    Colors are matched like undithered palette mapping with the mapper's
+    quantizer and metric, so gathering a row with an image's inverse color
+    index gives the same pixels as mapping the image to that palette.
+    """
+    mapper = mapper or PaletteMapper()
+    table = np.empty((len(palettes), len(colors)), dtype=np.uint8)
+    for row, palette in enumerate(palettes):
+        if mapper.quantizer == 'lut':
+            table[row] = get_palette_lut(palette.colors, mapper.lut_bits, mapper.metric).lookup(colors)
+        elif mapper.quantizer == 'numpy':
+            table[row] = nearest_palette_indices(colors, palette_array(palette.colors), mapper.metric, mapper.memory_budget)
+        else:
+            strip = Image.fromarray(colors[None])
+            table[row] = np.asarray(strip.quantize(palette=palette.image, dither=Image.Dither.NONE))[0]
+    return table
+
+def apply_palettes(image: Image.Image, palettes: Sequence, mapper: Optional[PaletteMapper] = None) -> List[Image.Image]:
+    """
+    Map an image to every palette without dithering, returning one 'P' image per palette.
+
+    The image's distinct colors and inverse index are computed once, every
+    palette matches only those colors, and all the variants come out of a
+    single gather of the (P, U) index table. The results are identical to
+    mapping the image to each palette separately.
+    """
+    mapper = mapper or PaletteMapper()
+    pixels = np.asarray(image.convert('RGB'))
+    colors, inverse = unique_colors(pixels)
+    indices = palette_index_table(colors, palettes, mapper)[:, inverse]
+    variants = []
+    for palette, palette_indices in zip(palettes, indices):
+        if mapper.quantizer == 'lut':
+            variants.append(indices_to_image(palette_indices, get_palette_lut(palette.colors, mapper.lut_bits, mapper.metric).colors))
+        elif mapper.quantizer == 'numpy':
+            variants.append(indices_to_image(palette_indices, palette_array(palette.colors)))
+        else:
+            variant = Image.fromarray(palette_indices, 'P')
+            variant.putpalette(palette.image.getpalette())
+            variants.append(variant)
+    return variants
+
+def contact_sheet(images: Sequence[Image.Image], columns: Optional[int] = None, padding: int = 0, background: Tuple[int, int, int] = (0, 0, 0)) -> Image.Image:
+    """Arrange images in a grid, row by row, with columns defaulting to a square layout"""
+    if not images:
+        raise ValueError("A contact sheet needs at least one image")
+    columns = columns or math.ceil(math.sqrt(len(images)))
+    rows = math.ceil(len(images) / columns)
+    cell_width = max(image.width for image in images)
+    cell_height = max(image.height for image in images)
+    sheet = Image.new('RGB', (
+        columns * cell_width + (columns + 1) * padding,
+        rows * cell_height + (rows + 1) * padding,
+    ), background)
+    for position, image in enumerate(images):
+        row, column = divmod(position, columns)
+        sheet.paste(image.convert('RGB'), (
+            padding + column * (cell_width + padding),
+            padding + row * (cell_height + padding),
+        ))
+    return sheet
+
+def save_pages(images: Sequence[Image.Image], path: Path):
+    """Save images as the pages or frames of one file (TIFF, GIF, WebP or PDF, from the extension)"""
+    first, *rest = images
+    first.save(path, save_all=True, append_images=rest)
@@ -0,0 +1,122 @@
+"""
+Parallel batch processing of images with a process pool
+"""
+
+import os
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import profiling
+from palette_swap import CompiledJob, ImagePalette, compile_job, process_picture
+
+# (input path, output path, contrasts, saturations) for one unit of work
+BatchTask = Tuple[Path, Path, Optional[List[float]], Optional[List[float]]]
+
+# Palettes and process_picture options shared by every task, set once per worker process
+_worker_palettes: Optional[List[ImagePalette]] = None
+_worker_options: Dict[str, Any] = {}
+_worker_show_traceback = False
+# Compiled jobs of the worker by (contrasts, saturations), as split tasks each have their own
+_worker_jobs: Dict[Tuple[Tuple[float, ...], Tuple[float, ...]], CompiledJob] = {}
+
+def _init_worker(palettes: Optional[List[ImagePalette]], options: Dict[str, Any], show_traceback: bool = False, profile: bool = False):
+    global _worker_palettes, _worker_options, _worker_show_traceback
+    _worker_palettes = palettes
+    _worker_options = options
+    _worker_show_traceback = show_traceback
+    _worker_jobs.clear()
+    if profile:
+        profiling.enable()
+
+def _init_pool_worker(palettes: Optional[List[ImagePalette]], options: Dict[str, Any], show_traceback: bool = False, profile: bool = False):
+    # Forked workers inherit the parent's profiler along with its events
+    profiling.disable()
+    _init_worker(palettes, options, show_traceback, profile)
+
+def task_job(jobs: Dict[Tuple[Tuple[float, ...], Tuple[float, ...]], CompiledJob], options: Dict[str, Any], palettes: Optional[List[ImagePalette]], contrasts: Optional[List[float]], saturations: Optional[List[float]]) -> CompiledJob:
+    """Compiled job for a task's contrasts and saturations, compiled on first use and kept in jobs"""
+    key = (tuple(contrasts or ()), tuple(saturations or ()))
+    if key not in jobs:
+        jobs[key] = compile_job(options, palettes, contrasts, saturations)
+    return jobs[key]
+
+def _run_task(task: BatchTask) -> Tuple[BatchTask, Optional[str], List[Path], List[Dict[str, Any]]]:
+    """Process one task, returning the error message instead of raising, and the profiling events of the task"""
+    input_path, output_path, contrasts, saturations = task
+    profiler = profiling.active()
+    try:
+        with profiling.image_scope(str(input_path)):
+            job = task_job(_worker_jobs, _worker_options, _worker_palettes, contrasts, saturations)
+            outputs = process_picture(
+                input_path, output_path, saturation=saturations, constrast=contrasts,
+                palettes=_worker_palettes, job=job, **_worker_options
+            )
+    except Exception as e:
+        detail = traceback.format_exc() if _worker_show_traceback else ""
+        return task, f"{e}\n{detail}".rstrip(), [], profiler.drain() if profiler else []
+    return task, None, outputs, profiler.drain() if profiler else []
+
+def make_tasks(files: List[Tuple[Path, Path]], constrast: Optional[List[float]] = None, saturation: Optional[List[float]] = None, split_permutations: bool = False) -> List[BatchTask]:
+    """
+    Build the task list for a batch.
+
+    With split_permutations, every contrast/saturation pair of an image becomes
+    its own task so the permutations of a large image run on several workers.
+    """
+    if not split_permutations:
+        return [(input_path, output_path, constrast, saturation) for input_path, output_path in files]
+    contrasts = constrast if constrast else [1.0]
+    saturations = saturation if saturation else [1.0]
+    return [
+        (input_path, output_path, [contrast_val], [saturation_val])
+        for input_path, output_path in files
+        for contrast_val in contrasts
+        for saturation_val in saturations
+    ]
+
+def process_batch(tasks: List[BatchTask], palettes: Optional[List[ImagePalette]] = None, jobs: int = 1, ordered: bool = False, show_traceback: bool = False, profile: bool = False, **options: Any) -> Iterator[Tuple[BatchTask, Optional[str], List[Path]]]:
+    """
+    Run process_picture for every task and yield (task, error, outputs) as tasks finish.
+
+    Palettes are built once by the caller and sent to each worker a single time
+    through the pool initializer, and every worker compiles the processing
+    parameters once (see palette_swap.CompiledJob) for all its tasks. A
+    failing task yields its error message and does not stop the rest of the
+    batch; outputs lists the files written.
+
+    Args:
+        tasks: Tasks from make_tasks
+        jobs: Number of worker processes (0 for one per CPU, 1 to run in-process)
+        ordered: Yield results in task order instead of completion order
+        show_traceback: Include the full traceback in error messages
+        profile: Time the stages of every task, in worker processes too, and
+                 collect the events in this process's profiler
+        options: Remaining process_picture arguments (downscale_width_resolution,
+                 dither, colors, ...), the same for every task
+    """
+    jobs = jobs or os.cpu_count() or 1
+    # Also keep collecting when the caller enabled profiling itself
+    profiler = profiling.enable() if profile else profiling.active()
+
+    def finished(result: Tuple[BatchTask, Optional[str], List[Path], List[Dict[str, Any]]]) -> Tuple[BatchTask, Optional[str], List[Path]]:
+        task, error, outputs, events = result
+        if profiler:
+            profiler.extend(events)
+        return task, error, outputs
+
+    if jobs == 1 or len(tasks) <= 1:
+        _init_worker(palettes, options, show_traceback, profile)
+        for task in tasks:
+            yield finished(_run_task(task))
+        return
+
+    with ProcessPoolExecutor(max_workers=min(jobs, len(tasks)), initializer=_init_pool_worker, initargs=(palettes, options, show_traceback, profile)) as executor:
+        futures = {executor.submit(_run_task, task): task for task in tasks}
+        for future in (futures if ordered else as_completed(futures)):
+            try:
+                yield finished(future.result())
+            except Exception as e:
+                # The worker itself died (e.g. killed or out of memory)
+                yield futures[future], str(e), []
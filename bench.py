@@ -0,0 +1,451 @@
+"""
+Benchmarks for the palette_swap pipeline
+"""
+
+import argparse
+import io
+import json
+import platform
+import subprocess
+import sys
+import time
+import numpy as np
+from PIL import Image
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from detect import DEFAULT_CONFIDENCE, DETECT_FORMATS, detect_pixel_size_sampled
+from enhance import ColorEnhancer
+from palette_swap import ImagePalette, _apply_colors, _apply_contrast, _apply_palette, _apply_saturation, detect_pixel_size, process_image, write_image
+from palettes import PaletteCollection
+from quantize import PaletteMapper
+
+# Pipeline stages timed by bench_pipeline_case, in processing order
+STAGES = ('load', 'detect', 'downscale', 'enhance', 'quantize', 'color_reduce', 'upscale', 'encode')
+IMAGE_KINDS = ('photo', 'pixelart')
+# Bump when the baseline file layout changes
+BASELINE_VERSION = 1
+# CLI invocations timed by bench_startup, and modules they must not import
+STARTUP_COMMANDS = (('--version',), ('--help',), ('palettes',), ('process', '--help'))
+STARTUP_FORBIDDEN = ('numpy', 'PIL')
+# Output encodings compared by bench_encode: format and write_image options
+ENCODINGS = {
+    'png': ('png', {}),
+    'png level 1': ('png', {'compress_level': 1}),
+    'png rle': ('png', {'strategy': 'rle'}),
+    'png indexed': ('png', {'indexed': True}),
+    'png optimize': ('png', {'optimize': True}),
+    'webp lossless': ('webp', {}),
+    'qoi': ('qoi', {}),
+}
+
+def make_pixel_art(width: int, height: int, pixel_size: int, colors: int = 16, seed: int = 0) -> Image.Image:
+    """Create a synthetic pixel art image made of pixel_size x pixel_size blocks"""
+    rng = np.random.default_rng(seed)
+    palette = rng.integers(0, 256, size=(colors, 3), dtype=np.uint8)
+    rows = -(-height // pixel_size)
+    cols = -(-width // pixel_size)
+    indices = rng.integers(0, colors, size=(rows, cols))
+    blocks = palette[indices]
+    pixels = np.repeat(np.repeat(blocks, pixel_size, axis=0), pixel_size, axis=1)
+    return Image.fromarray(np.ascontiguousarray(pixels[:height, :width]), 'RGB')
+
+def _legacy_detect_pixel_size(image: Image.Image, max_size: int = 16) -> int:
+    """Per-block loop detector that detect_pixel_size replaced, kept as a baseline"""
+    img_array = np.array(image.convert('RGB'))
+    height, width, _ = img_array.shape
+    best_score = 0
+    best_size = 1
+    sizes_to_test = list(range(2, min(max_size + 1, min(width, height) // 2)))
+    sizes_to_test.reverse()
+    for size in sizes_to_test:
+        if width % size != 0 or height % size != 0:
+            continue
+        total_blocks = 0
+        uniform_blocks = 0
+        for y in range(0, height - size + 1, size):
+            for x in range(0, width - size + 1, size):
+                block = img_array[y:y+size, x:x+size]
+                if np.all(np.abs(block - block[0, 0]) <= 5):
+                    uniform_blocks += 1
+                total_blocks += 1
+        score = uniform_blocks / total_blocks if total_blocks > 0 else 0
+        adjusted_score = score + (size * 0.01)
+        if adjusted_score > best_score:
+            best_score = adjusted_score
+            best_size = size
+    return best_size if (best_score - (best_size * 0.01)) > 0.6 else 1
+
+def time_call(func: Callable[[], object], repeat: int = 3) -> float:
+    """Best wall-clock time of repeat calls, in seconds"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def bench_detect_pixel_size(resolutions: List[Tuple[int, int]], pixel_size: int = 4, legacy_max_pixels: int = 1024 * 1024, repeat: int = 3):
+    """Compare per-megapixel cost of detect_pixel_size against the legacy loop and sampled detection"""
+    print(f"{'resolution':>12} {'vectorized ms/MP':>18} {'sampled ms/MP':>14} {'legacy ms/MP':>14} {'speedup':>9}")
+    for width, height in resolutions:
+        image = make_pixel_art(width, height, pixel_size)
+        megapixels = width * height / 1e6
+        fast = time_call(lambda: detect_pixel_size(image), repeat) / megapixels
+        sampled = time_call(lambda: detect_pixel_size_sampled(image), repeat) / megapixels
+        if width * height <= legacy_max_pixels:
+            legacy = time_call(lambda: _legacy_detect_pixel_size(image), 1) / megapixels
+            legacy_text = f"{legacy * 1000:14.1f}"
+            speedup_text = f"{legacy / fast:8.1f}x"
+        else:
+            legacy_text = f"{'skipped':>14}"
+            speedup_text = f"{'-':>9}"
+        print(f"{width:>6}x{height:<5} {fast * 1000:18.2f} {sampled * 1000:14.2f} {legacy_text} {speedup_text}")
+
+def make_photo(width: int, height: int, seed: int = 0) -> Image.Image:
+    """Create a synthetic photo-like image: smooth color gradients plus sensor-like noise"""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    channels = []
+    for _ in range(3):
+        fx, fy, phase = rng.uniform(1, 6), rng.uniform(1, 6), rng.uniform(0, 2 * np.pi)
+        channels.append(np.sin(x / width * fx * np.pi + phase) * np.cos(y / height * fy * np.pi))
+    pixels = (np.stack(channels, axis=-1) * 100 + 128 + rng.normal(0, 12, (height, width, 3)))
+    return Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8), 'RGB')
+
+def make_palette(colors: int, seed: int = 0) -> ImagePalette:
+    """Random palette of the given size, built like palettes loaded from images"""
+    rng = np.random.default_rng(seed)
+    values = rng.integers(0, 256, size=(colors, 3), dtype=np.uint8)
+    image = Image.fromarray(values.reshape(1, colors, 3), 'RGB').convert('P')
+    return ImagePalette(f"random{colors}", image, [tuple(int(c) for c in color) for color in values])
+
+def _reset_peak_rss() -> bool:
+    """Reset the peak resident set size of this process, where the OS allows it (Linux)"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+def peak_rss_mb() -> Optional[float]:
+    """Peak resident set size of this process in MB, None where it cannot be measured"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+def case_name(kind: str, width: int, height: int, palette_colors: int) -> str:
+    return f"{kind}-{width}x{height}-p{palette_colors}"
+
+def bench_pipeline_case(kind: str, width: int, height: int, palette_colors: int = 16, quantizer: str = 'pillow', pixel_size: int = 4, repeat: int = 3) -> Dict[str, Any]:
+    """
+    Time every stage of process_picture on one synthetic input.
+
+    Each stage is timed on the output of the previous one and reported as
+    seconds and source megapixels per second. The image is downscaled by
+    pixel_size, as for pixel art with blocks of that size.
+    """
+    image = make_pixel_art(width, height, pixel_size) if kind == 'pixelart' else make_photo(width, height)
+    buffer = io.BytesIO()
+    image.save(buffer, 'PNG')
+    source = buffer.getvalue()
+    palette = make_palette(palette_colors)
+    mapper = PaletteMapper(quantizer)
+    small_size = (max(1, width // pixel_size), max(1, height // pixel_size))
+    _reset_peak_rss()
+
+    # Every stage produces the input of the next one
+    stages: List[Tuple[str, Callable[[Any], Any]]] = [
+        ('load', lambda data: Image.open(io.BytesIO(data)).convert('RGB')),
+        ('detect', lambda img: (detect_pixel_size(img), img)[1]),
+        ('downscale', lambda img: img.resize(small_size, Image.Resampling.NEAREST)),
+        ('enhance', lambda img: _apply_saturation(_apply_contrast(img, '', 1.2)[0], '', 1.1)[0]),
+        ('quantize', lambda img: _apply_palette(img, '', Image.Dither.NONE, palette, mapper)[0]),
+        ('color_reduce', lambda img: _apply_colors(img, '', max(2, palette_colors // 2))[0]),
+        ('upscale', lambda img: img.resize((width, height), Image.Resampling.NEAREST)),
+        ('encode', lambda img: img.save(io.BytesIO(), 'PNG')),
+    ]
+    megapixels = width * height / 1e6
+    timings = {}
+    value: Any = source
+    for stage, func in stages:
+        stage_input = value
+        timings[stage] = time_call(lambda: func(stage_input), repeat)
+        value = func(stage_input)
+    return {
+        'name': case_name(kind, width, height, palette_colors),
+        'kind': kind,
+        'size': [width, height],
+        'palette_colors': palette_colors,
+        'quantizer': quantizer,
+        'stages': {stage: {'seconds': seconds, 'mp_per_s': megapixels / seconds if seconds else float('inf')} for stage, seconds in timings.items()},
+        'total_seconds': sum(timings.values()),
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+def bench_pipeline(kinds: List[str], sizes: List[int], palette_sizes: List[int], quantizer: str = 'pillow', pixel_size: int = 4, repeat: int = 3) -> List[Dict[str, Any]]:
+    """Run bench_pipeline_case for every kind, square size and palette size"""
+    return [
+        bench_pipeline_case(kind, size, size, palette_colors, quantizer, pixel_size, repeat)
+        for kind in kinds
+        for size in sizes
+        for palette_colors in palette_sizes
+    ]
+
+def bench_palette_collection(repeat: int = 3) -> Dict[str, float]:
+    """Seconds to load every built-in palette, with and without the palette index cache"""
+    def load_all(use_cache: bool):
+        collection = PaletteCollection(use_cache=use_cache)
+        for name in collection.list_palettes():
+            collection.get_palette(name)
+    return {
+        'cached_seconds': time_call(lambda: load_all(True), repeat),
+        'uncached_seconds': time_call(lambda: load_all(False), repeat),
+    }
+
+def bench_enhance(kinds: List[str], sizes: List[int], pixel_size: int = 4, contrasts: Tuple[float, ...] = (0.8, 1.2), saturations: Tuple[float, ...] = (0.7, 1.3), repeat: int = 3) -> List[Dict[str, Any]]:
+    """
+    Seconds to compute every contrast and saturation pair of an image with ImageEnhance and with ColorEnhancer.
+
+    Pillow runs the contrast of every factor once and the saturations on
+    top of it, like the permutation tree; ColorEnhancer is built once per
+    image. The results are checked to be identical.
+    """
+    results = []
+    for kind in kinds:
+        for size in sizes:
+            image = make_pixel_art(size, size, pixel_size) if kind == 'pixelart' else make_photo(size, size)
+            def pillow():
+                variants = []
+                for contrast in contrasts:
+                    contrasted = _apply_contrast(image, '', contrast)[0]
+                    variants += [_apply_saturation(contrasted, '', saturation)[0] for saturation in saturations]
+                return variants
+            def numpy_enhancer():
+                enhancer = ColorEnhancer(image)
+                return [enhancer.enhance(contrast, saturation) for contrast in contrasts for saturation in saturations]
+            identical = all(np.array_equal(np.asarray(a), np.asarray(b)) for a, b in zip(pillow(), numpy_enhancer()))
+            results.append({
+                'name': f"{kind}-{size}x{size}",
+                'pillow_seconds': time_call(pillow, repeat),
+                'numpy_seconds': time_call(numpy_enhancer, repeat),
+                'identical': identical,
+            })
+    return results
+
+def bench_encode(kinds: List[str], sizes: List[int], scale: int = 4, quantizer: str = 'pillow', repeat: int = 3) -> List[Dict[str, Any]]:
+    """
+    Encode time and size of every ENCODINGS entry on images mapped to each built-in palette.
+
+    Every synthetic image of sizes is processed with every built-in palette,
+    then the result is saved with write_image as the downscaled output and
+    as the full-size output scale times larger. Seconds and bytes are summed
+    over palettes.
+    """
+    collection = PaletteCollection()
+    palettes = [ImagePalette(name, collection.create_palette_image(name), collection.get_palette(name)) for name in collection.list_palettes()]
+    mapper = PaletteMapper(quantizer)
+    results = []
+    for kind in kinds:
+        for size in sizes:
+            image = make_pixel_art(size, size, 1) if kind == 'pixelart' else make_photo(size, size)
+            mapped = [next(process_image(image, size, [Image.Dither.NONE], palettes=[palette], mapper=mapper))[1] for palette in palettes]
+            for encoding, (format, options) in ENCODINGS.items():
+                row = {'name': f"{kind}-{size}x{size}", 'encoding': encoding, 'palettes': len(palettes)}
+                for output, full_size in (('downscaled', None), ('full_size', (size * scale, size * scale))):
+                    seconds = encoded = 0
+                    for processed in mapped:
+                        output_file = io.BytesIO()
+                        def encode():
+                            output_file.seek(0)
+                            output_file.truncate()
+                            write_image(processed, output_file, full_size, format, **options)
+                        seconds += time_call(encode, repeat)
+                        encoded += output_file.tell()
+                    row[f'{output}_seconds'] = seconds
+                    row[f'{output}_bytes'] = encoded
+                results.append(row)
+    return results
+
+def parse_importtime(output: str) -> Dict[str, int]:
+    """
+    Cumulative import time in microseconds of every module in python -X importtime output.
+
+    The '' key holds the total: the sum over the modules imported at the
+    top level, whose names are indented by a single space.
+    """
+    modules = {'': 0}
+    for line in output.splitlines():
+        fields = line.split('|')
+        if not line.startswith('import time:') or len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+        name, cumulative = fields[2], int(fields[1])
+        modules[name.strip()] = cumulative
+        if not name.startswith('  '):
+            modules[''] += cumulative
+    return modules
+
+def bench_startup(repeat: int = 3) -> List[Dict[str, Any]]:
+    """
+    Wall time and import time of CLI invocations that should start without NumPy or Pillow.
+
+    Every command in STARTUP_COMMANDS runs as a fresh `python cli.py`
+    process repeat times (the fastest is kept) and once more under
+    -X importtime, which gives the import time and the imported modules.
+    """
+    cli_path = Path(__file__).parent / 'cli.py'
+    results = []
+    for args in STARTUP_COMMANDS:
+        command = [sys.executable, str(cli_path), *args]
+        def run():
+            subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        seconds = time_call(run, repeat)
+        traced = subprocess.run([sys.executable, '-X', 'importtime', *command[1:]], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, check=True)
+        modules = parse_importtime(traced.stderr)
+        results.append({
+            'command': ' '.join(args),
+            'seconds': seconds,
+            'import_seconds': modules[''] / 1e6,
+            'forbidden': [name for name in STARTUP_FORBIDDEN if name in modules],
+        })
+    return results
+
+def cli_choice_mismatches() -> List[str]:
+    """Names of the CLI choice lists that no longer match the constants they mirror"""
+    import cli
+    from colorspace import COLOR_SPACES
+    from downscale import DOWNSCALE_METHODS
+    from encoding import OUTPUT_FORMATS, PNG_STRATEGIES
+    from extract import DEFAULT_MAX_PIXELS, EXTRACT_METHODS
+    pairs = {
+        'DOWNSCALE_CHOICES': (cli.DOWNSCALE_CHOICES, list(DOWNSCALE_METHODS)),
+        'EXTRACT_CHOICES': (cli.EXTRACT_CHOICES, list(EXTRACT_METHODS)),
+        'COLOR_SPACE_CHOICES': (cli.COLOR_SPACE_CHOICES, list(COLOR_SPACES)),
+        'DEFAULT_EXTRACT_PIXELS': (cli.DEFAULT_EXTRACT_PIXELS, DEFAULT_MAX_PIXELS),
+        'FORMAT_CHOICES': (cli.FORMAT_CHOICES, list(OUTPUT_FORMATS)),
+        'PNG_STRATEGY_CHOICES': (cli.PNG_STRATEGY_CHOICES, list(PNG_STRATEGIES)),
+        'DETECT_FORMAT_CHOICES': (cli.DETECT_FORMAT_CHOICES, list(DETECT_FORMATS)),
+        'DEFAULT_DETECT_CONFIDENCE': (cli.DEFAULT_DETECT_CONFIDENCE, DEFAULT_CONFIDENCE),
+    }
+    return [name for name, (choices, expected) in pairs.items() if choices != expected]
+
+def save_baseline(path: Path, results: List[Dict[str, Any]]):
+    """Store benchmark results, with the machine they ran on, as a baseline"""
+    data = {
+        'version': BASELINE_VERSION,
+        'machine': {'platform': platform.platform(), 'processor': platform.processor(), 'python': platform.python_version()},
+        'results': results,
+    }
+    path.write_text(json.dumps(data, indent=2), encoding='utf-8')
+
+def compare_baseline(path: Path, results: List[Dict[str, Any]], threshold: float = 0.1) -> List[Dict[str, Any]]:
+    """
+    Compare results against a stored baseline, case by case and stage by stage.
+
+    Returns one row per stage found in both, with the time ratio (current /
+    baseline) and whether it is a regression, i.e. slower by more than
+    threshold (a fraction of the baseline time).
+    """
+    data = json.loads(path.read_text(encoding='utf-8'))
+    if data.get('version') != BASELINE_VERSION:
+        raise ValueError(f"Unsupported baseline version {data.get('version')} in {path}")
+    baseline = {result['name']: result for result in data['results']}
+    rows = []
+    for result in results:
+        reference = baseline.get(result['name'])
+        if not reference:
+            continue
+        for stage, timing in result['stages'].items():
+            if stage not in reference['stages']:
+                continue
+            ratio = timing['seconds'] / max(reference['stages'][stage]['seconds'], 1e-9)
+            rows.append({'name': result['name'], 'stage': stage, 'baseline_seconds': reference['stages'][stage]['seconds'], 'seconds': timing['seconds'], 'ratio': ratio, 'regression': ratio > 1 + threshold})
+    return rows
+
+def print_pipeline_results(results: List[Dict[str, Any]]):
+    print(f"{'case':>24} " + " ".join(f"{stage:>12}" for stage in STAGES) + f" {'peak RSS':>9}")
+    for result in results:
+        cells = " ".join(f"{result['stages'][stage]['mp_per_s']:>7.1f} MP/s" for stage in STAGES)
+        rss = f"{result['peak_rss_mb']:>6.0f} MB" if result['peak_rss_mb'] is not None else f"{'-':>9}"
+        print(f"{result['name']:>24} {cells} {rss}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the palette_swap pipeline on synthetic inputs.")
+    parser.add_argument('--suite', choices=['pipeline', 'detect', 'palettes', 'startup', 'enhance', 'encode'], help='Per-stage pipeline timings, the pixel size detector against its legacy loop, palette loading, CLI startup, the contrast and saturation engines, or output encodings', default='pipeline')
+    parser.add_argument('--sizes', nargs='+', type=int, help='Square image sizes to benchmark', default=[256, 512, 1024, 2048])
+    parser.add_argument('--kinds', nargs='+', choices=IMAGE_KINDS, help='Synthetic image kinds for the pipeline, enhance and encode suites', default=list(IMAGE_KINDS))
+    parser.add_argument('--palette-sizes', nargs='+', type=int, help='Palette sizes for the pipeline suite', default=[16])
+    parser.add_argument('--quantizer', choices=['pillow', 'lut', 'numpy'], help='Palette mapping engine for the pipeline and encode suites', default='pillow')
+    parser.add_argument('--pixel-size', type=int, help='Block size of the synthetic pixel art, and full-size scale of the encode suite', default=4)
+    parser.add_argument('--legacy-max-pixels', type=int, help='Largest image the slow legacy detector is timed on', default=1024 * 1024)
+    parser.add_argument('--repeat', type=int, help='Number of timed runs per measurement', default=3)
+    parser.add_argument('--save-baseline', type=Path, help='Store the pipeline results as a JSON baseline', default=None)
+    parser.add_argument('--compare', type=Path, help='Compare the pipeline results with a JSON baseline', default=None)
+    parser.add_argument('--max-import-ms', type=float, help='Import time above which the startup suite fails', default=300.0)
+    parser.add_argument('--threshold', type=float, help='Slowdown fraction reported as a regression by --compare', default=0.1)
+    args = parser.parse_args()
+
+    if args.suite == 'detect':
+        bench_detect_pixel_size([(size, size) for size in args.sizes], args.pixel_size, args.legacy_max_pixels, args.repeat)
+        return
+    if args.suite == 'palettes':
+        timings = bench_palette_collection(args.repeat)
+        print(f"Palette collection: {timings['cached_seconds'] * 1000:.1f} ms cached, {timings['uncached_seconds'] * 1000:.1f} ms uncached")
+        return
+    if args.suite == 'enhance':
+        for result in bench_enhance(args.kinds, args.sizes, args.pixel_size, repeat=args.repeat):
+            print(f"{result['name']:>20}: pillow {result['pillow_seconds'] * 1000:8.2f} ms, numpy {result['numpy_seconds'] * 1000:8.2f} ms ({result['pillow_seconds'] / result['numpy_seconds']:.2f}x)" + ("" if result['identical'] else "  MISMATCH"))
+        return
+    if args.suite == 'encode':
+        results = bench_encode(args.kinds, args.sizes, args.pixel_size, args.quantizer, args.repeat)
+        for result in results:
+            if result['encoding'] == next(iter(ENCODINGS)):
+                print(f"{result['name']} on {result['palettes']} palettes, full size x{args.pixel_size}: ms and KB per image, downscaled | full size")
+            count = result['palettes']
+            print(f"  {result['encoding']:>14}: {result['downscaled_seconds'] * 1000 / count:8.2f} ms {result['downscaled_bytes'] / 1024 / count:8.1f} KB | "
+                  f"{result['full_size_seconds'] * 1000 / count:8.2f} ms {result['full_size_bytes'] / 1024 / count:9.1f} KB")
+        return
+    if args.suite == 'startup':
+        failures = 0
+        for name in cli_choice_mismatches():
+            failures += 1
+            print(f"cli.{name} no longer matches the constant it mirrors")
+        for result in bench_startup(args.repeat):
+            import_ms = result['import_seconds'] * 1000
+            problems = [f"imports {name}" for name in result['forbidden']]
+            if import_ms > args.max_import_ms:
+                problems.append(f"imports take over {args.max_import_ms:.0f} ms")
+            failures += bool(problems)
+            print(f"{result['command']:>16}: {result['seconds'] * 1000:7.1f} ms, {import_ms:6.1f} ms importing" + (f"  REGRESSION: {', '.join(problems)}" if problems else ""))
+        if failures:
+            sys.exit(1)
+        return
+
+    results = bench_pipeline(args.kinds, args.sizes, args.palette_sizes, args.quantizer, args.pixel_size, args.repeat)
+    print_pipeline_results(results)
+    if args.save_baseline:
+        save_baseline(args.save_baseline, results)
+        print(f"Baseline saved to {args.save_baseline}")
+    if args.compare:
+        rows = compare_baseline(args.compare, results, args.threshold)
+        regressions = [row for row in rows if row['regression']]
+        for row in regressions:
+            print(f"Regression: {row['name']} {row['stage']} {row['baseline_seconds'] * 1000:.2f} ms -> {row['seconds'] * 1000:.2f} ms ({row['ratio']:.2f}x)")
+        print(f"{len(regressions)} regression(s) in {len(rows)} compared stages")
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
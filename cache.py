@@ -0,0 +1,29 @@
+"""
+Location of and atomic writes to the on-disk cache
+"""
+
+import os
+import tempfile
+from pathlib import Path
+from typing import Callable, IO
+
+def get_cache_dir() -> Path:
+    """Directory for on-disk caches ($PXLTR_CACHE_DIR, else the XDG cache directory)"""
+    if os.environ.get('PXLTR_CACHE_DIR'):
+        return Path(os.environ['PXLTR_CACHE_DIR'])
+    return Path(os.environ.get('XDG_CACHE_HOME', Path.home() / '.cache')) / 'pxltr'
+
+def atomic_write(path: Path, write: Callable[[IO[bytes]], None]):
+    """
+    Write a file through a temporary sibling and rename it into place, so
+    concurrent readers never see a partially written file.
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=path.parent, suffix='.tmp', delete=False) as f:
+        try:
+            write(f)
+        except BaseException:
+            f.close()
+            os.unlink(f.name)
+            raise
+    os.replace(f.name, path)
@@ -4,18 +4,48 @@ PixelArt Colors Tool - A fully featured CLI for pixel art color palette processi
 """
 
 import click
-from rich.console import Console
-from rich.table import Table
-from rich.progress import Progress, SpinnerColumn, TextColumn
-from rich.panel import Panel
 from pathlib import Path
-from typing import List, Optional, Tuple
+from typing import TYPE_CHECKING, Dict, List, Optional, Sequence, Tuple
 import sys
 
-from palette_swap import process_picture, ImagePalette
-from palettes import PaletteCollection
+import profiling
 
-console = Console()
+if TYPE_CHECKING:
+    from palette_swap import ImagePalette
+    from palettes import PaletteCollection
+
+# Commands import NumPy, Pillow and the processing modules when they run, so
+# --help, --version and palette listing start without them. The choices below
+# mirror downscale.DOWNSCALE_METHODS, extract.EXTRACT_METHODS,
+# colorspace.COLOR_SPACES, extract.DEFAULT_MAX_PIXELS, encoding.OUTPUT_FORMATS
+# and encoding.PNG_STRATEGIES.
+DOWNSCALE_CHOICES = ['nearest', 'mean', 'median', 'mode', 'edge']
+EXTRACT_CHOICES = ['kmeans', 'median-cut', 'pillow']
+COLOR_SPACE_CHOICES = ['rgb', 'cielab', 'oklab']
+DEFAULT_EXTRACT_PIXELS = 1 << 18
+FORMAT_CHOICES = ['png', 'webp', 'qoi']
+PNG_STRATEGY_CHOICES = ['default', 'filtered', 'huffman', 'rle', 'fixed']
+DETECT_FORMAT_CHOICES = ['table', 'json', 'csv']
+DEFAULT_DETECT_CONFIDENCE = 0.95
+# Files a directory input is searched for, by lowercased suffix
+IMAGE_SUFFIXES = ('.png', '.jpg', '.jpeg', '.gif')
+
+class _LazyConsole:
+    """rich Console created on first use"""
+    
+    def __init__(self):
+        self._console = None
+    
+    def get(self):
+        if self._console is None:
+            from rich.console import Console
+            self._console = Console()
+        return self._console
+    
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+console = _LazyConsole()
 
 @click.group(invoke_without_command=True)
 @click.pass_context
@@ -27,6 +57,7 @@ def cli(ctx):
     swapping palettes, and creating pixel art effects.
     """
     if ctx.invoked_subcommand is None:
+        from rich.panel import Panel
         console.print(Panel.fit(
             "[bold blue]PixelArt Colors Tool[/bold blue]\n\n"
             "Transform your images with retro color palettes!\n\n"
@@ -42,111 +73,224 @@ def cli(ctx):
 @click.option('--colors', '-c', multiple=True, type=int, help='Force quantization to specific color counts')
 @click.option('--contrast', multiple=True, type=float, help='Adjust contrast (0.0 to infinity)')
 @click.option('--saturation', '-s', multiple=True, type=float, help='Adjust saturation (0.0 to infinity)')
-@click.option('--dither', '-d', type=click.Choice(['none', 'floyd', 'both']), default='none',
-              help='Dithering method: none, floyd-steinberg, or both')
+@click.option('--dither', '-d', multiple=True, default=['none'],
+              type=click.Choice(['none', 'floyd', 'both', 'bayer', 'atkinson', 'sierra', 'jarvis']),
+              help='Dithering method: none, floyd-steinberg, both (none and floyd), bayer, atkinson, sierra or jarvis')
 @click.option('--auto-detect-pixel-size', '-a', is_flag=True, help='Automatically detect optimal pixel size from source image')
+@click.option('--detect-samples', default=0, type=click.IntRange(min=0),
+              help='With -a, detect from at most this many random blocks per pixel size (0 tests every block)')
+@click.option('--downscale', type=click.Choice(DOWNSCALE_CHOICES), default='nearest',
+              help='Downscaling: nearest sampling, or the mean, median, mode (majority) or edge-preserving color of each block')
+@click.option('--enhance', 'enhancer', type=click.Choice(['pillow', 'numpy']), default='pillow',
+              help='Contrast and saturation engine: pillow (ImageEnhance) or numpy (lookup tables, same pixels, fastest on pixel art)')
+@click.option('--quantizer', '-q', type=click.Choice(['pillow', 'lut', 'numpy']), default='pillow',
+              help='Palette mapping engine: pillow, lut (cached lookup table) or numpy (direct search)')
+@click.option('--metric', '-m', type=click.Choice(['rgb', 'redmean', 'cielab', 'oklab']), default='rgb',
+              help='Color distance used by the lut and numpy quantizers')
+@click.option('--max-memory', type=click.IntRange(min=1), help='Memory budget in MB for nearest-color distance matrices and, with --tiled, tile size')
+@click.option('--tiled', is_flag=True, help='Read and write large images in strips to stay within --max-memory (PNG output)')
+@click.option('--lut-bits', type=click.Choice(['5', '6', '8']), default='6',
+              help='Bits per channel of the palette lookup table (8 is exact)')
+@click.option('--sequence', is_flag=True, help='Treat an input directory as the frames of one animation')
+@click.option('--frame-duration', default=100, type=click.IntRange(min=1), help='Frame duration in ms for frame sequences and frames without one')
+@click.option('--stable-colors/--no-stable-colors', default=True, help='Reuse the colors chosen for the first frame of an animation')
+@click.option('--downscaled/--no-downscaled', default=True, help='Save the downscaled version of every output')
+@click.option('--full-size/--no-full-size', default=True, help='Save the output upscaled back to the original size')
+@click.option('--scale-metadata', is_flag=True, help='Record the original size in downscaled PNG and WebP outputs, for consumers upscaling them')
+@click.option('--incremental', '-i', is_flag=True, help='Skip tasks whose inputs and options are unchanged since the last run')
+@click.option('--prune', is_flag=True, help='With --incremental, delete outputs whose input files no longer exist')
+@click.option('--jobs', '-j', default=1, type=click.IntRange(min=0), help='Number of worker processes (0 for one per CPU)')
+@click.option('--pipeline', is_flag=True, help='Overlap reading, processing and writing of images with threads in one process')
+@click.option('--prefetch', default=4, type=click.IntRange(min=1), help='With --pipeline, decoded inputs read ahead of processing')
+@click.option('--compress-level', default=6, type=click.IntRange(min=0, max=9), help='zlib level of PNG outputs (0 is fastest, 9 smallest)')
+@click.option('--optimize', is_flag=True, help='Let Pillow search for smaller PNG encodings (slower)')
+@click.option('--format', 'output_format', type=click.Choice(FORMAT_CHOICES),
+              help='Output format instead of the output suffix: png, lossless webp (smallest) or qoi')
+@click.option('--png-strategy', type=click.Choice(PNG_STRATEGY_CHOICES),
+              help='zlib strategy of PNG outputs (default: filtered, as Pillow; rle is fastest)')
+@click.option('--indexed', is_flag=True, help='Write PNG outputs with at most 256 colors as indexed PNGs')
+@click.option('--ordered', is_flag=True, help='Report results in input order instead of completion order')
+@click.option('--split-permutations', is_flag=True, help='Distribute contrast/saturation permutations of each image across workers')
+@click.option('--profile', is_flag=True, help='Time every processing stage and print a summary')
+@click.option('--profile-json', type=click.Path(path_type=Path), help='With --profile, save stage timings and events as JSON')
+@click.option('--profile-trace', type=click.Path(path_type=Path), help='With --profile, save a Chrome trace (chrome://tracing, Perfetto)')
 @click.option('--verbose', '-v', is_flag=True, help='Enable verbose output')
 def process(input_path: Path, output_path: Path, width: int, palette: Tuple[str], 
            colors: Tuple[int], contrast: Tuple[float], saturation: Tuple[float], 
-           dither: str, auto_detect_pixel_size: bool, verbose: bool):
+           dither: Tuple[str], auto_detect_pixel_size: bool, detect_samples: int, downscale: str, enhancer: str, quantizer: str, metric: str,
+           max_memory: Optional[int], lut_bits: str, sequence: bool, frame_duration: int,
+           stable_colors: bool, tiled: bool, downscaled: bool, full_size: bool, scale_metadata: bool, incremental: bool, prune: bool,
+           jobs: int, pipeline: bool, prefetch: int, compress_level: int, optimize: bool, output_format: Optional[str],
+           png_strategy: Optional[str], indexed: bool, ordered: bool,
+           split_permutations: bool, profile: bool, profile_json: Optional[Path],
+           profile_trace: Optional[Path], verbose: bool):
     """Process images with pixel art effects
     
     INPUT_PATH: Path to image file or directory
     OUTPUT_PATH: Path for output file or directory
     """
     try:
+        from rich.progress import Progress, SpinnerColumn, TextColumn
+        from batch import make_tasks, process_batch
+        from manifest import ResultManifest
+        from palette_swap import DITHER_NAMES
+        from palettes import PaletteCollection
+        from pipeline import process_pipelined
+        from quantize import DEFAULT_MEMORY_BUDGET
+        
         # Validate input/output paths
-        if input_path.is_dir() and not output_path.exists():
+        if sequence and not input_path.is_dir():
+            console.print("[red]Error:[/red] --sequence needs a directory of frames as input")
+            sys.exit(1)
+        elif sequence:
+            if output_path.is_dir() or not output_path.suffix:
+                output_path.mkdir(parents=True, exist_ok=True)
+                output_path = output_path / f"{input_path.name}.gif"
+        elif input_path.is_dir() and not output_path.exists():
             output_path.mkdir(parents=True, exist_ok=True)
         elif input_path.is_dir() and output_path.is_file():
             console.print("[red]Error:[/red] If input is a directory, output must also be a directory")
             sys.exit(1)
+        if pipeline and jobs != 1:
+            console.print("[red]Error:[/red] --pipeline runs in a single process and cannot be combined with --jobs")
+            sys.exit(1)
+        if tiled and output_format not in (None, 'png'):
+            console.print("[red]Error:[/red] --tiled writes PNG files and cannot be combined with --format")
+            sys.exit(1)
+        if not downscaled and not full_size:
+            console.print("[red]Error:[/red] --no-downscaled and --no-full-size leave nothing to save")
+            sys.exit(1)
+        
+        profiler = profiling.enable() if profile or profile_json or profile_trace else None
         
         # Initialize palette collection
         palette_collection = PaletteCollection()
         
         # Process palettes
-        palette_images = []
-        if palette:
-            for plt in palette:
-                if plt.lower() in palette_collection.list_palettes():
-                    palette_img = palette_collection.create_palette_image(plt.lower())
-                    palette_images.append(ImagePalette(plt.lower(), palette_img))
-                    if verbose:
-                        console.print(f"[green]✓[/green] Loaded built-in palette: {plt}")
-                else:
-                    plt_path = Path(plt)
-                    if plt_path.exists():
-                        from PIL import Image
-                        palette_img = Image.open(plt_path).convert(mode="P", palette=Image.Palette.WEB)
-                        palette_images.append(ImagePalette(plt_path.stem, palette_img))
-                        if verbose:
-                            console.print(f"[green]✓[/green] Loaded custom palette: {plt}")
-                    else:
-                        console.print(f"[red]Error:[/red] Palette not found: {plt}")
-                        sys.exit(1)
+        palette_images = _load_palettes(palette_collection, palette, verbose)
         
-        # Convert dither option
-        dither_map = {
-            'none': 0,
-            'floyd': 1,
-            'both': 2
-        }
-        dither_value = dither_map[dither]
+        # Convert dither option, expanding 'both' and dropping repeats
+        dither_names = [name for d in dither for name in (['floyd', 'none'] if d == 'both' else [d])]
+        dither_value = [DITHER_NAMES[name] for name in dict.fromkeys(dither_names)]
+        lut_bits = int(lut_bits)
         
         # Process files
-        if input_path.is_dir():
-            image_files = list(input_path.rglob("*.png")) + list(input_path.rglob("*.jpg")) + list(input_path.rglob("*.jpeg"))
+        if sequence:
+            files = [(input_path, output_path)]
+        elif input_path.is_dir():
+            image_files = _image_files(input_path)
             
             if not image_files:
                 console.print("[yellow]Warning:[/yellow] No image files found in directory")
                 return
             
-            with Progress(
-                SpinnerColumn(),
-                TextColumn("[progress.description]{task.description}"),
-                console=console
-            ) as progress:
-                task = progress.add_task("Processing images...", total=len(image_files))
-                
-                for img_file in image_files:
-                    if verbose:
-                        console.print(f"Processing: {img_file.name}")
-                    
-                    output_file = output_path / img_file.name
-                    process_picture(
-                        img_file, output_file, width, dither_value,
-                        list(colors) if colors else None,
-                        list(saturation) if saturation else None,
-                        list(contrast) if contrast else None,
-                        palette_images if palette_images else None,
-                        auto_detect_pixel_size
-                    )
-                    progress.advance(task)
-            
-            console.print(f"[green]✓[/green] Processed {len(image_files)} images")
+            files = [(img_file, output_path / (f"{img_file.stem}.{output_format or 'png'}" if tiled or output_format else img_file.name)) for img_file in image_files]
         else:
             if output_path.is_dir():
-                output_path = output_path / input_path.name
+                output_path = output_path / (f"{input_path.stem}.{output_format or 'png'}" if tiled or output_format else input_path.name)
+            elif output_format:
+                output_path = output_path.with_suffix(f".{output_format}")
+            files = [(input_path, output_path)]
+        
+        tasks = make_tasks(
+            files,
+            list(contrast) if contrast else None,
+            list(saturation) if saturation else None,
+            split_permutations
+        )
+        failed_files = set()
+        options = dict(
+            downscale_width_resolution=width,
+            dither=dither_value,
+            colors=list(colors) if colors else None,
+            auto_detect_pixel_size=auto_detect_pixel_size,
+            detect_samples=detect_samples,
+            quantizer=quantizer,
+            lut_bits=lut_bits,
+            metric=metric,
+            memory_budget=max_memory * 1024 * 1024 if max_memory else DEFAULT_MEMORY_BUDGET,
+            stable_colors=stable_colors,
+            frame_duration=frame_duration,
+            tiled=tiled,
+            save_downscaled=downscaled,
+            save_full_size=full_size,
+            downscale=downscale,
+            enhancer=enhancer,
+            compress_level=compress_level,
+            optimize=optimize,
+            png_strategy=png_strategy,
+            indexed=indexed,
+            scale_metadata=scale_metadata
+        )
+        
+        # The manifest lives in the output directory and records what every task wrote
+        manifest = None
+        keys = {}
+        if incremental:
+            manifest = ResultManifest.load(output_path if input_path.is_dir() and not sequence else output_path.parent)
+            if prune:
+                deleted = manifest.prune()
+                console.print(f"Pruned {len(deleted)} output(s) of removed inputs")
+            pending, current = manifest.partition(tasks, palette_images if palette_images else None, options)
+            if current:
+                console.print(f"Skipping {len(current)} up-to-date task(s)")
+            tasks = [task for task, _ in pending]
+            keys = {ResultManifest.task_id(task): key for task, key in pending}
+        elif prune:
+            console.print("[yellow]Warning:[/yellow] --prune only applies with --incremental")
+        
+        with Progress(
+            SpinnerColumn(),
+            TextColumn("[progress.description]{task.description}"),
+            console=console.get()
+        ) as progress:
+            task = progress.add_task("Processing images..." if len(files) > 1 else "Processing image...", total=len(tasks))
             
-            with Progress(
-                SpinnerColumn(),
-                TextColumn("[progress.description]{task.description}"),
-                console=console
-            ) as progress:
-                task = progress.add_task("Processing image...", total=1)
-                
-                process_picture(
-                    input_path, output_path, width, dither_value,
-                    list(colors) if colors else None,
-                    list(saturation) if saturation else None,
-                    list(contrast) if contrast else None,
-                    palette_images if palette_images else None,
-                    auto_detect_pixel_size
+            if pipeline:
+                results = process_pipelined(
+                    tasks, palette_images if palette_images else None,
+                    prefetch=prefetch, ordered=ordered, show_traceback=verbose,
+                    profile=profiler is not None, **options
                 )
-                progress.advance(task)
-            
+            else:
+                results = process_batch(
+                    tasks, palette_images if palette_images else None,
+                    jobs=jobs, ordered=ordered, show_traceback=verbose,
+                    profile=profiler is not None, **options
+                )
+            try:
+                for batch_task, error, outputs in results:
+                    img_file = batch_task[0]
+                    if error:
+                        failed_files.add(img_file)
+                        console.print(f"[red]Failed:[/red] {img_file.name}: {error}")
+                    else:
+                        if manifest:
+                            manifest.record(batch_task, keys[ResultManifest.task_id(batch_task)], outputs)
+                        if verbose:
+                            console.print(f"Processed: {img_file.name}")
+                    progress.advance(task)
+            finally:
+                if manifest:
+                    manifest.save()
+        
+        if profiler:
+            _print_profile(profiler)
+            if profile_json:
+                profiler.write_json(profile_json)
+                console.print(f"Profile saved to: {profile_json}")
+            if profile_trace:
+                profiler.write_chrome_trace(profile_trace)
+                console.print(f"Chrome trace saved to: {profile_trace}")
+        
+        if input_path.is_dir() and not sequence:
+            console.print(f"[green]✓[/green] Processed {len(image_files) - len(failed_files)} images")
+        elif not failed_files:
             console.print(f"[green]✓[/green] Image processed: {output_path}")
+        
+        if failed_files:
+            console.print(f"[red]Error:[/red] {len(failed_files)} image(s) failed")
+            sys.exit(1)
     
     except Exception as e:
         console.print(f"[red]Error:[/red] {str(e)}")
@@ -154,9 +298,71 @@ def process(input_path: Path, output_path: Path, width: int, palette: Tuple[str]
             console.print_exception()
         sys.exit(1)
 
+def _image_files(directory: Path) -> List[Path]:
+    """Image files under a directory, recursively and in path order, as every command taking a directory looks for them"""
+    return sorted(path for path in directory.rglob('*') if path.suffix.lower() in IMAGE_SUFFIXES and path.is_file())
+
+def _load_palettes(palette_collection: 'PaletteCollection', names: Sequence[str], verbose: bool = False) -> List['ImagePalette']:
+    """Built-in palettes by name and custom palettes by image path, exiting when one is not found"""
+    from palette_swap import ImagePalette, load_image_palette
+    
+    palette_images = []
+    for plt in names:
+        if plt.lower() in palette_collection.list_palettes():
+            palette_img = palette_collection.create_palette_image(plt.lower())
+            palette_images.append(ImagePalette(plt.lower(), palette_img, palette_collection.get_palette(plt.lower())))
+            if verbose:
+                console.print(f"[green]✓[/green] Loaded built-in palette: {plt}")
+        else:
+            plt_path = Path(plt)
+            if plt_path.exists():
+                palette_images.append(load_image_palette(plt_path))
+                if verbose:
+                    console.print(f"[green]✓[/green] Loaded custom palette: {plt}")
+            else:
+                console.print(f"[red]Error:[/red] Palette not found: {plt}")
+                sys.exit(1)
+    return palette_images
+
+def _print_profile(profiler: profiling.Profiler, slowest: int = 10):
+    """Print the time spent per stage and the slowest images"""
+    from rich.table import Table
+    
+    stages = profiler.stage_summary()
+    total_ms = sum(stats['total_ms'] for stats in stages.values()) or 1.0
+    
+    table = Table(title="Time per Stage")
+    table.add_column("Stage", style="cyan", no_wrap=True)
+    table.add_column("Calls", justify="right")
+    table.add_column("Total ms", justify="right", style="magenta")
+    table.add_column("Mean ms", justify="right")
+    table.add_column("Max ms", justify="right")
+    table.add_column("Share", justify="right")
+    for name, stats in sorted(stages.items(), key=lambda item: -item[1]['total_ms']):
+        table.add_row(
+            name, str(int(stats['calls'])), f"{stats['total_ms']:.1f}", f"{stats['mean_ms']:.2f}",
+            f"{stats['max_ms']:.2f}", f"{stats['total_ms'] / total_ms:.0%}"
+        )
+    console.print(table)
+    
+    images = profiler.image_summary()
+    if len(images) > 1:
+        table = Table(title=f"Slowest Images (of {len(images)})")
+        table.add_column("Image", style="cyan")
+        table.add_column("Total ms", justify="right", style="magenta")
+        table.add_column("Slowest stage", justify="right")
+        for image, stats in sorted(images.items(), key=lambda item: -item[1].get('total', 0.0))[:slowest]:
+            stage_times = {name: ms for name, ms in stats.items() if name != 'total'}
+            top_stage = max(stage_times, key=stage_times.get) if stage_times else "-"
+            table.add_row(Path(image).name, f"{stats.get('total', 0.0):.1f}", f"{top_stage} ({stage_times.get(top_stage, 0.0):.1f} ms)")
+        console.print(table)
+
 @cli.command()
 def palettes():
     """List all available built-in color palettes"""
+    from rich.table import Table
+    from palettes import PaletteCollection
+    
     palette_collection = PaletteCollection()
     
     table = Table(title="Available Built-in Palettes")
@@ -165,7 +371,7 @@ def palettes():
     table.add_column("Colors", justify="right", style="magenta")
     
     for palette_name in sorted(palette_collection.list_palettes()):
-        info = palette_collection.get_palette_info(palette_name)
+        info = palette_collection.get_palette_info(palette_name, include_colors=False)
         table.add_row(
             palette_name,
             info['description'],
@@ -182,6 +388,8 @@ def show_palette(palette_name: str, output: Optional[Path]):
     
     PALETTE_NAME: Name of the built-in palette to display
     """
+    from palettes import PaletteCollection
+    
     palette_collection = PaletteCollection()
     
     if palette_name.lower() not in palette_collection.list_palettes():
@@ -218,26 +426,102 @@ def show_palette(palette_name: str, output: Optional[Path]):
 
 @cli.command()
 @click.argument('input_path', type=click.Path(exists=True, path_type=Path))
-def detect_pixel_size(input_path: Path):
+@click.option('--max-size', default=16, type=click.IntRange(min=2), help='Largest pixel size tested')
+@click.option('--tolerance', default=5, type=click.IntRange(min=0), help='Per-channel difference allowed within a pixel block')
+@click.option('--samples', default=0, type=click.IntRange(min=0),
+              help='Test at most this many random blocks per pixel size, e.g. 4096 (default: 0, every block, like process -a)')
+@click.option('--confidence', default=DEFAULT_DETECT_CONFIDENCE, type=click.FloatRange(0, 1),
+              help='Stop sampling once the detected size is this likely to match testing every block')
+@click.option('--seed', default=0, type=int, help='Seed for block sampling')
+@click.option('--jobs', '-j', default=1, type=click.IntRange(min=0), help='Number of worker processes for a directory input (0 for one per CPU)')
+@click.option('--format', 'output_format', type=click.Choice(DETECT_FORMAT_CHOICES), default='table',
+              help='Report as a table, or every result with its score curve as JSON or CSV')
+@click.option('--output', '-o', type=click.Path(path_type=Path), help='Write the JSON or CSV report to a file instead of the console')
+def detect_pixel_size(input_path: Path, max_size: int, tolerance: int, samples: int, confidence: float, seed: int,
+                      jobs: int, output_format: str, output: Optional[Path]):
     """Detect the optimal pixel size for an image
     
-    INPUT_PATH: Path to the image file
+    INPUT_PATH: Path to the image file, or a directory of images
     """
     try:
-        from palette_swap import detect_pixel_size as detect_func
-        from PIL import Image
+        import json
+        from contextlib import nullcontext
+        from detect import detect_files, open_csv, write_csv_row
         
-        # Load image
-        img = Image.open(input_path).convert('RGB')
-        detected_size = detect_func(img)
+        paths = _image_files(input_path) if input_path.is_dir() else [input_path]
+        if not paths:
+            console.print("[yellow]Warning:[/yellow] No image files found in directory")
+            return
+        options = dict(max_size=max_size, tolerance=tolerance, samples=samples, confidence=confidence, seed=seed)
+        results = detect_files(paths, jobs, **options)
         
-        console.print(f"\n[bold]Pixel Size Detection[/bold] for {input_path.name}")
-        console.print(f"Detected pixel size: [green]{detected_size}x{detected_size}[/green]")
+        if output_format != 'table':
+            with (open(output, 'w', newline='') if output else nullcontext(sys.stdout)) as stream:
+                if output_format == 'csv':
+                    # Rows are written as results arrive, so large directories are not held in memory
+                    writer = open_csv(stream, max_size)
+                    failed = 0
+                    for result in results:
+                        write_csv_row(writer, result, max_size)
+                        failed += result['error'] is not None
+                else:
+                    report = list(results)
+                    json.dump(report, stream, indent=2)
+                    stream.write('\n')
+                    failed = sum(result['error'] is not None for result in report)
+            if output:
+                console.print(f"[green]✓[/green] Report of {len(paths)} image(s) saved to: {output}")
+            if failed:
+                console.print(f"[red]Error:[/red] {failed} image(s) failed")
+                sys.exit(1)
+            return
         
-        if detected_size > 1:
-            console.print(f"Recommended width resolution: [cyan]{img.width // detected_size}[/cyan]")
-        else:
-            console.print("[yellow]No clear pixel pattern detected - image may not be pixelated[/yellow]")
+        if not input_path.is_dir():
+            result = next(results)
+            if result['error']:
+                raise ValueError(result['error'])
+            detected_size = result['pixel_size']
+            console.print(f"\n[bold]Pixel Size Detection[/bold] for {input_path.name}")
+            console.print(f"Detected pixel size: [green]{detected_size}x{detected_size}[/green] (confidence {result['confidence']:.1%})")
+            
+            if detected_size > 1:
+                console.print(f"Recommended width resolution: [cyan]{result['width'] // detected_size}[/cyan]")
+            else:
+                console.print("[yellow]No clear pixel pattern detected - image may not be pixelated[/yellow]")
+            curve = "  ".join(f"{size}: {score:.2f}" for size, score in result['scores'].items())
+            if curve:
+                console.print(f"Block uniformity by size: {curve}")
+            return
+        
+        from rich.progress import Progress, SpinnerColumn, TextColumn
+        from rich.table import Table
+        # Images and lowest confidence by detected pixel size
+        counts: Dict[int, int] = {}
+        lowest: Dict[int, float] = {}
+        failed = 0
+        with Progress(SpinnerColumn(), TextColumn("[progress.description]{task.description}"), console=console.get()) as progress:
+            task = progress.add_task("Detecting pixel sizes...", total=len(paths))
+            for result in results:
+                if result['error']:
+                    failed += 1
+                    console.print(f"[red]Failed:[/red] {result['path']}: {result['error']}")
+                else:
+                    size = result['pixel_size']
+                    counts[size] = counts.get(size, 0) + 1
+                    lowest[size] = min(lowest.get(size, 1.0), result['confidence'])
+                progress.advance(task)
+        
+        table = Table(title=f"Detected Pixel Sizes ({len(paths)} images)")
+        table.add_column("Pixel Size", style="cyan", justify="right")
+        table.add_column("Images", justify="right")
+        table.add_column("Lowest Confidence", justify="right")
+        for size in sorted(counts):
+            table.add_row(f"{size}x{size}", str(counts[size]), f"{lowest[size]:.1%}")
+        console.print(table)
+        console.print("Use --format json or csv for the score curve of every image")
+        if failed:
+            console.print(f"[red]Error:[/red] {failed} image(s) failed")
+            sys.exit(1)
     
     except Exception as e:
         console.print(f"[red]Error:[/red] {str(e)}")
@@ -245,27 +529,58 @@ def detect_pixel_size(input_path: Path):
 
 @cli.command()
 @click.argument('input_path', type=click.Path(exists=True, path_type=Path))
-@click.option('--colors', '-c', default=16, help='Number of colors to extract')
+@click.option('--colors', '-c', default=16, type=click.IntRange(min=1, max=256), help='Number of colors to extract')
 @click.option('--output', '-o', type=click.Path(path_type=Path), help='Save extracted palette as image')
-def extract_palette(input_path: Path, colors: int, output: Optional[Path]):
+@click.option('--method', type=click.Choice(EXTRACT_CHOICES), default='kmeans', help='Clustering method (pillow uses Pillow\'s quantizer)')
+@click.option('--space', type=click.Choice(COLOR_SPACE_CHOICES), default='rgb', help='Color space to cluster in')
+@click.option('--seed', default=0, type=int, help='Seed for pixel sampling and mini-batch k-means')
+@click.option('--max-pixels', default=DEFAULT_EXTRACT_PIXELS, type=click.IntRange(min=0), help='Pixels sampled per image before clustering (0 for all)')
+@click.option('--yaml', 'yaml_path', type=click.Path(path_type=Path), help='Save as a palette YAML file, or into this directory for a directory input')
+@click.option('--name', help='Palette name in the YAML file, lowercased like built-in names (default: image name)')
+@click.option('--jobs', '-j', default=1, type=click.IntRange(min=0), help='Number of worker processes for a directory input (0 for one per CPU)')
+def extract_palette(input_path: Path, colors: int, output: Optional[Path], method: str, space: str, seed: int,
+                    max_pixels: int, yaml_path: Optional[Path], name: Optional[str], jobs: int):
     """Extract color palette from an image
     
-    INPUT_PATH: Path to the image file
+    INPUT_PATH: Path to the image file, or a directory of images to extract
+    a palette YAML file from each (with --yaml DIRECTORY)
     """
     try:
         from PIL import Image
+        from rich.progress import Progress, SpinnerColumn, TextColumn
+        from extract import extract_directory, normalize_palette_name, output_paths, palette_name, save_palette_yaml
+        from extract import extract_palette as extract_palette_colors
         
-        # Load and process image
-        img = Image.open(input_path).convert('RGB')
-        quantized = img.quantize(colors=colors)
-        palette_colors = quantized.getpalette()
+        if input_path.is_dir():
+            if not yaml_path:
+                console.print("[red]Error:[/red] A directory input needs --yaml with an output directory")
+                sys.exit(1)
+            image_files = _image_files(input_path)
+            if not image_files:
+                console.print("[yellow]Warning:[/yellow] No image files found in directory")
+                return
+            failed = 0
+            written = 0
+            with Progress(SpinnerColumn(), TextColumn("[progress.description]{task.description}"), console=console.get()) as progress:
+                task = progress.add_task("Extracting palettes...", total=len(image_files))
+                for img_file, error, palette_path in extract_directory(image_files, yaml_path, colors, method, space, seed, max_pixels or None, jobs):
+                    if error:
+                        failed += 1
+                        console.print(f"[red]Failed:[/red] {img_file.name}: {error}")
+                    else:
+                        written += 1
+                        if palette_path.stem != palette_name(img_file):
+                            console.print(f"[yellow]Renamed:[/yellow] {img_file} saved as {palette_path.name}, its name is already taken")
+                    progress.advance(task)
+            console.print(f"[green]✓[/green] Extracted {written} palettes to: {yaml_path}")
+            if failed:
+                console.print(f"[red]Error:[/red] {failed} image(s) failed")
+                sys.exit(1)
+            return
         
-        # Convert palette to RGB tuples
-        rgb_colors = []
-        if palette_colors:
-            for i in range(0, len(palette_colors), 3):
-                if i + 2 < len(palette_colors):
-                    rgb_colors.append((palette_colors[i], palette_colors[i+1], palette_colors[i+2]))
+        # Load and process image
+        with Image.open(input_path) as img:
+            rgb_colors = extract_palette_colors(img, colors, method, space, seed, max_pixels or None)
         
         console.print(f"\n[bold]Extracted Palette[/bold] from {input_path.name}")
         console.print(f"Colors: {len(rgb_colors)}\n")
@@ -287,10 +602,166 @@ def extract_palette(input_path: Path, colors: int, output: Optional[Path]):
             large_palette = palette_img.resize((len(rgb_colors) * 32, 32), Image.Resampling.NEAREST)
             large_palette.save(output)
             console.print(f"\n[green]✓[/green] Palette saved to: {output}")
+        
+        if yaml_path:
+            if yaml_path.is_dir():
+                # The file is named after the palette, unless that name is taken
+                requested = normalize_palette_name(name) if name else palette_name(input_path)
+                yaml_path = output_paths([input_path], yaml_path, {input_path: requested})[input_path]
+                if yaml_path.stem != requested:
+                    console.print(f"[yellow]Renamed:[/yellow] palette '{requested}' saved as {yaml_path.stem}, its name is already taken")
+                name = yaml_path.stem
+            save_palette_yaml(yaml_path, normalize_palette_name(name or yaml_path.stem), rgb_colors, source=input_path.name)
+            console.print(f"[green]✓[/green] Palette file saved to: {yaml_path}")
     
     except Exception as e:
         console.print(f"[red]Error:[/red] {str(e)}")
         sys.exit(1)
 
+@cli.command()
+@click.argument('input_path', type=click.Path(exists=True, path_type=Path))
+@click.argument('output_path', type=click.Path(path_type=Path))
+@click.option('--palette', '-p', multiple=True, help='Palette name or path to palette image (default: all built-in palettes)')
+@click.option('--width', '-w', default=256, help='Target width resolution for downscaling')
+@click.option('--auto-detect-pixel-size', '-a', is_flag=True, help='Automatically detect optimal pixel size from source image')
+@click.option('--downscale', type=click.Choice(DOWNSCALE_CHOICES), default='nearest',
+              help='Downscaling: nearest sampling, or the mean, median, mode (majority) or edge-preserving color of each block')
+@click.option('--quantizer', '-q', type=click.Choice(['pillow', 'lut', 'numpy']), default='pillow',
+              help='Palette mapping engine: pillow, lut (cached lookup table) or numpy (direct search)')
+@click.option('--metric', '-m', type=click.Choice(['rgb', 'redmean', 'cielab', 'oklab']), default='rgb',
+              help='Color distance used by the lut and numpy quantizers')
+@click.option('--lut-bits', type=click.Choice(['5', '6', '8']), default='6', help='Bits per channel of the palette lookup table (8 is exact)')
+@click.option('--downscaled', is_flag=True, help='Use the downscaled variants instead of upscaling them back to the original size')
+@click.option('--columns', type=click.IntRange(min=1), help='Variants per row of the contact sheet (default: square grid)')
+@click.option('--padding', default=0, type=click.IntRange(min=0), help='Pixels between contact sheet cells')
+@click.option('--pages', is_flag=True, help='Save the variants as the pages of OUTPUT_PATH (.tiff, .gif, .webp or .pdf) instead of a contact sheet')
+@click.option('--split', type=click.Path(file_okay=False, path_type=Path), help='Also save every variant as its own file in this directory')
+def atlas(input_path: Path, output_path: Path, palette: Tuple[str], width: int, auto_detect_pixel_size: bool, downscale: str,
+          quantizer: str, metric: str, lut_bits: str, downscaled: bool, columns: Optional[int], padding: int,
+          pages: bool, split: Optional[Path]):
+    """Render an image in many palettes at once
+    
+    INPUT_PATH: Path to the image file
+    OUTPUT_PATH: Contact sheet, or multi-page file with --pages
+    
+    Undithered palette mapping is done for all palettes in one pass over the
+    image's distinct colors with the lut and numpy quantizers.
+    """
+    try:
+        from PIL import Image
+        from atlas import contact_sheet, save_pages
+        from palette_swap import permutation_path, process_image
+        from palettes import PaletteCollection
+        from quantize import PaletteMapper
+        
+        palette_collection = PaletteCollection()
+        palette_images = _load_palettes(palette_collection, palette or palette_collection.list_palettes())
+        mapper = PaletteMapper(quantizer, metric, int(lut_bits))
+        with Image.open(input_path) as image:
+            results = list(process_image(image, width, [Image.Dither.NONE], palettes=palette_images, auto_detect_pixel_size=auto_detect_pixel_size, mapper=mapper, downscale=downscale))
+        variants = []
+        for params, variant in results:
+            if not downscaled:
+                variant = variant.resize(params['size'], Image.Resampling.NEAREST)
+            variants.append(variant)
+            if split:
+                split.mkdir(parents=True, exist_ok=True)
+                variant.save(permutation_path(split / f"{input_path.stem}.png", params['name']))
+        
+        if pages:
+            save_pages(variants, output_path)
+        else:
+            contact_sheet(variants, columns, padding).save(output_path)
+        console.print(f"[green]✓[/green] {len(variants)} palette variants saved to: {output_path}")
+    
+    except Exception as e:
+        console.print(f"[red]Error:[/red] {str(e)}")
+        sys.exit(1)
+
+@cli.command()
+@click.option('--host', default='127.0.0.1', help='Address to listen on')
+@click.option('--port', default=8765, type=click.IntRange(min=0, max=65535), help='Port to listen on (0 picks a free one)')
+@click.option('--socket', 'socket_path', type=click.Path(path_type=Path), help='Listen on a Unix socket instead of TCP')
+@click.option('--jobs', '-j', default=1, type=click.IntRange(min=0), help='Number of worker processes (0 for one per CPU)')
+@click.option('--queue-size', default=64, type=click.IntRange(min=1), help='Requests waiting for a worker before new ones are refused with 503')
+@click.option('--max-body', default=64, type=click.IntRange(min=1), help='Largest accepted image in MB')
+@click.option('--max-memory', type=click.IntRange(min=1), help='Memory budget in MB for nearest-color distance matrices')
+def serve(host: str, port: int, socket_path: Optional[Path], jobs: int, queue_size: int, max_body: int, max_memory: Optional[int]):
+    """Serve the processing pipeline over HTTP
+    
+    POST an image to /process with options in the query string, e.g.
+    /process?width=128&palette=nes&dither=bayer, to get the processed image
+    back. GET /metrics reports queue depth and latencies.
+    """
+    import asyncio
+    from quantize import DEFAULT_MEMORY_BUDGET
+    from server import serve as run_server
+    
+    def ready(address):
+        where = address if socket_path else f"http://{address[0]}:{address[1]}"
+        console.print(f"[green]✓[/green] Serving on {where} with {jobs or 'one per CPU'} worker(s), press Ctrl+C to stop")
+    
+    try:
+        asyncio.run(run_server(
+            host, port, socket_path, jobs, queue_size, max_body * 1024 * 1024,
+            max_memory * 1024 * 1024 if max_memory else DEFAULT_MEMORY_BUDGET, ready
+        ))
+    except KeyboardInterrupt:
+        console.print("Server stopped")
+    except OSError as e:
+        console.print(f"[red]Error:[/red] {str(e)}")
+        sys.exit(1)
+
+@cli.command()
+@click.option('--size', '-s', 'sizes', multiple=True, type=click.IntRange(min=8), default=[512, 1024], help='Square image size to benchmark (can be used multiple times)')
+@click.option('--kind', '-k', 'kinds', multiple=True, type=click.Choice(['photo', 'pixelart']), default=['photo', 'pixelart'], help='Synthetic image kind (can be used multiple times)')
+@click.option('--palette-size', '-p', 'palette_sizes', multiple=True, type=click.IntRange(min=2, max=256), default=[16], help='Palette size (can be used multiple times)')
+@click.option('--quantizer', '-q', type=click.Choice(['pillow', 'lut', 'numpy']), default='pillow', help='Palette mapping engine')
+@click.option('--pixel-size', default=4, type=click.IntRange(min=1), help='Block size of the synthetic pixel art and downscale factor')
+@click.option('--repeat', '-r', default=3, type=click.IntRange(min=1), help='Timed runs per stage, the best one is reported')
+@click.option('--save-baseline', type=click.Path(path_type=Path), help='Store the results as a JSON baseline')
+@click.option('--compare', type=click.Path(exists=True, path_type=Path), help='Compare the results with a JSON baseline')
+@click.option('--threshold', default=0.1, type=float, help='Slowdown fraction reported as a regression by --compare')
+def bench(sizes: Tuple[int], kinds: Tuple[str], palette_sizes: Tuple[int], quantizer: str, pixel_size: int,
+          repeat: int, save_baseline: Optional[Path], compare: Optional[Path], threshold: float):
+    """Benchmark every pipeline stage on synthetic images
+    
+    Reports the throughput of each stage in source megapixels per second and
+    the peak memory of each case, to size hardware and catch regressions.
+    """
+    from rich.table import Table
+    from bench import STAGES, bench_pipeline, compare_baseline, save_baseline as store_baseline
+    
+    with console.status("Running benchmarks..."):
+        results = bench_pipeline(list(kinds), list(sizes), list(palette_sizes), quantizer, pixel_size, repeat)
+    
+    table = Table(title=f"Pipeline throughput (MP/s, {quantizer} quantizer)")
+    table.add_column("Case", style="cyan", no_wrap=True)
+    for stage in STAGES:
+        table.add_column(stage, justify="right")
+    table.add_column("Total ms", justify="right", style="magenta")
+    table.add_column("Peak RSS", justify="right")
+    for result in results:
+        table.add_row(
+            result['name'],
+            *(f"{result['stages'][stage]['mp_per_s']:.1f}" for stage in STAGES),
+            f"{result['total_seconds'] * 1000:.1f}",
+            f"{result['peak_rss_mb']:.0f} MB" if result['peak_rss_mb'] is not None else "-"
+        )
+    console.print(table)
+    
+    if save_baseline:
+        store_baseline(save_baseline, results)
+        console.print(f"[green]✓[/green] Baseline saved to: {save_baseline}")
+    if compare:
+        rows = compare_baseline(compare, results, threshold)
+        regressions = [row for row in rows if row['regression']]
+        for row in regressions:
+            console.print(f"[red]Regression:[/red] {row['name']} {row['stage']}: {row['baseline_seconds'] * 1000:.2f} ms -> {row['seconds'] * 1000:.2f} ms ({row['ratio']:.2f}x)")
+        if regressions:
+            console.print(f"[red]Error:[/red] {len(regressions)} regression(s) in {len(rows)} compared stages")
+            sys.exit(1)
+        console.print(f"[green]✓[/green] No regressions in {len(rows)} compared stages")
+
 if __name__ == '__main__':
     cli()
\ No newline at end of file
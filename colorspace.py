@@ -0,0 +1,66 @@
+"""
+Vectorized conversions from 8-bit sRGB to perceptual color spaces
+"""
+
+import numpy as np
+
+# sRGB (D65) to CIE XYZ
+_RGB_TO_XYZ = np.array([
+    [0.4124564, 0.3575761, 0.1804375],
+    [0.2126729, 0.7151522, 0.0721750],
+    [0.0193339, 0.1191920, 0.9503041],
+], dtype=np.float32)
+_D65_WHITE = np.array([0.95047, 1.0, 1.08883], dtype=np.float32)
+
+# Linear sRGB to LMS and LMS' to OKLab (Björn Ottosson, 2020)
+_RGB_TO_LMS = np.array([
+    [0.4122214708, 0.5363325363, 0.0514459929],
+    [0.2119034982, 0.6806995451, 0.1073969566],
+    [0.0883024619, 0.2817188376, 0.6299787005],
+], dtype=np.float32)
+_LMS_TO_OKLAB = np.array([
+    [0.2104542553, 0.7936177850, -0.0040720468],
+    [1.9779984951, -2.4285922050, 0.4505937099],
+    [0.0259040371, 0.7827717662, -0.8086757660],
+], dtype=np.float32)
+
+def _srgb_to_linear_table() -> np.ndarray:
+    values = np.arange(256, dtype=np.float64) / 255
+    linear = np.where(values <= 0.04045, values / 12.92, ((values + 0.055) / 1.055) ** 2.4)
+    return linear.astype(np.float32)
+
+# Every 8-bit channel value maps through a 256-entry table instead of a power per pixel
+_SRGB_TO_LINEAR = _srgb_to_linear_table()
+
+COLOR_SPACES = ('rgb', 'cielab', 'oklab')
+
+def srgb_to_linear(pixels: np.ndarray) -> np.ndarray:
+    """Linear-light float32 values for an (..., 3) uint8 sRGB array"""
+    return _SRGB_TO_LINEAR[pixels]
+
+def rgb_to_cielab(pixels: np.ndarray) -> np.ndarray:
+    """CIELAB (D65) float32 coordinates for an (..., 3) uint8 sRGB array"""
+    xyz = srgb_to_linear(pixels) @ _RGB_TO_XYZ.T
+    xyz /= _D65_WHITE
+    delta = 6 / 29
+    f = np.where(xyz > delta ** 3, np.cbrt(xyz), xyz / (3 * delta ** 2) + 4 / 29)
+    lab = np.empty_like(f)
+    lab[..., 0] = 116 * f[..., 1] - 16
+    lab[..., 1] = 500 * (f[..., 0] - f[..., 1])
+    lab[..., 2] = 200 * (f[..., 1] - f[..., 2])
+    return lab
+
+def rgb_to_oklab(pixels: np.ndarray) -> np.ndarray:
+    """OKLab float32 coordinates for an (..., 3) uint8 sRGB array"""
+    lms = srgb_to_linear(pixels) @ _RGB_TO_LMS.T
+    return np.cbrt(lms) @ _LMS_TO_OKLAB.T
+
+def convert_colors(pixels: np.ndarray, space: str) -> np.ndarray:
+    """Float32 coordinates of an (..., 3) uint8 sRGB array in the given color space"""
+    if space == 'rgb':
+        return pixels.astype(np.float32)
+    if space == 'cielab':
+        return rgb_to_cielab(pixels)
+    if space == 'oklab':
+        return rgb_to_oklab(pixels)
+    raise ValueError(f"Unknown color space '{space}', expected one of {', '.join(COLOR_SPACES)}")
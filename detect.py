@@ -0,0 +1,166 @@
+"""
+Sampled pixel size detection with score curves and confidence, for single images and whole directories
+"""
+
+import csv
+import math
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, TextIO
+
+from palette_swap import PIXEL_SIZE_BONUS, PIXEL_SIZE_THRESHOLD, _calculate_block_uniformity, best_pixel_size, choose_pixel_size, pixel_size_candidates
+
+# Blocks drawn per size between two confidence checks
+SAMPLE_ROUND = 256
+DEFAULT_SAMPLES = 4096
+DEFAULT_CONFIDENCE = 0.95
+DETECT_FORMATS = ('table', 'json', 'csv')
+
+def _sampled_uniformity(pixels: np.ndarray, size: int, rows: np.ndarray, cols: np.ndarray, tolerance: int) -> np.ndarray:
+    """Whether each sampled block (row, col) of the size grid is uniform, as _calculate_block_uniformity decides"""
+    offsets = np.arange(size)
+    ys = (rows[:, None] * size + offsets)[:, :, None]
+    xs = (cols[:, None] * size + offsets)[:, None, :]
+    blocks = pixels[ys, xs].astype(np.int16)
+    # Every pixel within tolerance of the block's first pixel, in every channel
+    return (np.abs(blocks - blocks[:, :1, :1]) <= tolerance).reshape(len(blocks), -1).all(axis=1)
+
+def _probability_above(margin: float, error: float) -> float:
+    """Probability that a normally distributed estimate of margin with this standard error is not negative; exact margins have no error"""
+    if error == 0:
+        return 1.0 if margin >= 0 else 0.0
+    return 0.5 * (1 + math.erf(margin / error / math.sqrt(2)))
+
+def decision_confidence(scores: Dict[int, float], errors: Dict[int, float]) -> float:
+    """
+    Estimated probability that exact scores would give the same pixel size as these estimates.
+
+    The best size by adjusted score (see best_pixel_size) must stay on the
+    same side of PIXEL_SIZE_THRESHOLD, which decides between it and 1, and
+    keep the best adjusted score against every other size; the confidence
+    is the least likely of these comparisons, each under a normal
+    approximation with the given standard errors. Covariances between sizes
+    are ignored, which errs on the low side as sizes are sampled at the same
+    positions. Exact scores (all errors 0) are certain.
+    """
+    if all(error == 0 for error in errors.values()):
+        return 1.0
+    best_size = best_pixel_size(scores)
+    threshold_margin = scores[best_size] - PIXEL_SIZE_THRESHOLD
+    if choose_pixel_size(scores) == 1:
+        # The best size has to stay at or under the threshold
+        threshold_margin = -threshold_margin
+    best_adjusted = scores[best_size] + best_size * PIXEL_SIZE_BONUS
+    probabilities = [_probability_above(threshold_margin, errors[best_size])]
+    for size in scores:
+        if size != best_size:
+            margin = best_adjusted - (scores[size] + size * PIXEL_SIZE_BONUS)
+            probabilities.append(_probability_above(margin, math.hypot(errors[best_size], errors[size])))
+    return min(probabilities)
+
+def detect_pixel_size_sampled(image: Image.Image, max_size: int = 16, tolerance: int = 5, samples: int = DEFAULT_SAMPLES, confidence: float = DEFAULT_CONFIDENCE, seed: int = 0) -> Dict[str, Any]:
+    """
+    Pixel size of an image estimated from randomly drawn blocks, with its score curve and confidence.
+
+    Scores estimate those of palette_swap.detect_pixel_size, the fraction of
+    uniform blocks of every candidate size. Blocks are drawn in rounds of
+    SAMPLE_ROUND per size, at the same relative positions for every size,
+    until decision_confidence reaches confidence or samples blocks were
+    drawn per size; sizes with at most samples blocks are scored exactly.
+    samples=0 scores every block, giving detect_pixel_size's result.
+
+    Returns a dict with the image width and height, pixel_size, confidence,
+    scores (estimated score by size), samples (blocks drawn per sampled
+    size) and exhaustive (whether every score is exact).
+    """
+    pixels = np.asarray(image.convert('RGB'))
+    height, width, _ = pixels.shape
+    sizes = pixel_size_candidates(width, height, max_size)
+    scores: Dict[int, float] = {}
+    errors: Dict[int, float] = {}
+    for size in sizes:
+        if not samples or (height // size) * (width // size) <= samples:
+            scores[size] = _calculate_block_uniformity(pixels, size, tolerance)
+            errors[size] = 0.0
+    sampled = [size for size in sizes if size not in scores]
+    uniform = dict.fromkeys(sampled, 0)
+    rng = np.random.default_rng(seed)
+    drawn = 0
+    while True:
+        if sampled:
+            count = min(SAMPLE_ROUND, samples - drawn)
+            row_positions, col_positions = rng.random(count), rng.random(count)
+            for size in sampled:
+                rows = (row_positions * (height // size)).astype(np.intp)
+                cols = (col_positions * (width // size)).astype(np.intp)
+                uniform[size] += int(_sampled_uniformity(pixels, size, rows, cols, tolerance).sum())
+            drawn += count
+            for size in sampled:
+                scores[size] = uniform[size] / drawn
+                # Standard error of the proportion, shrunk towards 1/2 so all-uniform samples are not certain
+                shrunk = (uniform[size] + 2) / (drawn + 4)
+                errors[size] = math.sqrt(shrunk * (1 - shrunk) / (drawn + 4))
+        certainty = decision_confidence(scores, errors)
+        if not sampled or drawn >= samples or certainty >= confidence:
+            break
+    return {
+        'width': width,
+        'height': height,
+        'pixel_size': choose_pixel_size(scores),
+        'confidence': certainty,
+        'scores': {size: scores[size] for size in sorted(scores)},
+        'samples': drawn,
+        'exhaustive': not sampled,
+    }
+
+def detect_file(path: Path, max_size: int = 16, tolerance: int = 5, samples: int = DEFAULT_SAMPLES, confidence: float = DEFAULT_CONFIDENCE, seed: int = 0) -> Dict[str, Any]:
+    """detect_pixel_size_sampled of the first frame of an image file, with its path and error (None when it succeeded)"""
+    try:
+        with Image.open(path) as image:
+            result = detect_pixel_size_sampled(image, max_size, tolerance, samples, confidence, seed)
+    except Exception as e:
+        return {'path': str(path), 'error': str(e)}
+    return {'path': str(path), 'error': None, **result}
+
+def _detect_file_options(args: tuple) -> Dict[str, Any]:
+    path, options = args
+    return detect_file(path, **options)
+
+def detect_files(paths: List[Path], jobs: int = 1, **options: Any) -> Iterator[Dict[str, Any]]:
+    """
+    Run detect_file on every path, in order, with jobs worker processes (0 for one per CPU).
+
+    Paths are sent to the workers in chunks, since each detection is short.
+    A file that cannot be read yields a result with its error instead of
+    stopping the batch. options are the detect_file arguments.
+    """
+    jobs = jobs or os.cpu_count() or 1
+    if jobs == 1 or len(paths) <= 1:
+        for path in paths:
+            yield detect_file(path, **options)
+        return
+    chunksize = max(1, min(64, len(paths) // (jobs * 4)))
+    with ProcessPoolExecutor(max_workers=min(jobs, len(paths))) as executor:
+        yield from executor.map(_detect_file_options, [(path, options) for path in paths], chunksize=chunksize)
+
+def csv_columns(max_size: int = 16) -> List[str]:
+    """CSV header of detection results, with one score column per candidate size"""
+    return ['path', 'width', 'height', 'pixel_size', 'confidence', 'samples', 'exhaustive'] + [f"score_{size}" for size in range(2, max_size + 1)] + ['error']
+
+def write_csv_row(writer: Any, result: Dict[str, Any], max_size: int = 16):
+    """Write one detection result to a csv.writer, in csv_columns order; sizes not tested are left empty"""
+    scores = result.get('scores', {})
+    row = [result['path']] + [result.get(name, '') for name in ('width', 'height', 'pixel_size')]
+    row.append(f"{result['confidence']:.4f}" if 'confidence' in result else '')
+    row += [result.get('samples', ''), result.get('exhaustive', '')]
+    row += [f"{scores[size]:.4f}" if size in scores else '' for size in range(2, max_size + 1)]
+    writer.writerow(row + [result['error'] or ''])
+
+def open_csv(output: TextIO, max_size: int = 16) -> Any:
+    """csv.writer on output with the csv_columns header already written"""
+    writer = csv.writer(output)
+    writer.writerow(csv_columns(max_size))
+    return writer
@@ -0,0 +1,119 @@
+"""
+Ordered and error-diffusion dithering against an arbitrary palette
+"""
+
+import enum
+import numpy as np
+from PIL import Image
+from typing import Dict, List, Sequence, Tuple
+
+from quantize import DEFAULT_MEMORY_BUDGET, indices_to_image, nearest_palette_indices, palette_array
+
+class DitherMethod(enum.Enum):
+    """Dithering methods implemented with NumPy, named like Image.Dither for output names"""
+    FLOYDSTEINBERG = 'floyd'
+    BAYER = 'bayer'
+    ATKINSON = 'atkinson'
+    SIERRA = 'sierra'
+    JARVIS = 'jarvis'
+
+# (row offset, column offset, weight) taps and divisor of each error-diffusion kernel
+ERROR_KERNELS: Dict[DitherMethod, Tuple[List[Tuple[int, int, int]], int]] = {
+    DitherMethod.FLOYDSTEINBERG: ([(0, 1, 7), (1, -1, 3), (1, 0, 5), (1, 1, 1)], 16),
+    DitherMethod.ATKINSON: ([(0, 1, 1), (0, 2, 1), (1, -1, 1), (1, 0, 1), (1, 1, 1), (2, 0, 1)], 8),
+    DitherMethod.SIERRA: ([
+        (0, 1, 5), (0, 2, 3),
+        (1, -2, 2), (1, -1, 4), (1, 0, 5), (1, 1, 4), (1, 2, 2),
+        (2, -1, 2), (2, 0, 3), (2, 1, 2),
+    ], 32),
+    DitherMethod.JARVIS: ([
+        (0, 1, 7), (0, 2, 5),
+        (1, -2, 3), (1, -1, 5), (1, 0, 7), (1, 1, 5), (1, 2, 3),
+        (2, -2, 1), (2, -1, 3), (2, 0, 5), (2, 1, 3), (2, 2, 1),
+    ], 48),
+}
+
+def bayer_matrix(size: int) -> np.ndarray:
+    """Bayer threshold matrix of the given power-of-two size, with values 0..size**2-1"""
+    if size < 2 or size & (size - 1):
+        raise ValueError(f"Bayer matrix size must be a power of two >= 2, got {size}")
+    matrix = np.zeros((1, 1), dtype=np.int32)
+    while len(matrix) < size:
+        matrix = np.block([[4 * matrix, 4 * matrix + 2], [4 * matrix + 3, 4 * matrix + 1]])
+    return matrix
+
+def palette_spread(palette: np.ndarray) -> float:
+    """Median RGB distance from each palette color to its nearest other color"""
+    colors = np.unique(palette, axis=0).astype(np.float32)
+    if len(colors) < 2:
+        return 0.0
+    distances = np.sqrt(((colors[:, None, :] - colors[None, :, :]) ** 2).sum(axis=-1))
+    np.fill_diagonal(distances, np.inf)
+    return float(np.median(distances.min(axis=1)))
+
+def ordered_dither(pixels: np.ndarray, palette: np.ndarray, metric: str = 'rgb', size: int = 4, origin: Tuple[int, int] = (0, 0), memory_budget: int = DEFAULT_MEMORY_BUDGET) -> np.ndarray:
+    """
+    Palette indices of an (H, W, 3) uint8 image with Bayer ordered dithering.
+
+    Every pixel only depends on its own value and position, so an image can be
+    split into tiles processed independently; pass each tile's top-left
+    (x, y) position as origin to keep the threshold pattern continuous.
+    """
+    height, width, _ = pixels.shape
+    matrix = bayer_matrix(size)
+    thresholds = ((matrix + 0.5) / matrix.size - 0.5) * palette_spread(palette)
+    rows = (np.arange(height) + origin[1]) % size
+    cols = (np.arange(width) + origin[0]) % size
+    offsets = thresholds[rows[:, None], cols[None, :]].astype(np.float32)
+    values = pixels + offsets[..., None]
+    values = np.clip(np.rint(values), 0, 255).astype(np.uint8)
+    return nearest_palette_indices(values, palette, metric, memory_budget).reshape(height, width)
+
+def error_diffusion_dither(pixels: np.ndarray, palette: np.ndarray, method: DitherMethod = DitherMethod.FLOYDSTEINBERG, metric: str = 'rgb') -> np.ndarray:
+    """
+    Palette indices of an (H, W, 3) uint8 image with error-diffusion dithering.
+
+    Pixels are visited in raster order, but instead of looping per pixel the
+    image is swept along skewed anti-diagonals x + skew * y = t: the skew is
+    chosen so every tap of the kernel lands on a later diagonal, which makes
+    all pixels of one diagonal independent and lets them be quantized and
+    spread as a single vectorized step.
+    """
+    taps, divisor = ERROR_KERNELS[method]
+    height, width, _ = pixels.shape
+    skew = max(-dx // dy + 1 for dy, dx, _ in taps if dy > 0)
+    reach = max(abs(dx) for _, dx, _ in taps)
+    depth = max(dy for dy, _, _ in taps)
+
+    # Pad so taps near the borders fall into scratch cells instead of wrapping
+    buffer = np.zeros((height + depth, width + 2 * reach, 3), dtype=np.float32)
+    buffer[:height, reach:reach + width] = pixels
+    palette_f = palette.astype(np.float32)
+    weights = [(dy, dx + reach, weight / divisor) for dy, dx, weight in taps]
+    indices = np.empty((height, width), dtype=np.uint8)
+    all_rows = np.arange(height)
+
+    for diagonal in range(width + skew * (height - 1)):
+        first_row = max(0, -(-(diagonal - width + 1) // skew))
+        last_row = min(height - 1, diagonal // skew)
+        rows = all_rows[first_row:last_row + 1]
+        cols = diagonal - skew * rows
+
+        values = np.clip(buffer[rows, cols + reach], 0, 255)
+        chosen = nearest_palette_indices(np.rint(values).astype(np.uint8), palette, metric)
+        indices[rows, cols] = chosen
+        error = values - palette_f[chosen]
+        # Targets of one tap are distinct, so plain fancy-index updates are safe
+        for dy, dx, weight in weights:
+            buffer[rows + dy, cols + dx] += error * weight
+    return indices
+
+def dither_image(image: Image.Image, colors: Sequence[Tuple[int, int, int]], method: DitherMethod, metric: str = 'rgb', memory_budget: int = DEFAULT_MEMORY_BUDGET, origin: Tuple[int, int] = (0, 0)) -> Image.Image:
+    """Dither an image to the palette colors, returning a 'P' image; origin only affects ordered dithering"""
+    palette = palette_array(colors)
+    pixels = np.asarray(image.convert('RGB'))
+    if method == DitherMethod.BAYER:
+        indices = ordered_dither(pixels, palette, metric, origin=origin, memory_budget=memory_budget)
+    else:
+        indices = error_diffusion_dither(pixels, palette, method, metric)
+    return indices_to_image(indices, palette)
@@ -0,0 +1,99 @@
+"""
+Downscaling by block reduction: mean, median, majority and edge-preserving colors per block
+"""
+
+import math
+import numpy as np
+from PIL import Image
+from typing import Optional, Tuple
+
+DOWNSCALE_METHODS = ('nearest', 'mean', 'median', 'mode', 'edge')
+
+def _blocks(pixels: np.ndarray, block: Tuple[int, int]) -> np.ndarray:
+    """(rows, cols, block_w * block_h, 3) view of the pixels of every block"""
+    block_width, block_height = block
+    rows, cols = pixels.shape[0] // block_height, pixels.shape[1] // block_width
+    cropped = pixels[:rows * block_height, :cols * block_width]
+    blocks = cropped.reshape(rows, block_height, cols, block_width, 3).transpose(0, 2, 1, 3, 4)
+    return blocks.reshape(rows, cols, block_width * block_height, 3)
+
+def _block_mode(blocks: np.ndarray) -> np.ndarray:
+    """
+    Most frequent color of every block, the smallest packed color among ties.
+
+    Colors are packed into 24-bit integers and sorted within each block;
+    the length of the run ending at every position comes from the position
+    of the last run start, so the longest run is found without a Python loop
+    over blocks.
+    """
+    packed = (blocks[..., 0].astype(np.uint32) << 16) | (blocks[..., 1].astype(np.uint32) << 8) | blocks[..., 2]
+    packed.sort(axis=-1)
+    positions = np.arange(packed.shape[-1])
+    starts = np.empty(packed.shape, dtype=bool)
+    starts[..., 0] = True
+    np.not_equal(packed[..., 1:], packed[..., :-1], out=starts[..., 1:])
+    run_starts = np.maximum.accumulate(np.where(starts, positions, 0), axis=-1)
+    run_ends = (positions - run_starts).argmax(axis=-1)
+    mode = np.take_along_axis(packed, run_ends[..., None], axis=-1)[..., 0]
+    return np.stack([mode >> 16, (mode >> 8) & 0xff, mode & 0xff], axis=-1).astype(np.uint8)
+
+def block_reduce(pixels: np.ndarray, block: Tuple[int, int], method: str = 'mean') -> np.ndarray:
+    """
+    Reduce every (block_w, block_h) block of an (H, W, 3) uint8 array to one pixel.
+
+    'mean' averages each channel and 'median' takes each channel's median,
+    which can both produce colors absent from the image. 'mode' takes the
+    most frequent color and 'edge' the block pixel nearest the per-channel
+    median; both only output colors of the block, and 'edge' follows the
+    majority side of an edge crossing the block instead of blending it.
+    Partial blocks at the right and bottom are dropped.
+    """
+    blocks = _blocks(pixels, block)
+    count = blocks.shape[2]
+    if method == 'mean':
+        sums = blocks.sum(axis=2, dtype=np.uint32)
+        return ((sums + count // 2) // count).astype(np.uint8)
+    if method == 'median':
+        return np.rint(np.median(blocks, axis=2)).astype(np.uint8)
+    if method == 'mode':
+        return _block_mode(blocks)
+    if method == 'edge':
+        median = np.rint(np.median(blocks, axis=2)).astype(np.int16)
+        distances = np.abs(blocks.astype(np.int16) - median[:, :, None, :]).sum(axis=-1)
+        nearest = distances.argmin(axis=2)
+        return np.take_along_axis(blocks, nearest[:, :, None, None], axis=2)[:, :, 0]
+    raise ValueError(f"Unknown block reduction '{method}', expected one of mean, median, mode, edge")
+
+def block_size(size: Tuple[int, int], scaled_size: Tuple[int, int]) -> Optional[Tuple[int, int]]:
+    """
+    Block of source pixels behind each pixel when scaled_size divides size,
+    ignoring a remainder smaller than one block; None for other ratios.
+    """
+    (width, height), (scaled_width, scaled_height) = size, scaled_size
+    block = (max(1, width // scaled_width), max(1, height // scaled_height))
+    if width // block[0] != scaled_width or height // block[1] != scaled_height:
+        return None
+    return block
+
+def downscale_image(image: Image.Image, size: Tuple[int, int], method: str = 'nearest') -> Image.Image:
+    """
+    Downscale an RGB image to size with one of DOWNSCALE_METHODS.
+
+    'nearest' is Pillow's NEAREST resize. The block methods reduce blocks
+    of source pixels directly when the size divides the image (ignoring a
+    remainder smaller than one block, as with a pixel size from
+    detect_pixel_size), so pixel art upscaled by an integer factor comes
+    back exactly. Other ratios first resample the image with NEAREST to the
+    next multiple of size.
+    """
+    if method not in DOWNSCALE_METHODS:
+        raise ValueError(f"Unknown downscale method '{method}', expected one of {', '.join(DOWNSCALE_METHODS)}")
+    width, height = size
+    if method == 'nearest' or (width, height) == image.size:
+        return image.resize(size, Image.Resampling.NEAREST)
+    block = block_size(image.size, size)
+    if block is None:
+        block = (math.ceil(image.width / width), math.ceil(image.height / height))
+        image = image.resize((width * block[0], height * block[1]), Image.Resampling.NEAREST)
+    pixels = np.asarray(image.convert('RGB'))
+    return Image.fromarray(block_reduce(pixels, block, method))
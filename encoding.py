@@ -0,0 +1,286 @@
+"""
+Output encoding helpers: streamed PNG writing, integer-scale indexed output, QOI and per-format save options
+"""
+
+import re
+import struct
+import zlib
+import numpy as np
+from PIL import Image, PngImagePlugin
+from pathlib import Path
+from typing import Any, BinaryIO, Dict, List, Optional, Sequence, Tuple, Union
+
+from quantize import unique_colors
+
+# Upper bound for the replicated rows encoded at once by save_scaled_png
+SCALE_CHUNK_BYTES = 16 * 1024 * 1024
+# Formats outputs can be converted to with --format, all lossless
+OUTPUT_FORMATS = ('png', 'webp', 'qoi')
+# zlib strategies of PNG output; without one, Pillow uses 'filtered' and StripPngWriter 'default'
+PNG_STRATEGIES = {
+    'default': zlib.Z_DEFAULT_STRATEGY,
+    'filtered': zlib.Z_FILTERED,
+    'huffman': zlib.Z_HUFFMAN_ONLY,
+    'rle': zlib.Z_RLE,
+    'fixed': zlib.Z_FIXED,
+}
+# Metadata keys recording the size a downscaled output was made from
+ORIGINAL_SIZE_KEY = 'pxltr:original-size'
+SCALE_KEY = 'pxltr:scale'
+
+class StripPngWriter:
+    """
+    PNG writer that takes the image a few rows at a time.
+
+    Rows are Up-filtered and fed to a single zlib stream, so memory use only
+    depends on the width of the image, not its height. path may also be a
+    binary file object, which is written to but left open. strategy is a
+    PNG_STRATEGIES name and text is written as tEXt chunks.
+    """
+
+    def __init__(self, path: Union[Path, BinaryIO], size: Tuple[int, int], mode: str, palette: Optional[Sequence[int]] = None, compress_level: int = 6, chunk_size: int = 1 << 20, strategy: Optional[str] = None, text: Optional[Dict[str, str]] = None):
+        if mode not in ('RGB', 'P'):
+            raise ValueError(f"Strip PNG writer supports RGB and P images, got {mode}")
+        self.path = path
+        self.size = size
+        self.mode = mode
+        self.chunk_size = chunk_size
+        self._rows_written = 0
+        self._compressor = zlib.compressobj(compress_level, zlib.DEFLATED, zlib.MAX_WBITS, 8, PNG_STRATEGIES[strategy or 'default'])
+        self._pending: List[bytes] = []
+        self._pending_size = 0
+        self._previous = np.zeros(size[0] * (3 if mode == 'RGB' else 1), dtype=np.uint8)
+        self._owns_file = not hasattr(path, 'write')
+        self._file: Optional[BinaryIO] = open(path, 'wb') if self._owns_file else path
+        self._file.write(b'\x89PNG\r\n\x1a\n')
+        self._chunk(b'IHDR', struct.pack('>IIBBBBB', size[0], size[1], 8, 2 if mode == 'RGB' else 3, 0, 0, 0))
+        if mode == 'P':
+            self._chunk(b'PLTE', bytes(palette or []))
+        for key, value in (text or {}).items():
+            self._chunk(b'tEXt', key.encode('latin-1') + b'\0' + value.encode('latin-1'))
+
+    def _chunk(self, kind: bytes, data: bytes):
+        self._file.write(struct.pack('>I', len(data)) + kind + data)
+        self._file.write(struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+
+    def _compressed(self, data: bytes):
+        if data:
+            self._pending.append(data)
+            self._pending_size += len(data)
+        if self._pending_size >= self.chunk_size:
+            self._flush()
+
+    def _flush(self):
+        if self._pending:
+            self._chunk(b'IDAT', b''.join(self._pending))
+            self._pending = []
+            self._pending_size = 0
+
+    def write(self, rows: np.ndarray):
+        """Append (R, W) index or (R, W, 3) RGB rows"""
+        rows = rows.reshape(len(rows), -1)
+        if not len(rows):
+            return
+        if self._rows_written + len(rows) > self.size[1]:
+            raise ValueError(f"Too many rows for a {self.size[0]}x{self.size[1]} image")
+        filtered = np.empty((len(rows), rows.shape[1] + 1), dtype=np.uint8)
+        filtered[:, 0] = 2  # Up filter: nearest-neighbor upscales repeat rows, which become zeros
+        np.subtract(rows[0], self._previous, out=filtered[0, 1:])
+        np.subtract(rows[1:], rows[:-1], out=filtered[1:, 1:])
+        self._previous = rows[-1].copy()
+        self._rows_written += len(rows)
+        self._compressed(self._compressor.compress(filtered.tobytes()))
+
+    def close(self):
+        """Finish the file, which must have received every row"""
+        if self._file is None:
+            return
+        if self._rows_written != self.size[1]:
+            self.abort()
+            raise ValueError(f"{self.path} got {self._rows_written} of {self.size[1]} rows")
+        self._compressed(self._compressor.flush())
+        self._flush()
+        self._chunk(b'IEND', b'')
+        self._release()
+
+    def _release(self):
+        if self._owns_file:
+            self._file.close()
+        self._file = None
+
+    def abort(self):
+        """Close the file without finishing it, leaving a truncated PNG"""
+        if self._file is not None:
+            self._release()
+
+def integer_scale(size: Tuple[int, int], scaled_size: Tuple[int, int]) -> Optional[Tuple[int, int]]:
+    """Horizontal and vertical factors when scaled_size is an integer multiple of size, else None"""
+    (width, height), (scaled_width, scaled_height) = size, scaled_size
+    if width and height and scaled_width % width == 0 and scaled_height % height == 0:
+        return scaled_width // width, scaled_height // height
+    return None
+
+def palette_indices(image: Image.Image) -> Optional[Tuple[np.ndarray, List[int]]]:
+    """
+    (H, W) palette indices and flat RGB palette of an image, without changing any pixel.
+
+    'P' images are used as is; RGB images with at most 256 colors are indexed
+    by their unique colors. Returns None when the image cannot be indexed.
+    """
+    if image.mode == 'P' and 'transparency' not in image.info:
+        return np.asarray(image), image.getpalette()
+    if image.mode != 'RGB':
+        return None
+    colors, inverse = unique_colors(np.asarray(image))
+    if len(colors) > 256:
+        return None
+    return inverse.astype(np.uint8), list(colors.tobytes())
+
+def save_scaled_png(indices: np.ndarray, palette: Sequence[int], path: Union[Path, BinaryIO], scale: Tuple[int, int], compress_level: int = 6, strategy: Optional[str] = None):
+    """
+    Save an indexed image enlarged by integer factors as an indexed PNG.
+
+    Every index is replicated into a scale block a few rows at a time, which
+    gives the same pixels as a NEAREST resize without ever holding the
+    full-size image, and with 1 byte per pixel instead of 3.
+    """
+    scale_x, scale_y = scale
+    height, width = indices.shape
+    writer = StripPngWriter(path, (width * scale_x, height * scale_y), 'P', palette, compress_level, strategy=strategy)
+    try:
+        row_bytes = width * scale_x * scale_y
+        chunk_rows = max(1, SCALE_CHUNK_BYTES // row_bytes)
+        for start in range(0, height, chunk_rows):
+            rows = np.repeat(indices[start:start + chunk_rows], scale_x, axis=1)
+            writer.write(np.repeat(rows, scale_y, axis=0))
+    except BaseException:
+        writer.abort()
+        raise
+    writer.close()
+
+def indexed_image(image: Image.Image) -> Image.Image:
+    """'P' version of an RGB image with at most 256 colors, with the same pixels; other images as they are"""
+    if image.mode != 'RGB':
+        return image
+    indexed = palette_indices(image)
+    if indexed is None:
+        return image
+    indices, palette = indexed
+    result = Image.fromarray(indices, 'P')
+    result.putpalette(palette)
+    return result
+
+def original_size_metadata(size: Tuple[int, int], original_size: Tuple[int, int]) -> Dict[str, str]:
+    """Metadata of a downscaled output: the size it was made from and the scale factors back to it"""
+    (width, height), (og_width, og_height) = size, original_size
+    return {ORIGINAL_SIZE_KEY: f"{og_width}x{og_height}", SCALE_KEY: f"{og_width / width:g}x{og_height / height:g}"}
+
+def _xmp_packet(metadata: Dict[str, str]) -> bytes:
+    attributes = ' '.join(f'{key}="{value}"' for key, value in metadata.items())
+    return (
+        '<x:xmpmeta xmlns:x="adobe:ns:meta/"><rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">'
+        f'<rdf:Description xmlns:pxltr="urn:pxltr:1.0" {attributes}/></rdf:RDF></x:xmpmeta>'
+    ).encode()
+
+def read_original_size(image: Image.Image) -> Optional[Tuple[int, int]]:
+    """Original size recorded by original_size_metadata in a PNG or WebP output, None when there is none"""
+    value = getattr(image, 'text', {}).get(ORIGINAL_SIZE_KEY) if image.format == 'PNG' else None
+    if value is None:
+        match = re.search(rf'{ORIGINAL_SIZE_KEY}="([^"]*)"', (image.info.get('xmp') or b'').decode('utf-8', 'replace'))
+        value = match and match.group(1)
+    if not value:
+        return None
+    width, height = value.split('x')
+    return int(width), int(height)
+
+def save_options(image: Image.Image, format: str, compress_level: int = 6, optimize: bool = False, strategy: Optional[str] = None, indexed: bool = False, metadata: Optional[Dict[str, str]] = None) -> Tuple[Image.Image, Dict[str, Any]]:
+    """
+    Image to save and Pillow save options for a lowercase format name.
+
+    PNG takes the zlib compress_level, a PNG_STRATEGIES strategy, Pillow's
+    optimize flag and, with indexed, is written as an indexed PNG when it
+    has at most 256 colors. WebP is lossless, with compress_level setting
+    the encoder effort (method 0-6, 4 at the default level 6). metadata is
+    saved as PNG text chunks or WebP XMP; other formats drop it.
+    """
+    if format == 'png':
+        options: Dict[str, Any] = {'compress_level': compress_level, 'optimize': optimize}
+        if strategy:
+            options['compress_type'] = PNG_STRATEGIES[strategy]
+        if metadata:
+            options['pnginfo'] = PngImagePlugin.PngInfo()
+            for key, value in metadata.items():
+                options['pnginfo'].add_text(key, value)
+        return indexed_image(image) if indexed else image, options
+    if format == 'webp':
+        options = {'lossless': True, 'method': compress_level * 2 // 3}
+        if metadata:
+            options['xmp'] = _xmp_packet(metadata)
+        return image.convert('RGB') if image.mode == 'P' else image, options
+    return image, {}
+
+def encode_qoi(image: Image.Image) -> bytes:
+    """
+    QOI encoding of an image as RGB, with the same ops as the reference encoder.
+
+    The encoder is sequential in principle, but every decision only depends
+    on the previous pixel or on the last earlier pixel with the same hash,
+    so it is computed for all pixels at once: pixels equal to their
+    predecessor form runs, the others are an index hit when the last
+    non-run pixel with the same hash equals them, else a diff, luma or RGB
+    op. Channel differences are taken in uint8, which wraps them like the
+    reference's signed chars. Ops are scattered into a buffer pre-filled
+    with full-run bytes.
+    """
+    width, height = image.size
+    pixels = np.asarray(image.convert('RGB')).reshape(-1, 3)
+    # Channels behind a black first predecessor, the encoder's starting pixel
+    red, green, blue = (np.concatenate(([0], pixels[:, c])).astype(np.uint8) for c in range(3))
+    packed = (red.astype(np.uint32) << 16) | (green.astype(np.uint32) << 8) | blue
+    repeated = packed[1:] == packed[:-1]
+    # Runs, with their length at their last pixel
+    bounds = np.diff(np.concatenate(([0], repeated.view(np.int8), [0])))
+    run_starts, run_ends = np.flatnonzero(bounds == 1), np.flatnonzero(bounds == -1) - 1
+    run_lengths = run_ends - run_starts + 1
+    # Ops of the other pixels, at position + 1 in the padded channels
+    ops = np.flatnonzero(~repeated)
+    current, previous = ops + 1, ops
+    values = packed[current]
+    hashes = ((red[current].astype(np.uint16) * 3 + green[current] * 5 + blue[current] * 7 + 255 * 11) & 63).astype(np.uint8)
+    order = np.argsort(hashes, kind='stable')
+    hit = np.zeros(len(ops), dtype=bool)
+    hit[order[1:]] = (hashes[order[1:]] == hashes[order[:-1]]) & (values[order[1:]] == values[order[:-1]])
+    delta_red = red[current] - red[previous]
+    delta_green = green[current] - green[previous]
+    delta_blue = blue[current] - blue[previous]
+    small = ~hit & ((delta_red + 2) <= 3) & ((delta_green + 2) <= 3) & ((delta_blue + 2) <= 3)
+    luma_red, luma_blue = delta_red - delta_green + 8, delta_blue - delta_green + 8
+    luma = ~hit & ~small & ((delta_green + 32) <= 63) & (luma_red <= 15) & (luma_blue <= 15)
+    rgb = ~(hit | small | luma)
+    # Bytes per pixel: op lengths, and run bytes at the end of every run
+    lengths = np.zeros(len(repeated), dtype=np.int64)
+    lengths[ops] = 1 + luma + 3 * rgb
+    lengths[run_ends] = (run_lengths + 61) // 62
+    offsets = np.cumsum(lengths)
+    out = np.full(int(offsets[-1]) if len(offsets) else 0, 0xfd, dtype=np.uint8)  # QOI_OP_RUN of 62
+    remainders = run_lengths % 62
+    partial = remainders > 0
+    out[offsets[run_ends[partial]] - 1] = 0xc0 | (remainders[partial] - 1)
+    starts = offsets[ops] - lengths[ops]
+    diff = 0x40 | ((delta_red + 2) << 4) | ((delta_green + 2) << 2) | (delta_blue + 2)
+    out[starts] = np.where(hit, hashes, np.where(small, diff, np.where(luma, 0x80 | (delta_green + 32), 0xfe)))
+    out[starts[luma] + 1] = (luma_red[luma] << 4) | luma_blue[luma]
+    rgb_starts = starts[rgb]
+    out[rgb_starts + 1] = red[current[rgb]]
+    out[rgb_starts + 2] = green[current[rgb]]
+    out[rgb_starts + 3] = blue[current[rgb]]
+    header = b'qoif' + struct.pack('>IIBB', width, height, 3, 0)
+    return header + out.tobytes() + b'\0' * 7 + b'\1'
+
+def save_qoi(image: Image.Image, target: Union[Path, BinaryIO]):
+    """Save an image with encode_qoi to a path or binary file, which is left open"""
+    data = encode_qoi(image)
+    if hasattr(target, 'write'):
+        target.write(data)
+    else:
+        Path(target).write_bytes(data)
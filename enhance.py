@@ -0,0 +1,111 @@
+"""
+Contrast and saturation with NumPy lookup tables, matching ImageEnhance
+"""
+
+import numpy as np
+from functools import lru_cache
+from PIL import Image
+from typing import Any, Dict, Optional
+
+from quantize import has_few_colors, unique_colors
+
+ENHANCERS = ('pillow', 'numpy')
+
+def luminance(pixels: np.ndarray) -> np.ndarray:
+    """Gray level of (..., 3) uint8 RGB pixels, as Pillow's convert('L') computes it"""
+    r, g, b = (pixels[..., c].astype(np.uint32) for c in range(3))
+    return ((r * 19595 + g * 38470 + b * 7471 + 0x8000) >> 16).astype(np.uint8)
+
+@lru_cache(maxsize=64)
+def blend_table(factor: float) -> np.ndarray:
+    """
+    (256, 256) uint8 table of Image.blend(base, value, factor) by base and value.
+
+    Pillow blends in float32, truncates and clips to 0-255; doing the same
+    arithmetic here makes every entry identical to Pillow's result. Tables
+    are cached per factor and must not be modified.
+    """
+    levels = np.arange(256, dtype=np.float32)
+    blended = levels[:, None] + np.float32(factor) * (levels[None, :] - levels[:, None])
+    return np.clip(blended, 0, 255).astype(np.uint8)
+
+def contrast_mean(pixels: np.ndarray, counts: np.ndarray) -> int:
+    """Rounded mean gray level ImageEnhance.Contrast pivots around, for colors weighted by pixel counts"""
+    gray = luminance(pixels).astype(np.int64)
+    return int(int((gray * counts).sum()) / int(counts.sum()) + 0.5)
+
+def image_mean(image: Image.Image) -> int:
+    """Rounded mean gray level ImageEnhance.Contrast pivots around, from the gray histogram"""
+    histogram = image.convert('L').histogram()
+    return int(sum(level * count for level, count in enumerate(histogram)) / (image.width * image.height) + 0.5)
+
+def adjust_contrast(pixels: np.ndarray, factor: float, mean: int) -> np.ndarray:
+    """ImageEnhance.Contrast(image).enhance(factor) of (..., 3) uint8 pixels, as one table lookup"""
+    return blend_table(factor)[mean][pixels]
+
+def adjust_saturation(pixels: np.ndarray, factor: float) -> np.ndarray:
+    """ImageEnhance.Color(image).enhance(factor) of (..., 3) uint8 pixels, as one table lookup"""
+    index = (luminance(pixels).astype(np.intp) << 8)[..., None] | pixels
+    return blend_table(factor).ravel()[index]
+
+def colors_image(colors: np.ndarray, inverse: np.ndarray) -> Image.Image:
+    """RGB image of (U, 3) uint8 colors gathered by an (H, W) index array, as packed 32-bit pixels"""
+    packed = np.zeros((len(colors), 4), dtype=np.uint8)
+    packed[:, :3] = colors
+    pixels = packed.view(np.uint32).ravel().take(inverse)
+    return Image.frombytes('RGB', (inverse.shape[1], inverse.shape[0]), pixels, 'raw', 'RGBX')
+
+class ColorEnhancer:
+    """
+    Contrast and saturation variants of one image, identical to ImageEnhance.
+
+    Images with few distinct colors (see quantize.has_few_colors), such as
+    pixel art, are enhanced through their distinct colors only, with the
+    lookup tables, and rebuilt with one gather of packed pixels. Other
+    images apply contrast as a per-channel point() table, instead of
+    blending with a mean-color image, and saturation with Pillow's blend,
+    which is faster there than NumPy lookups over every pixel. The contrast
+    stage is kept per factor and shared by the saturations applied after
+    it. mean overrides the mean gray contrast pivots around, e.g. the mean
+    of a whole image when this one is a strip of it.
+    """
+
+    def __init__(self, image: Image.Image, mean: Optional[int] = None):
+        self.image = image.convert('RGB')
+        self.colors = None
+        self.inverse = None
+        self._counts = None
+        pixels = np.asarray(self.image)
+        if has_few_colors(pixels):
+            self.colors, self.inverse = unique_colors(pixels)
+            self._counts = np.bincount(self.inverse.ravel(), minlength=len(self.colors))
+        self._mean = mean
+        self._contrasted: Dict[float, Any] = {}
+
+    @property
+    def mean(self) -> int:
+        if self._mean is None:
+            self._mean = image_mean(self.image) if self.colors is None else contrast_mean(self.colors, self._counts)
+        return self._mean
+
+    def _contrast(self, factor: float) -> Any:
+        # Distinct colors, or the whole image, with contrast applied
+        if factor not in self._contrasted:
+            if self.colors is not None:
+                self._contrasted[factor] = self.colors if factor == 1.0 else adjust_contrast(self.colors, factor, self.mean)
+            else:
+                self._contrasted[factor] = self.image if factor == 1.0 else self.image.point(blend_table(factor)[self.mean].tolist() * 3)
+        return self._contrasted[factor]
+
+    def enhance(self, contrast: float = 1.0, saturation: float = 1.0) -> Image.Image:
+        """The image with contrast then saturation applied, like ImageEnhance.Contrast then ImageEnhance.Color"""
+        if contrast == 1.0 and saturation == 1.0:
+            return self.image
+        contrasted = self._contrast(contrast)
+        if self.colors is None:
+            if saturation == 1.0:
+                return contrasted
+            return Image.blend(contrasted.convert('L').convert('RGB'), contrasted, saturation)
+        if saturation != 1.0:
+            contrasted = adjust_saturation(contrasted, saturation)
+        return colors_image(contrasted, self.inverse)
@@ -0,0 +1,262 @@
+"""
+Palette extraction from images: color histograms, median cut and k-means
+"""
+
+import json
+import os
+import re
+import numpy as np
+import yaml
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from PIL import Image
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from cache import atomic_write
+from colorspace import COLOR_SPACES, convert_colors
+
+EXTRACT_METHODS = ('kmeans', 'median-cut', 'pillow')
+# Pixels sampled from an image before building its color histogram
+DEFAULT_MAX_PIXELS = 1 << 18
+# Colors whose distances to the centers are computed at once
+_ASSIGN_CHUNK = 1 << 16
+
+def color_histogram(pixels: np.ndarray, max_pixels: Optional[int] = DEFAULT_MAX_PIXELS, seed: int = 0) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Unique (N, 3) uint8 colors of an (..., 3) pixel array and their pixel counts.
+
+    Colors are packed into 24-bit integers so a single np.unique deduplicates
+    them. Images with more than max_pixels pixels are randomly subsampled
+    first, reproducibly for a given seed.
+    """
+    pixels = pixels.reshape(-1, pixels.shape[-1])[:, :3]
+    if max_pixels and len(pixels) > max_pixels:
+        pixels = pixels[np.random.default_rng(seed).integers(0, len(pixels), max_pixels)]
+    packed = (pixels[:, 0].astype(np.uint32) << 16) | (pixels[:, 1].astype(np.uint32) << 8) | pixels[:, 2]
+    values, counts = np.unique(packed, return_counts=True)
+    colors = np.stack([values >> 16, (values >> 8) & 0xff, values & 0xff], axis=1).astype(np.uint8)
+    return colors, counts
+
+def _weighted_means(values: np.ndarray, weights: np.ndarray, labels: np.ndarray, count: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Weighted mean of the values in each of count groups, and the total weight of each group"""
+    totals = np.bincount(labels, weights, minlength=count)
+    sums = np.stack([np.bincount(labels, weights * values[:, c], minlength=count) for c in range(values.shape[1])], axis=1)
+    return sums / np.maximum(totals, 1e-12)[:, None], totals
+
+def _nearest_centers(points: np.ndarray, centers: np.ndarray) -> np.ndarray:
+    """Index of the nearest center for every point, in chunks of bounded size"""
+    center_norms = (centers ** 2).sum(axis=1)
+    labels = np.empty(len(points), dtype=np.intp)
+    for start in range(0, len(points), _ASSIGN_CHUNK):
+        chunk = points[start:start + _ASSIGN_CHUNK]
+        labels[start:start + _ASSIGN_CHUNK] = (center_norms - 2 * (chunk @ centers.T)).argmin(axis=1)
+    return labels
+
+def _median_cut_labels(points: np.ndarray, weights: np.ndarray, count: int) -> np.ndarray:
+    """
+    Box of every point after splitting the points into at most count boxes.
+
+    The box with the largest weighted squared error is split at the weighted
+    median of its widest-variance axis, until there are count boxes or no
+    box holds more than one distinct point.
+    """
+    def squared_error(members: np.ndarray) -> float:
+        if len(members) < 2:
+            return 0.0
+        member_weights = weights[members]
+        deviations = points[members] - np.average(points[members], axis=0, weights=member_weights)
+        return float((member_weights * (deviations ** 2).sum(axis=1)).sum())
+
+    boxes = [np.arange(len(points))]
+    errors = [squared_error(boxes[0])]
+    while len(boxes) < count:
+        box = int(np.argmax(errors))
+        if errors[box] <= 0:
+            break
+        members = boxes[box]
+        values, member_weights = points[members], weights[members]
+        variances = np.average((values - np.average(values, axis=0, weights=member_weights)) ** 2, axis=0, weights=member_weights)
+        order = np.argsort(values[:, int(np.argmax(variances))], kind='stable')
+        cumulative = np.cumsum(member_weights[order])
+        # Keep at least one point on each side
+        split = min(max(int(np.searchsorted(cumulative, cumulative[-1] / 2)), 1), len(order) - 1)
+        boxes[box], upper = members[order[:split]], members[order[split:]]
+        boxes.append(upper)
+        errors[box] = squared_error(boxes[box])
+        errors.append(squared_error(upper))
+    labels = np.empty(len(points), dtype=np.intp)
+    for index, members in enumerate(boxes):
+        labels[members] = index
+    return labels
+
+def median_cut(colors: np.ndarray, counts: np.ndarray, count: int, space: str = 'rgb') -> np.ndarray:
+    """Median-cut palette of at most count colors from a color histogram, as a (K, 3) uint8 array"""
+    labels = _median_cut_labels(convert_colors(colors, space), counts.astype(np.float64), count)
+    return _palette_from_labels(colors, counts, labels)
+
+def kmeans(colors: np.ndarray, counts: np.ndarray, count: int, space: str = 'rgb', seed: int = 0, iterations: int = 30, batch_size: int = 4096, tolerance: float = 0.05) -> np.ndarray:
+    """
+    K-means palette of at most count colors from a color histogram, as a (K, 3) uint8 array.
+
+    Clustering happens in the given color space, weighted by pixel counts,
+    and starts from the median-cut boxes so the result is deterministic for
+    a seed. Histograms larger than batch_size are clustered with mini-batch
+    k-means: each iteration moves the centers toward a weighted sample of
+    batch_size colors, with per-center learning rates. Iteration stops
+    early once no center moves by more than tolerance.
+    """
+    points = convert_colors(colors, space).astype(np.float64)
+    weights = counts.astype(np.float64)
+    labels = _median_cut_labels(points, weights, count)
+    centers, _ = _weighted_means(points, weights, labels, int(labels.max()) + 1)
+    rng = np.random.default_rng(seed)
+    cumulative = np.cumsum(weights)
+    center_weights = np.zeros(len(centers))
+    for _ in range(iterations):
+        if len(points) > batch_size:
+            batch = np.searchsorted(cumulative, rng.random(batch_size) * cumulative[-1], side='right')
+            batch_points, batch_weights = points[batch], np.ones(batch_size)
+        else:
+            batch_points, batch_weights = points, weights
+        labels = _nearest_centers(batch_points, centers)
+        means, totals = _weighted_means(batch_points, batch_weights, labels, len(centers))
+        moved = totals > 0
+        if len(points) > batch_size:
+            center_weights += totals
+            rates = np.where(moved, totals / np.maximum(center_weights, 1e-12), 0)
+            updated = centers + (means - centers) * rates[:, None]
+        else:
+            updated = np.where(moved[:, None], means, centers)
+        shift = np.abs(updated - centers).max()
+        centers = updated
+        if shift <= tolerance:
+            break
+    return _palette_from_labels(colors, counts, _nearest_centers(points, centers))
+
+def _palette_from_labels(colors: np.ndarray, counts: np.ndarray, labels: np.ndarray) -> np.ndarray:
+    """Weighted mean RGB color of every non-empty group, most used first"""
+    means, totals = _weighted_means(colors.astype(np.float64), counts.astype(np.float64), labels, int(labels.max()) + 1)
+    used = np.flatnonzero(totals > 0)
+    used = used[np.argsort(-totals[used], kind='stable')]
+    palette = np.clip(np.rint(means[used]), 0, 255).astype(np.uint8)
+    # Rounding can merge two groups into the same color
+    _, first = np.unique(palette, axis=0, return_index=True)
+    return palette[np.sort(first)]
+
+def extract_palette(image: Image.Image, colors: int = 16, method: str = 'kmeans', space: str = 'rgb', seed: int = 0, max_pixels: Optional[int] = DEFAULT_MAX_PIXELS) -> List[Tuple[int, int, int]]:
+    """
+    Extract at most colors representative colors from an image, most used first.
+
+    'kmeans' and 'median-cut' cluster the image's color histogram (see
+    color_histogram) in space, which is 'rgb', 'cielab' or 'oklab'; images
+    with fewer distinct colors return those colors. 'pillow' uses Pillow's
+    quantizer on the full image.
+    """
+    if method not in EXTRACT_METHODS:
+        raise ValueError(f"Unknown extraction method '{method}', expected one of {', '.join(EXTRACT_METHODS)}")
+    if space not in COLOR_SPACES:
+        raise ValueError(f"Unknown color space '{space}', expected one of {', '.join(COLOR_SPACES)}")
+    if colors < 1:
+        raise ValueError(f"Palettes need at least one color, got {colors}")
+    image = image.convert('RGB')
+    if method == 'pillow':
+        flat = image.quantize(colors=colors).getpalette() or []
+        return [tuple(flat[i:i + 3]) for i in range(0, len(flat) - 2, 3)]
+    histogram_colors, counts = color_histogram(np.asarray(image), max_pixels, seed)
+    if len(histogram_colors) <= colors:
+        palette = histogram_colors[np.argsort(-counts, kind='stable')]
+    elif method == 'median-cut':
+        palette = median_cut(histogram_colors, counts, colors, space)
+    else:
+        palette = kmeans(histogram_colors, counts, colors, space, seed)
+    return [tuple(int(c) for c in color) for color in palette]
+
+def normalize_palette_name(name: str) -> str:
+    """Name lowercased with other characters than letters and digits replaced, as PaletteCollection looks names up in lowercase"""
+    return re.sub(r'[^a-z0-9]+', '_', name.lower()).strip('_') or 'palette'
+
+def palette_name(path: Path) -> str:
+    """Palette name for an image file: its normalized stem"""
+    return normalize_palette_name(path.stem)
+
+def palette_yaml(name: str, colors: List[Tuple[int, int, int]], description: str = '', source: str = '') -> str:
+    """Palette file contents in the layout of the built-in palettes/*.yaml files"""
+    # JSON strings are valid YAML double-quoted scalars, escapes included
+    lines = [
+        f'name: {json.dumps(name, ensure_ascii=False)}',
+        f'description: {json.dumps(description or f"Palette extracted from {source or name}", ensure_ascii=False)}',
+        f'source: {json.dumps(source, ensure_ascii=False)}',
+        f'color_count: {len(colors)}',
+        'colors:',
+    ]
+    lines += [f"  - [{r}, {g}, {b}]  # #{r:02x}{g:02x}{b:02x}" for r, g, b in colors]
+    return "\n".join(lines) + "\n"
+
+def save_palette_yaml(path: Path, name: str, colors: List[Tuple[int, int, int]], description: str = '', source: str = ''):
+    content = palette_yaml(name, colors, description, source).encode('utf-8')
+    atomic_write(path, lambda f: f.write(content))
+
+def _extracted_from(path: Path, source: str) -> bool:
+    """Whether an existing palette file was extracted from an image file named source, and may be replaced"""
+    try:
+        with open(path, 'r') as f:
+            data = yaml.safe_load(f)
+    except Exception:
+        return False
+    return isinstance(data, dict) and data.get('source') == source
+
+def output_paths(input_paths: List[Path], output_dir: Path, names: Optional[Dict[Path, str]] = None) -> Dict[Path, Path]:
+    """
+    Palette file in output_dir of every image, named by palette_name or by
+    its normalized entry in names.
+
+    Images whose names collide get _2, _3... suffixes in path order, and
+    existing files not extracted from an image of the same file name (such
+    as the built-in palettes) are left alone, so no palette is overwritten
+    by another one while running again over the same images keeps the names.
+    """
+    taken = set()
+    targets = {}
+    for path in sorted(input_paths):
+        base = normalize_palette_name(names[path]) if names and path in names else palette_name(path)
+        name, suffix = base, 1
+        while name in taken or ((output_dir / f"{name}.yaml").exists() and not _extracted_from(output_dir / f"{name}.yaml", path.name)):
+            suffix += 1
+            name = f"{base}_{suffix}"
+        taken.add(name)
+        targets[path] = output_dir / f"{name}.yaml"
+    return targets
+
+def _extract_file(input_path: Path, output_path: Path, colors: int, method: str, space: str, seed: int, max_pixels: Optional[int]) -> Tuple[Path, Optional[str], Optional[Path]]:
+    """Extract one image's palette to a YAML file, returning the error message instead of raising"""
+    try:
+        with Image.open(input_path) as image:
+            palette = extract_palette(image, colors, method, space, seed, max_pixels)
+        save_palette_yaml(output_path, output_path.stem, palette, source=input_path.name)
+    except Exception as e:
+        return input_path, str(e), None
+    return input_path, None, output_path
+
+def extract_directory(input_paths: List[Path], output_dir: Path, colors: int = 16, method: str = 'kmeans', space: str = 'rgb', seed: int = 0, max_pixels: Optional[int] = DEFAULT_MAX_PIXELS, jobs: int = 1) -> Iterator[Tuple[Path, Optional[str], Optional[Path]]]:
+    """
+    Extract the palette of every image into output_dir/<name>.yaml, yielding (input, error, output) as images finish.
+
+    Names come from output_paths, so output_dir can be a palettes directory
+    used by PaletteCollection. jobs is the number of worker processes (0 for
+    one per CPU); a failing image yields its error and does not stop the rest.
+    """
+    output_dir.mkdir(parents=True, exist_ok=True)
+    work = [(path, target, colors, method, space, seed, max_pixels) for path, target in output_paths(input_paths, output_dir).items()]
+    jobs = jobs or os.cpu_count() or 1
+    if jobs == 1 or len(work) <= 1:
+        for args in work:
+            yield _extract_file(*args)
+        return
+    with ProcessPoolExecutor(max_workers=min(jobs, len(work))) as executor:
+        futures = {executor.submit(_extract_file, *args): args[0] for args in work}
+        for future in as_completed(futures):
+            try:
+                yield future.result()
+            except Exception as e:
+                # The worker itself died (e.g. killed or out of memory)
+                yield futures[future], str(e), None
@@ -0,0 +1,162 @@
+"""
+Result manifest for incremental batch runs: skip, resume and prune outputs
+"""
+
+import enum
+import hashlib
+import json
+from importlib import metadata
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from batch import BatchTask
+from cache import atomic_write
+from palette_swap import ImagePalette
+
+MANIFEST_NAME = '.pxltr-manifest.json'
+# Bump when the manifest layout or the key computation changes
+MANIFEST_VERSION = 1
+# process_picture options that do not change the output pixels
+_IGNORED_OPTIONS = ('memory_budget', 'compress_level', 'optimize', 'enhancer', 'png_strategy', 'indexed')
+
+try:
+    TOOL_VERSION = metadata.version('pixelartcolorstool')
+except metadata.PackageNotFoundError:
+    TOOL_VERSION = 'unknown'
+
+def file_digest(path: Path) -> str:
+    """SHA-256 of a file's contents, or of the names and contents of a directory's files"""
+    digest = hashlib.sha256()
+    if path.is_dir():
+        for child in sorted(p for p in path.iterdir() if p.is_file()):
+            digest.update(child.name.encode() + b'\0' + file_digest(child).encode())
+        return digest.hexdigest()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def palettes_digest(palettes: Optional[List[ImagePalette]]) -> str:
+    """SHA-256 of the names, colors and palette images of the palettes, in order"""
+    digest = hashlib.sha256()
+    for palette in palettes or []:
+        digest.update(palette.name.encode() + b'\0')
+        digest.update(bytes(c for color in palette.colors for c in color))
+        digest.update(palette.image.tobytes() + bytes(palette.image.getpalette() or []))
+    return digest.hexdigest()
+
+def _option_value(value: Any) -> Any:
+    # Dithers are Image.Dither or DitherMethod enums
+    if isinstance(value, enum.Enum):
+        return f"{type(value).__name__}.{value.name}"
+    raise TypeError(f"Cannot use {value!r} in a manifest key")
+
+class ResultManifest:
+    """
+    Record of the outputs written for every batch task and what they were made from.
+
+    A task is up to date when the key of its inputs (input file content,
+    palette contents, contrasts, saturations, the other process_picture
+    options and the tool version) matches the recorded one and all its
+    recorded outputs still exist. Input hashes are reused while a file's
+    size and modification time are unchanged, so unchanged files are not
+    read again.
+    """
+
+    def __init__(self, path: Path, entries: Optional[Dict[str, Dict[str, Any]]] = None, inputs: Optional[Dict[str, Dict[str, Any]]] = None):
+        self.path = path
+        self.entries = entries or {}
+        self.inputs = inputs or {}
+        self._unsaved = 0
+
+    @classmethod
+    def load(cls, directory: Path) -> 'ResultManifest':
+        """Manifest of an output directory; empty when missing, unreadable or outdated"""
+        path = directory / MANIFEST_NAME
+        try:
+            with open(path, encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('version') == MANIFEST_VERSION:
+                return cls(path, data['entries'], data['inputs'])
+        except (OSError, ValueError, KeyError):
+            pass
+        return cls(path)
+
+    def save(self):
+        data = {'version': MANIFEST_VERSION, 'entries': self.entries, 'inputs': self.inputs}
+        atomic_write(self.path, lambda f: f.write(json.dumps(data, indent=1).encode('utf-8')))
+        self._unsaved = 0
+
+    def input_digest(self, path: Path) -> str:
+        """Content hash of an input, reused from the manifest while its size and mtime match"""
+        if path.is_dir():
+            return file_digest(path)
+        stat = path.stat()
+        known = self.inputs.get(str(path))
+        if known and known['size'] == stat.st_size and known['mtime_ns'] == stat.st_mtime_ns:
+            return known['digest']
+        digest = file_digest(path)
+        self.inputs[str(path)] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'digest': digest}
+        return digest
+
+    @staticmethod
+    def task_id(task: BatchTask) -> str:
+        """Manifest entry of a task: its output path and contrast/saturation lists"""
+        _, output_path, contrasts, saturations = task
+        return json.dumps([str(output_path), contrasts, saturations])
+
+    def task_key(self, task: BatchTask, palettes_key: str, options: Dict[str, Any]) -> str:
+        """Hash of everything the outputs of a task depend on"""
+        input_path, _, contrasts, saturations = task
+        options = {name: value for name, value in options.items() if name not in _IGNORED_OPTIONS}
+        key = json.dumps(
+            [MANIFEST_VERSION, TOOL_VERSION, self.input_digest(input_path), palettes_key, contrasts, saturations, options],
+            sort_keys=True, default=_option_value
+        )
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def is_current(self, task: BatchTask, key: str) -> bool:
+        entry = self.entries.get(self.task_id(task))
+        return bool(entry) and entry['key'] == key and all(Path(p).exists() for p in entry['outputs'])
+
+    def partition(self, tasks: List[BatchTask], palettes: Optional[List[ImagePalette]], options: Dict[str, Any]) -> Tuple[List[Tuple[BatchTask, str]], List[BatchTask]]:
+        """Split tasks into (task, key) pairs to run and tasks whose outputs are up to date"""
+        palettes_key = palettes_digest(palettes)
+        pending, current = [], []
+        for task in tasks:
+            key = self.task_key(task, palettes_key, options)
+            if self.is_current(task, key):
+                current.append(task)
+            else:
+                pending.append((task, key))
+        return pending, current
+
+    def record(self, task: BatchTask, key: str, outputs: List[Path], save_every: int = 50):
+        """
+        Record the outputs of a finished task.
+
+        The manifest is saved every save_every records, so an interrupted run
+        resumes from the last save instead of starting over.
+        """
+        self.entries[self.task_id(task)] = {
+            'key': key,
+            'input': str(task[0]),
+            'outputs': [str(p) for p in outputs],
+        }
+        self._unsaved += 1
+        if self._unsaved >= save_every:
+            self.save()
+
+    def prune(self) -> List[Path]:
+        """Delete the recorded outputs of inputs that no longer exist, returning the deleted paths"""
+        deleted = []
+        for task_id, entry in list(self.entries.items()):
+            if Path(entry['input']).exists():
+                continue
+            for output in map(Path, entry['outputs']):
+                if output.exists():
+                    output.unlink()
+                    deleted.append(output)
+            del self.entries[task_id]
+            self.inputs.pop(entry['input'], None)
+        return deleted
@@ -1,146 +1,547 @@
 from PIL import Image, ImageEnhance
 from pathlib import Path
+import io
 import sys
 import argparse
-import itertools
 import numpy as np
-from typing import List, Optional, Tuple
+from typing import Any, BinaryIO, Dict, Iterator, List, Optional, Sequence, Tuple, Union
 from palettes import PaletteCollection
+from quantize import DEFAULT_MEMORY_BUDGET, METRICS, QUANTIZERS, PaletteMapper, has_few_colors
+from atlas import apply_palettes
+from downscale import downscale_image
+from enhance import ENHANCERS, ColorEnhancer
+from dither import DitherMethod, dither_image
+from encoding import integer_scale, original_size_metadata, palette_indices, save_options, save_qoi, save_scaled_png
+from profiling import stage
+
+# Pillow's own dithers, or one of the NumPy dithering methods
+Dither = Union[Image.Dither, DitherMethod]
+DITHER_NAMES = {
+    'none': Image.Dither.NONE,
+    'floyd': Image.Dither.FLOYDSTEINBERG,
+    'bayer': DitherMethod.BAYER,
+    'atkinson': DitherMethod.ATKINSON,
+    'sierra': DitherMethod.SIERRA,
+    'jarvis': DitherMethod.JARVIS,
+}
+
+# Uniform-block score a detected pixel size needs, and the bonus per pixel favoring larger sizes
+PIXEL_SIZE_THRESHOLD = 0.6
+PIXEL_SIZE_BONUS = 0.01
 
 class ImagePalette:
-    def __init__(self, name: str, image: Image.Image):
+    def __init__(self, name: str, image: Image.Image, colors: Optional[Sequence[Tuple[int, int, int]]] = None):
         self.name = name
         self.image = image
+        # Exact palette colors; image may only approximate them (e.g. WEB palette conversion)
+        self.colors = list(colors) if colors is not None else _image_palette_colors(image)
+
+def _image_palette_colors(image: Image.Image) -> List[Tuple[int, int, int]]:
+    """Colors used by a 'P' palette image, in palette order"""
+    palette = image.getpalette() or []
+    used = sorted(index for _, index in image.getcolors(256) or [])
+    return [tuple(palette[index * 3:index * 3 + 3]) for index in used]
 
-def detect_pixel_size(image: Image.Image, max_size: int = 16) -> int:
+def load_image_palette(path: Path) -> ImagePalette:
+    """Load a palette image (1x, see https://lospec.com/palette-list), keeping its exact colors"""
+    source = Image.open(path).convert('RGB')
+    colors = list(dict.fromkeys(source.getdata()))
+    return ImagePalette(path.stem, source.convert(mode="P", palette=Image.Palette.WEB), colors)
+
+def detect_pixel_size(image: Image.Image, max_size: int = 16, tolerance: int = 5) -> int:
     """
     Detect the optimal pixel size by analyzing repeating patterns in the image.
     
+    Sizes that do not evenly divide the image are tested on the largest
+    top-left crop that they do divide.
+    
     Args:
         image: PIL Image to analyze
         max_size: Maximum pixel size to test (default 16)
+        tolerance: Maximum per-channel deviation from a block's first pixel
     
     Returns:
         Detected pixel size (1 if no clear pattern found)
     """
     # Convert to numpy array for easier analysis
-    img_array = np.array(image.convert('RGB'))
+    img_array = np.asarray(image.convert('RGB'))
     height, width, _ = img_array.shape
     
+    # Calculate how uniform the blocks of every candidate size are
+    scores = {size: _calculate_block_uniformity(img_array, size, tolerance) for size in pixel_size_candidates(width, height, max_size)}
+    return choose_pixel_size(scores)
+
+def pixel_size_candidates(width: int, height: int, max_size: int = 16) -> List[int]:
+    """Pixel sizes detect_pixel_size tests on an image, largest first"""
+    return list(range(2, min(max_size + 1, min(width, height) // 2)))[::-1]
+
+def best_pixel_size(scores: Dict[int, float]) -> int:
+    """Size with the best uniform-block score plus PIXEL_SIZE_BONUS per pixel, the larger one among ties; 1 without sizes"""
     best_score = 0
     best_size = 1
-    
-    # Test different pixel sizes, prioritizing larger sizes
-    sizes_to_test = list(range(2, min(max_size + 1, min(width, height) // 2)))
-    sizes_to_test.reverse()  # Test larger sizes first
-    
-    for size in sizes_to_test:
-        if width % size != 0 or height % size != 0:
-            continue
-            
-        # Calculate how uniform the blocks are
-        score = _calculate_block_uniformity(img_array, size)
-        
+    # Test larger sizes first
+    for size in sorted(scores, reverse=True):
         # Prefer larger block sizes by adding a small bonus
-        adjusted_score = score + (size * 0.01)
-        
+        adjusted_score = scores[size] + (size * PIXEL_SIZE_BONUS)
         if adjusted_score > best_score:
             best_score = adjusted_score
             best_size = size
-    
+    return best_size
+
+def choose_pixel_size(scores: Dict[int, float]) -> int:
+    """Pixel size from the uniform-block score of every candidate size: best_pixel_size when its score passes PIXEL_SIZE_THRESHOLD, else 1"""
+    best_size = best_pixel_size(scores)
+    if best_size not in scores:
+        return 1
     # Only return detected size if confidence is high enough
-    return best_size if (best_score - (best_size * 0.01)) > 0.6 else 1
+    best_score = scores[best_size] + (best_size * PIXEL_SIZE_BONUS)
+    return best_size if (best_score - (best_size * PIXEL_SIZE_BONUS)) > PIXEL_SIZE_THRESHOLD else 1
 
-def _calculate_block_uniformity(img_array: np.ndarray, block_size: int) -> float:
+def _calculate_block_uniformity(img_array: np.ndarray, block_size: int, tolerance: int = 5) -> float:
     """
     Calculate how uniform blocks of the given size are in the image.
     Higher scores indicate more uniform blocks (suggesting pixelated content).
     """
-    height, width, channels = img_array.shape
-    total_blocks = 0
-    uniform_blocks = 0
+    block_min, block_max, reference = _block_extrema(img_array, block_size)
+    if reference.size == 0:
+        return 0
     
-    # Iterate through blocks
-    for y in range(0, height - block_size + 1, block_size):
-        for x in range(0, width - block_size + 1, block_size):
-            block = img_array[y:y+block_size, x:x+block_size]
-            
-            # Check if block is uniform (all pixels same color)
-            if _is_block_uniform(block):
-                uniform_blocks += 1
-            total_blocks += 1
-    
-    return uniform_blocks / total_blocks if total_blocks > 0 else 0
+    # A block is uniform if every pixel is within tolerance of its first pixel
+    reference = reference.astype(np.int16)
+    uniform = ((block_max - reference) <= tolerance) & ((reference - block_min) <= tolerance)
+    return float(uniform.all(axis=-1).mean())
 
-def _is_block_uniform(block: np.ndarray, tolerance: int = 5) -> bool:
+def _block_extrema(img_array: np.ndarray, block_size: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
     """
-    Check if a block has uniform color within tolerance.
+    Per-block channel minimum, maximum and first pixel for the largest crop
+    of the image divisible by block_size, each shaped (H/s, W/s, C).
     """
-    if block.size == 0:
-        return False
-        
-    # Get the first pixel as reference
-    reference = block[0, 0]
+    height, width, channels = img_array.shape
+    rows, cols = height // block_size, width // block_size
+    cropped = img_array[:rows * block_size, :cols * block_size]
+    
+    # Reduce the s rows of each block first; every slice is a contiguous row band
+    bands = cropped.reshape(rows, block_size, cols * block_size * channels)
+    row_min = bands[:, 0].copy()
+    row_max = bands[:, 0].copy()
+    for i in range(1, block_size):
+        np.minimum(row_min, bands[:, i], out=row_min)
+        np.maximum(row_max, bands[:, i], out=row_max)
+    
+    # Then reduce the s columns inside each block
+    row_min = row_min.reshape(rows, cols, block_size, channels)
+    row_max = row_max.reshape(rows, cols, block_size, channels)
+    block_min = row_min[:, :, 0].copy()
+    block_max = row_max[:, :, 0].copy()
+    for i in range(1, block_size):
+        np.minimum(block_min, row_min[:, :, i], out=block_min)
+        np.maximum(block_max, row_max[:, :, i], out=block_max)
     
-    # Check if all pixels are within tolerance of reference
-    diff = np.abs(block - reference)
-    return np.all(diff <= tolerance)
+    reference = cropped[::block_size, ::block_size]
+    return block_min, block_max, reference
 
-def process_picture_internal(image: Image.Image, output_path: Path, og_width: int, og_height: int, constrast: float, saturation: float, dither: Image.Dither, colors: int, palette: Optional[ImagePalette] = None):
+def _apply_contrast(image: Image.Image, name: str, constrast: float, mean: Optional[int] = None) -> Tuple[Image.Image, str]:
     if constrast != 1.0:
-        output_path = output_path.with_name(f"{output_path.stem}_C{constrast}{output_path.suffix}")
-        contrast_enhancer = ImageEnhance.Contrast(image)
-        image = contrast_enhancer.enhance(constrast)
+        name = f"{name}_C{constrast}"
+        with stage('contrast'):
+            if mean is None:
+                contrast_enhancer = ImageEnhance.Contrast(image)
+                image = contrast_enhancer.enhance(constrast)
+            else:
+                # Same blend as ImageEnhance.Contrast, around a mean gray measured on the whole image
+                degenerate = Image.new("L", image.size, mean).convert(image.mode)
+                image = Image.blend(degenerate, image, constrast)
+    return image, name
+
+def _apply_saturation(image: Image.Image, name: str, saturation: float) -> Tuple[Image.Image, str]:
     if saturation != 1.0:
-        output_path = output_path.with_name(f"{output_path.stem}_S{saturation}{output_path.suffix}")
-        saturation_enhancer = ImageEnhance.Color(image)
-        image = saturation_enhancer.enhance(saturation)
-    output_path = output_path.with_name(f"{output_path.stem}_D{dither.name}{output_path.suffix}")
+        name = f"{name}_S{saturation}"
+        with stage('saturation'):
+            saturation_enhancer = ImageEnhance.Color(image)
+            image = saturation_enhancer.enhance(saturation)
+    return image, name
+
+def _apply_enhancement(enhancer: ColorEnhancer, name: str, constrast: float, saturation: float) -> Tuple[Image.Image, str]:
+    """Contrast then saturation from a ColorEnhancer, named like _apply_contrast and _apply_saturation"""
+    if constrast != 1.0:
+        name = f"{name}_C{constrast}"
+    if saturation != 1.0:
+        name = f"{name}_S{saturation}"
+    with stage('enhance'):
+        return enhancer.enhance(constrast, saturation), name
+
+def _apply_palette(image: Image.Image, name: str, dither: Dither, palette: Optional[ImagePalette], mapper: Optional[PaletteMapper] = None, origin: Tuple[int, int] = (0, 0), prepared: Any = None) -> Tuple[Image.Image, str]:
+    name = f"{name}_D{dither.name}"
     if palette:
-        output_path = output_path.with_name(f"{output_path.stem}_P{palette.name}{output_path.suffix}")
-        image = image.quantize(palette=palette.image, dither=dither)
-        palette_colors = palette.image.getcolors()
-        colors = len(palette_colors) if palette_colors and not colors else colors
+        name = f"{name}_P{palette.name}"
+        mapper = mapper or PaletteMapper()
+        if mapper.quantizer != 'pillow' and dither == Image.Dither.FLOYDSTEINBERG:
+            # Dither against the exact palette colors rather than Pillow's palette image
+            dither = DitherMethod.FLOYDSTEINBERG
+        with stage('palette'):
+            if isinstance(dither, DitherMethod):
+                image = dither_image(image, palette.colors, dither, mapper.metric, mapper.memory_budget, origin)
+            elif mapper.quantizer != 'pillow':
+                image = mapper.map(image, palette.colors if prepared is None else prepared)
+            else:
+                image = image.quantize(palette=palette.image, dither=dither)
     else:
-        image = image.quantize(dither=dither)
+        # Adaptive quantization ignores dithering
+        with stage('quantize'):
+            image = image.quantize(dither=Image.Dither.NONE)
+    return image, name
+
+def _palette_color_count(colors: int, palette: Optional[ImagePalette], mapper: Optional[PaletteMapper] = None) -> int:
+    # Without an explicit color count, a palette limits colors to its own size
+    if palette and not colors:
+        if mapper and mapper.quantizer != 'pillow':
+            return len(set(palette.colors))
+        palette_colors = palette.image.getcolors()
+        return len(palette_colors) if palette_colors else colors
+    return colors
+
+def _apply_colors(image: Image.Image, name: str, colors: int, reference_palettes: Optional[Dict[str, Image.Image]] = None) -> Tuple[Image.Image, str]:
     if colors and colors > 0:
-        output_path = output_path.with_name(f"{output_path.stem}_{colors}{output_path.suffix}")
-        image = image.quantize(colors=colors).convert('RGB')
-    
+        name = f"{name}_{colors}"
+        with stage('colors'):
+            if reference_palettes is not None and name in reference_palettes:
+                # Reuse the colors picked for an earlier frame so they do not flicker
+                image = image.convert('RGB').quantize(palette=reference_palettes[name], dither=Image.Dither.NONE)
+            elif reference_palettes is None and image.getcolors(colors) is not None:
+                # Median cut keeps every color of an image that already has at most colors of them
+                pass
+            else:
+                image = image.quantize(colors=colors)
+                if reference_palettes is not None:
+                    reference_palettes[name] = image
+            image = image.convert('RGB')
+    return image, name
+
+def permutation_path(output_path: Path, name: str) -> Path:
+    """Output path of a permutation: output_path with the permutation name appended to its stem"""
+    return output_path.with_name(f"{output_path.stem}{name}{output_path.suffix}")
+
+def _downscaled_path(output_path: Path) -> Path:
+    return output_path.with_name(f"{output_path.stem}_downscaled{output_path.suffix}")
+
+def write_image(image: Image.Image, target: Union[Path, BinaryIO], size: Optional[Tuple[int, int]] = None, format: Optional[str] = None, compress_level: int = 6, optimize: bool = False, strategy: Optional[str] = None, indexed: bool = False, original_size: Optional[Tuple[int, int]] = None):
+    """
+    Save an image to a path or binary file, enlarged to size with nearest neighbor.
+
+    format defaults to the path extension. When size is an integer multiple
+    of the image size, PNG output replicates palette indices straight into
+    an indexed PNG instead of building the enlarged RGB image. compress_level
+    (0-9), optimize, the zlib strategy and indexed are applied as described
+    in encoding.save_options, which also writes WebP losslessly; the
+    integer-scale path streams rows and ignores optimize. QOI is encoded by
+    encoding.encode_qoi, much faster than Pillow's pure Python encoder.
+    original_size records the size a downscaled image was made from as
+    metadata, read back by encoding.read_original_size.
+    """
+    kind = (format or Path(getattr(target, 'name', target)).suffix.lstrip('.')).lower()
+    if size and size != image.size:
+        scale = integer_scale(image.size, size)
+        indices = palette_indices(image) if scale and kind == 'png' else None
+        if indices:
+            save_scaled_png(*indices, target, scale, compress_level, strategy)
+            return
+        # Upscale back to original size using nearest neighbor
+        image = image.resize(size, Image.Resampling.NEAREST)
+    if kind == 'qoi':
+        save_qoi(image, target)
+        return
+    metadata = original_size_metadata(image.size, original_size) if original_size else None
+    image, options = save_options(image, kind, compress_level, optimize, strategy, indexed, metadata)
+    image.save(target, format=format, **options)
+
+def encode_image(image: Image.Image, format: str = 'png', size: Optional[Tuple[int, int]] = None, **save_options: Any) -> bytes:
+    """Encoded bytes of an image, enlarged to size like write_image"""
+    output = io.BytesIO()
+    if save_options:
+        if size and size != image.size:
+            image = image.resize(size, Image.Resampling.NEAREST)
+        image.save(output, format=format, **save_options)
+    else:
+        write_image(image, output, size, format)
+    return output.getvalue()
+
+def _save_outputs(image: Image.Image, output_path: Path, og_width: int, og_height: int, save_downscaled: bool = True, save_full_size: bool = True, compress_level: int = 6, optimize: bool = False, png_strategy: Optional[str] = None, indexed: bool = False, scale_metadata: bool = False) -> List[Path]:
+    """Save the requested outputs of a processed image, returning the written paths"""
+    written = []
     # Save the downscaled processed version
-    downscaled_output_path = output_path.with_name(f"{output_path.stem}_downscaled{output_path.suffix}")
-    image.save(downscaled_output_path)
+    if save_downscaled:
+        with stage('save_downscaled'):
+            write_image(image, _downscaled_path(output_path), None, None, compress_level, optimize, png_strategy, indexed, (og_width, og_height) if scale_metadata else None)
+        written.append(_downscaled_path(output_path))
+    if save_full_size:
+        with stage('save_full_size'):
+            write_image(image, output_path, (og_width, og_height), None, compress_level, optimize, png_strategy, indexed)
+        written.append(output_path)
+    return written
+
+def process_picture_internal(image: Image.Image, output_path: Path, og_width: int, og_height: int, constrast: float, saturation: float, dither: Dither, colors: int, palette: Optional[ImagePalette] = None, mapper: Optional[PaletteMapper] = None, save_downscaled: bool = True, save_full_size: bool = True):
+    image, name = _apply_contrast(image, '', constrast)
+    image, name = _apply_saturation(image, name, saturation)
+    image, name = _apply_palette(image, name, dither, palette, mapper)
+    image, name = _apply_colors(image, name, _palette_color_count(colors, palette, mapper))
+    _save_outputs(image, permutation_path(output_path, name), og_width, og_height, save_downscaled, save_full_size)
+
+def _batched_palettes(image: Image.Image, dither: Dither, palettes_list: List[Optional[ImagePalette]], mapper: Optional[PaletteMapper]) -> Dict[int, Image.Image]:
+    """
+    Undithered results of every palette, by position in palettes_list, when mapping them together pays off.
+
+    The lut and numpy quantizers match each color on its own, so images with
+    few distinct colors match them once for all palettes (atlas.apply_palettes).
+    Pillow's cached per-pixel mapping is faster on its own.
+    """
+    positions = [i for i, palette in enumerate(palettes_list) if palette]
+    if dither != Image.Dither.NONE or len(positions) < 2 or not mapper or mapper.quantizer == 'pillow':
+        return {}
+    if not has_few_colors(np.asarray(image.convert('RGB'))):
+        return {}
+    with stage('palette'):
+        variants = apply_palettes(image, [palettes_list[i] for i in positions], mapper)
+    return dict(zip(positions, variants))
+
+def iter_permutations(image: Image.Image, contrasts: List[float], saturations: List[float], dithers: List[Dither], colors_list: List[int], palettes_list: List[Optional[ImagePalette]], mapper: Optional[PaletteMapper] = None, reference_palettes: Optional[Dict[str, Image.Image]] = None, contrast_mean: Optional[int] = None, origin: Tuple[int, int] = (0, 0)) -> Iterator[Tuple[Dict[str, Any], Image.Image]]:
+    """
+    Yield the parameters and processed image of every permutation.
+    
+    Permutations are evaluated as a tree (contrast -> saturation -> palette
+    -> colors) so each shared prefix is computed once and its result reused
+    by all the permutations below it. The parameters are the contrast,
+    saturation, dither, palette name and resulting color count (0 when the
+    colors are not reduced), and the name suffix of the permutation's files.
     
-    # Upscale back to original size using nearest neighbor
-    image = image.resize((og_width, og_height), Image.Resampling.NEAREST)
-    image.save(output_path)
+    reference_palettes, when given, keeps the colors chosen by the color
+    count reduction of each permutation and reuses them for later images.
+    contrast_mean and origin let image be one tile of a larger image: the
+    mean gray of the whole image for contrast, and the tile position for
+    ordered dithering.
+    """
+    job = CompiledJob(None, dithers, colors_list, saturations, contrasts, palettes_list, mapper=mapper)
+    yield from job.permutations(image, reference_palettes, contrast_mean, origin)
 
-def process_picture(input_path: Path, output_path: Path, downscale_width_resolution: int, dither: int, colors: Optional[List[int]] = None, saturation: Optional[List[float]] = None, constrast: Optional[List[float]] = None, palettes: Optional[List[ImagePalette]] = None, auto_detect_pixel_size: bool = False):
-    # Get the input image
-    image = Image.open(input_path).convert('RGB')
-    og_width, og_height = image.size
+class CompiledJob:
+    """
+    Processing parameters prepared once for many images.
+
+    Everything that does not depend on the image is worked out up front:
+    the permutation lists, the palette mapper, the color count of every
+    palette and color count pair (Pillow counts the colors of the palette
+    image) and the palette data the quantizer matches against (the lookup
+    table of 'lut', the color array of 'numpy'). Contrast and saturation
+    blend with a gray mean or grayscale copy of each image, so they are
+    still computed per image: with ImageEnhance for enhancer='pillow', or
+    by an enhance.ColorEnhancer for 'numpy', which gives the same pixels
+    and enhances only the distinct colors of images with few of them.
+
+    apply() processes an image like process_image and permutations() runs
+    the permutation tree of iter_permutations on an already downscaled
+    image. downscale_width_resolution can be None for a job only used
+    through permutations().
+    """
+
+    def __init__(self, downscale_width_resolution: Optional[int], dither: Union[int, Sequence[Dither]], colors: Optional[List[int]] = None, saturation: Optional[List[float]] = None, constrast: Optional[List[float]] = None, palettes: Optional[Sequence[Optional[ImagePalette]]] = None, auto_detect_pixel_size: bool = False, mapper: Optional[PaletteMapper] = None, downscale: str = 'nearest', enhancer: str = 'pillow', detect_samples: int = 0):
+        if enhancer not in ENHANCERS:
+            raise ValueError(f"Unknown enhancer '{enhancer}', expected one of {', '.join(ENHANCERS)}")
+        self.downscale_width_resolution = downscale_width_resolution
+        self.auto_detect_pixel_size = auto_detect_pixel_size
+        self.detect_samples = detect_samples
+        self.downscale = downscale
+        self.enhancer = enhancer
+        self.mapper = mapper or PaletteMapper()
+        self.contrasts = list(constrast) if constrast else [1.0]
+        self.saturations = list(saturation) if saturation else [1.0]
+        self.dithers = _dither_list(dither)
+        self.colors_list = list(colors) if colors else [0]
+        self.palettes_list = list(palettes) if palettes else [None]
+        with stage('compile'):
+            # Color count of every palette (rows) and requested color count (columns)
+            self.color_counts = [[_palette_color_count(colors_val, palette, self.mapper) for colors_val in self.colors_list] for palette in self.palettes_list]
+            # Pillow matches against the palette image itself
+            self.prepared = [self.mapper.prepare(palette.colors) if palette and self.mapper.quantizer != 'pillow' else None for palette in self.palettes_list]
+
+    def permutations(self, image: Image.Image, reference_palettes: Optional[Dict[str, Image.Image]] = None, contrast_mean: Optional[int] = None, origin: Tuple[int, int] = (0, 0)) -> Iterator[Tuple[Dict[str, Any], Image.Image]]:
+        """Parameters and processed image of every permutation of a downscaled image, see iter_permutations"""
+        enhanced = any(c != 1.0 for c in self.contrasts) or any(s != 1.0 for s in self.saturations)
+        enhancer = ColorEnhancer(image, contrast_mean) if self.enhancer == 'numpy' and enhanced else None
+        for contrast_val in self.contrasts:
+            if enhancer is None:
+                contrast_image, contrast_name = _apply_contrast(image, '', contrast_val, contrast_mean)
+            for saturation_val in self.saturations:
+                if enhancer is None:
+                    saturation_image, saturation_name = _apply_saturation(contrast_image, contrast_name, saturation_val)
+                else:
+                    saturation_image, saturation_name = _apply_enhancement(enhancer, '', contrast_val, saturation_val)
+                # Quantizing without a palette ignores dithering, so it is shared by all dithers
+                adaptive_image = None
+                for dither_val in self.dithers:
+                    batched = _batched_palettes(saturation_image, dither_val, self.palettes_list, self.mapper)
+                    for palette_index, palette_val in enumerate(self.palettes_list):
+                        if palette_index in batched:
+                            palette_image = batched[palette_index]
+                            palette_name = f"{saturation_name}_D{dither_val.name}_P{palette_val.name}"
+                        elif palette_val:
+                            palette_image, palette_name = _apply_palette(saturation_image, saturation_name, dither_val, palette_val, self.mapper, origin, self.prepared[palette_index])
+                        else:
+                            if adaptive_image is None:
+                                adaptive_image, _ = _apply_palette(saturation_image, saturation_name, dither_val, None)
+                            palette_image = adaptive_image
+                            palette_name = f"{saturation_name}_D{dither_val.name}"
+                        for color_count in self.color_counts[palette_index]:
+                            processed_image, name = _apply_colors(palette_image, palette_name, color_count, reference_palettes)
+                            params = {
+                                'contrast': contrast_val,
+                                'saturation': saturation_val,
+                                'dither': dither_val,
+                                'palette': palette_val.name if palette_val else None,
+                                'colors': color_count if color_count and color_count > 0 else 0,
+                                'name': name,
+                            }
+                            yield params, processed_image
+
+    def apply(self, image: Union[Image.Image, np.ndarray], reference_palettes: Optional[Dict[str, Image.Image]] = None) -> Iterator[Tuple[Dict[str, Any], Image.Image]]:
+        """Downscale, enhance and quantize an in-memory image, yielding every permutation like process_image"""
+        if isinstance(image, np.ndarray):
+            image = Image.fromarray(image)
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        og_size = image.size
+        
+        # Downscale the image
+        downscale_size = _downscale_size(image, self.downscale_width_resolution, self.auto_detect_pixel_size, detect_samples=self.detect_samples)
+        with stage('downscale'):
+            image = downscale_image(image, downscale_size, self.downscale)
+        for params, processed_image in self.permutations(image, reference_palettes):
+            params['size'] = og_size
+            yield params, processed_image
+
+def compile_job(options: Dict[str, Any], palettes: Optional[List[ImagePalette]] = None, constrast: Optional[List[float]] = None, saturation: Optional[List[float]] = None) -> CompiledJob:
+    """CompiledJob for process_picture keyword options, as shared by every task of a batch"""
+    mapper = PaletteMapper(
+        options.get('quantizer', 'pillow'), options.get('metric', 'rgb'),
+        options.get('lut_bits', 6), options.get('memory_budget', DEFAULT_MEMORY_BUDGET)
+    )
+    return CompiledJob(
+        options['downscale_width_resolution'], options['dither'], options.get('colors'), saturation, constrast,
+        palettes, options.get('auto_detect_pixel_size', False), mapper, options.get('downscale', 'nearest'),
+        options.get('enhancer', 'pillow'), options.get('detect_samples', 0)
+    )
+
+def _dither_list(dither: Union[int, Sequence[Dither]]) -> List[Dither]:
+    """Dithers to apply: 0 for none, 1 for Floyd-Steinberg, 2 for both, or an explicit list"""
+    if isinstance(dither, int):
+        return [Image.Dither.FLOYDSTEINBERG, Image.Dither.NONE] if dither == 2 else [Image.Dither.NONE] if dither == 0 else [Image.Dither.FLOYDSTEINBERG]
+    return list(dither) if dither else [Image.Dither.NONE]
+
+def _downscale_size(image: Optional[Image.Image], downscale_width_resolution: int, auto_detect_pixel_size: bool = False, og_size: Optional[Tuple[int, int]] = None, detect_samples: int = 0) -> Tuple[int, int]:
+    """
+    Size to downscale an image to, keeping its aspect ratio; og_size overrides the size of image when it is only a sample.
+
+    detect_samples > 0 detects the pixel size from that many random blocks
+    per size at most (see detect.detect_pixel_size_sampled) instead of all.
+    """
+    og_width, og_height = og_size or image.size
     
     # Auto-detect pixel size if requested
     if auto_detect_pixel_size:
-        detected_size = detect_pixel_size(image)
+        with stage('detect'):
+            if detect_samples:
+                from detect import detect_pixel_size_sampled
+                detected_size = detect_pixel_size_sampled(image, samples=detect_samples)['pixel_size']
+            else:
+                detected_size = detect_pixel_size(image)
         if detected_size > 1:
             # Adjust downscale resolution based on detected pixel size
             downscale_width_resolution = og_width // detected_size
             print(f"Detected pixel size: {detected_size}x{detected_size}, adjusting resolution to {downscale_width_resolution}x{og_height // detected_size}")
     
-    # Downscale the image
     downscale_ratio = downscale_width_resolution / og_width
-    new_height = int(og_height * downscale_ratio)
-    image = image.resize((downscale_width_resolution, new_height), Image.Resampling.NEAREST)
-    contrasts = constrast if constrast else [1.0]
-    saturations = saturation if saturation else [1.0]
-    dithers = [Image.Dither.FLOYDSTEINBERG, Image.Dither.NONE] if dither == 2 else [Image.Dither.NONE] if dither == 0 else [Image.Dither.FLOYDSTEINBERG]
-    colors_list = colors if colors else [0]
-    palettes_list = palettes if palettes else [None]
-    # Generate all permutations (Cartesian product) of the lists
-    all_permutations = itertools.product(contrasts, saturations, dithers, colors_list, palettes_list)
-    for contrast_val, saturation_val, dither_val, colors_val, palette_val in all_permutations:
-        process_picture_internal(image.copy(), output_path, og_width, og_height, contrast_val, saturation_val, dither_val, colors_val, palette_val)
+    return downscale_width_resolution, int(og_height * downscale_ratio)
+
+def process_picture(input_path: Path, output_path: Path, downscale_width_resolution: int, dither: Union[int, Sequence[Dither]], colors: Optional[List[int]] = None, saturation: Optional[List[float]] = None, constrast: Optional[List[float]] = None, palettes: Optional[List[ImagePalette]] = None, auto_detect_pixel_size: bool = False, quantizer: str = 'pillow', lut_bits: int = 6, metric: str = 'rgb', memory_budget: int = DEFAULT_MEMORY_BUDGET, stable_colors: bool = True, frame_duration: int = 100, tiled: bool = False, save_downscaled: bool = True, save_full_size: bool = True, downscale: str = 'nearest', compress_level: int = 6, optimize: bool = False, enhancer: str = 'pillow', png_strategy: Optional[str] = None, indexed: bool = False, scale_metadata: bool = False, detect_samples: int = 0, job: Optional[CompiledJob] = None) -> List[Path]:
+    """
+    Downscale, enhance and quantize an image, saving every permutation.
+
+    With quantizer='lut' or 'numpy', undithered palette mapping matches the
+    exact palette colors under metric, through a cached lookup table of
+    lut_bits bits per channel or a direct search whose distance matrices
+    stay within memory_budget bytes.
+
+    dither is 0 (none), 1 (Floyd-Steinberg) or 2 (both), or a list of
+    Image.Dither and DitherMethod values. DitherMethod dithers and, with
+    the lut and numpy quantizers, Floyd-Steinberg use the exact palette
+    colors and metric; dithering only applies when a palette is given.
+
+    Animated inputs, and directories of frames, are handed to
+    animation.process_animation, which uses stable_colors and frame_duration.
+    With tiled, single images go to tiling.process_picture_tiled, which reads
+    and writes in strips so memory use stays close to memory_budget.
+
+    downscale is one of downscale.DOWNSCALE_METHODS: 'nearest' sampling,
+    or a per-block 'mean', 'median', 'mode' (majority color) or 'edge'
+    reduction, exact for integer ratios such as detected pixel sizes.
+
+    enhancer is 'pillow' (ImageEnhance) or 'numpy' (enhance.ColorEnhancer)
+    for contrast and saturation; both give the same pixels.
+
+    With auto_detect_pixel_size, detect_samples > 0 estimates the pixel
+    size from at most that many random blocks per candidate size (see
+    detect.detect_pixel_size_sampled) instead of testing every block.
+
+    save_downscaled and save_full_size choose which of the two outputs of
+    every permutation are written. When the original size is an integer
+    multiple of the downscaled one, PNG full-size outputs are written as
+    indexed PNGs by replicating palette indices. compress_level, optimize,
+    png_strategy (an encoding.PNG_STRATEGIES name) and indexed set how PNG
+    outputs are encoded, and WebP outputs are lossless; the output format
+    follows the suffix of output_path. scale_metadata records the original
+    size in downscaled PNG and WebP outputs, so consumers can upscale a
+    downscaled-only run themselves.
+
+    Still images are processed in memory by process_image, and each result
+    saved with write_image. job is these parameters compiled beforehand
+    (see compile_job) so a batch prepares its palettes once instead of per
+    image. Returns the paths of all the files written.
+    """
+    mapper = job.mapper if job else PaletteMapper(quantizer, metric, lut_bits, memory_budget)
+    if tiled and not input_path.is_dir():
+        from tiling import process_picture_tiled
+        return process_picture_tiled(input_path, output_path, downscale_width_resolution, dither, colors, saturation, constrast, palettes, auto_detect_pixel_size, mapper, save_downscaled, save_full_size, downscale, compress_level, enhancer, png_strategy, scale_metadata, detect_samples)
+    # Get the input image
+    with stage('decode'):
+        image = None if input_path.is_dir() else Image.open(input_path)
+    if image is None or getattr(image, 'is_animated', False):
+        if image is not None:
+            image.close()
+        from animation import process_animation
+        return process_animation(input_path, output_path, downscale_width_resolution, dither, colors, saturation, constrast, palettes, auto_detect_pixel_size, mapper, stable_colors, frame_duration, save_downscaled, save_full_size, downscale, enhancer, detect_samples)
+    with stage('decode'):
+        image = image.convert('RGB')
+    og_width, og_height = image.size
+    
+    # Evaluate all permutations (Cartesian product) of the lists, sharing common stages
+    written = []
+    job = job or CompiledJob(downscale_width_resolution, dither, colors, saturation, constrast, palettes, auto_detect_pixel_size, mapper, downscale, enhancer, detect_samples)
+    for params, processed_image in job.apply(image):
+        written.extend(_save_outputs(processed_image, permutation_path(output_path, params['name']), og_width, og_height, save_downscaled, save_full_size, compress_level, optimize, png_strategy, indexed, scale_metadata))
+    return written
+
+def process_image(image: Union[Image.Image, np.ndarray], downscale_width_resolution: int, dither: Union[int, Sequence[Dither]], colors: Optional[List[int]] = None, saturation: Optional[List[float]] = None, constrast: Optional[List[float]] = None, palettes: Optional[List[ImagePalette]] = None, auto_detect_pixel_size: bool = False, mapper: Optional[PaletteMapper] = None, reference_palettes: Optional[Dict[str, Image.Image]] = None, downscale: str = 'nearest', enhancer: str = 'pillow', detect_samples: int = 0) -> Iterator[Tuple[Dict[str, Any], Image.Image]]:
+    """
+    Downscale, enhance and quantize an in-memory image, yielding every permutation.
+
+    image is a PIL image or an (H, W, 3) uint8 array. Results are
+    (params, image) pairs from iter_permutations, with params['size'] set
+    to the original size; the images are downscaled, nothing is encoded or
+    written. Pass an image and params['size'] to write_image or
+    encode_image to get the full-size output. To process many images with
+    the same parameters, build a CompiledJob once and call its apply().
+    detect_samples is used with auto_detect_pixel_size, as in process_picture.
+    """
+    job = CompiledJob(downscale_width_resolution, dither, colors, saturation, constrast, palettes, auto_detect_pixel_size, mapper, downscale, enhancer, detect_samples)
+    yield from job.apply(image, reference_palettes)
 
 def main():
     # Initialize the parser
@@ -157,6 +558,12 @@ def main():
     parser.add_argument('--saturation', nargs='+', type=float, help='Between 0 and infinity, change picture saturation before processing', default=None)
     parser.add_argument('--dither', type=int, help='Apply dithering to the quantized image. 0 for no dithering, 1 for Floyd-Steinberg dithering, 2 for both', default=0)
     parser.add_argument('--auto-detect-pixel-size', action='store_true', help='Automatically detect optimal pixel size from the source image')
+    parser.add_argument('--quantizer', choices=QUANTIZERS, help='Palette mapping engine; lut and numpy match exact palette colors for undithered output', default='pillow')
+    parser.add_argument('--metric', choices=METRICS, help='Color distance used by the lut and numpy quantizers', default='rgb')
+    parser.add_argument('--lut-bits', type=int, choices=[5, 6, 8], help='Bits per channel of the palette lookup table', default=6)
+    parser.add_argument('--no-downscaled', action='store_true', help='Do not save the downscaled version of every output')
+    parser.add_argument('--no-full-size', action='store_true', help='Do not save the output upscaled back to the original size')
+    parser.add_argument('--jobs', type=int, help='Number of worker processes for directory inputs, 0 for one per CPU', default=1)
 
     # Check for list-palettes first
     if '--list-palettes' in sys.argv:
@@ -183,28 +590,31 @@ def main():
     if args.palette:
         if Path(args.palette[0]).is_dir():
             for plt in Path(args.palette[0]).rglob("*.png"):
-                palettes_images.append(ImagePalette(plt.stem, Image.open(plt).convert(mode="P", palette=Image.Palette.WEB)))
+                palettes_images.append(load_image_palette(plt))
         else:
             for plt in args.palette:
                 # Check if it's a built-in palette first
                 if plt.lower() in palette_collection.list_palettes():
                     palette_img = palette_collection.create_palette_image(plt.lower())
-                    palettes_images.append(ImagePalette(plt.lower(), palette_img))
+                    palettes_images.append(ImagePalette(plt.lower(), palette_img, palette_collection.get_palette(plt.lower())))
                 else:
                     # Treat as file path
-                    palettes_images.append(ImagePalette(Path(plt).stem, Image.open(plt).convert(mode="P", palette=Image.Palette.WEB)))
+                    palettes_images.append(load_image_palette(Path(plt)))
     input_path = Path(args.input)
     output_path = Path(args.output)
     if input_path.is_dir():
         if not output_path.is_dir():
             print("If input is a directory, output must also be a directory")
             sys.exit(1)
-        for ipt in Path(args.input).rglob("*.png"):
-            process_picture(ipt, output_path / ipt.name, args.twr, args.dither, args.colors, args.saturation, args.constrast, palettes_images, args.auto_detect_pixel_size)
+        from batch import make_tasks, process_batch
+        tasks = make_tasks([(ipt, output_path / ipt.name) for ipt in Path(args.input).rglob("*.png")], args.constrast, args.saturation)
+        for (ipt, _, _, _), error, _ in process_batch(tasks, palettes_images, jobs=args.jobs, downscale_width_resolution=args.twr, dither=args.dither, colors=args.colors, auto_detect_pixel_size=args.auto_detect_pixel_size, quantizer=args.quantizer, lut_bits=args.lut_bits, metric=args.metric, save_downscaled=not args.no_downscaled, save_full_size=not args.no_full_size):
+            if error:
+                print(f"Failed to process {ipt}: {error}")
     else:
         if output_path.is_dir():
             output_path = output_path / input_path.name
-        process_picture(input_path, output_path, args.twr, args.dither, args.colors, args.saturation, args.constrast, palettes_images, args.auto_detect_pixel_size)
+        process_picture(input_path, output_path, args.twr, args.dither, args.colors, args.saturation, args.constrast, palettes_images, args.auto_detect_pixel_size, args.quantizer, args.lut_bits, args.metric, save_downscaled=not args.no_downscaled, save_full_size=not args.no_full_size)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
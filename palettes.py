@@ -1,44 +1,119 @@
-from PIL import Image
-from typing import Dict, List, Tuple, Any
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple, Any
+import hashlib
+import json
 import yaml
 from pathlib import Path
+from cache import atomic_write, get_cache_dir
+from profiling import stage
+
+if TYPE_CHECKING:
+    from PIL import Image
+
+# Use libyaml's C parser when PyYAML was built with it
+YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+# Bump when the layout of the cached palette index changes
+INDEX_VERSION = 2
 
 class PaletteCollection:
     """Collection of well-known pixel art color palettes"""
     
-    def __init__(self):
-        self.palettes = self._load_palettes_from_yaml()
+    def __init__(self, palettes_dir: Optional[Path] = None, use_cache: bool = True):
+        self.palettes_dir = palettes_dir or Path(__file__).parent / "palettes"
+        self.use_cache = use_cache
+        # Colors by palette name, loaded on first access
+        self._colors: Dict[str, List[Tuple[int, int, int]]] = {}
+        # Palette name -> index entry with its file, metadata and color count
+        with stage('palette_index'):
+            self._index = self._load_index()
+    
+    @property
+    def palettes(self) -> Dict[str, List[Tuple[int, int, int]]]:
+        """All palettes by name"""
+        return {name: self.get_palette(name) for name in self._index}
     
-    def _load_palettes_from_yaml(self) -> Dict[str, List[Tuple[int, int, int]]]:
-        """Load color palettes from YAML files"""
-        palettes = {}
-        palettes_dir = Path(__file__).parent / "palettes"
+    def _index_cache_path(self) -> Path:
+        """Index file for this palettes directory in the on-disk cache"""
+        key = hashlib.sha256(str(self.palettes_dir.resolve()).encode()).hexdigest()[:16]
+        return get_cache_dir() / f"palette_index_{key}.json"
+    
+    def _load_index(self) -> Dict[str, Dict[str, Any]]:
+        """
+        Index the palette YAML files.
         
-        if not palettes_dir.exists():
+        Names and metadata of parsed files are kept in a JSON index in the
+        cache directory. A file is only parsed again when its modification
+        time or size changes, so a warm start reads one JSON file and stats
+        each YAML file; colors are read from a palette's file when it is
+        first used (see get_palette).
+        """
+        if not self.palettes_dir.exists():
             # Fallback to hardcoded palettes if directory doesn't exist
-            return self._get_fallback_palettes()
+            return self._fallback_index()
+        
+        cached_files = self._read_index_cache() if self.use_cache else {}
+        files = {}
+        for yaml_file in sorted(self.palettes_dir.glob("*.yaml")):
+            stat = yaml_file.stat()
+            entry = cached_files.get(yaml_file.name)
+            if not entry or entry['mtime_ns'] != stat.st_mtime_ns or entry['size'] != stat.st_size:
+                entry = self._parse_palette_file(yaml_file)
+                if entry is None:
+                    continue
+                # Keep the colors just parsed instead of reading the file again
+                self._colors[entry['name'].lower()] = [tuple(color) for color in entry.pop('colors')]
+                entry.update(mtime_ns=stat.st_mtime_ns, size=stat.st_size)
+            files[yaml_file.name] = entry
         
-        for yaml_file in palettes_dir.glob("*.yaml"):
-            try:
-                with open(yaml_file, 'r') as f:
-                    palette_data = yaml.safe_load(f)
-                
-                name = palette_data.get('name', yaml_file.stem)
-                colors = palette_data.get('colors', [])
-                
-                # Convert colors to tuples
-                color_tuples = [tuple(color) for color in colors]
-                palettes[name] = color_tuples
-                
-            except Exception as e:
-                print(f"Warning: Could not load palette from {yaml_file}: {e}")
-                continue
+        if self.use_cache and files != cached_files:
+            self._write_index_cache(files)
         
+        index = {entry['name']: entry for entry in files.values()}
         # If no palettes were loaded, use fallback
-        if not palettes:
-            return self._get_fallback_palettes()
+        return index or self._fallback_index()
+    
+    def _parse_palette_file(self, yaml_file: Path) -> Optional[Dict[str, Any]]:
+        """Parse one palette YAML file into an index entry"""
+        try:
+            with open(yaml_file, 'r') as f:
+                palette_data = yaml.load(f, Loader=YamlLoader)
             
-        return palettes
+            metadata = {key: value for key, value in palette_data.items() if key != 'colors'}
+            colors = [list(color) for color in palette_data.get('colors', [])]
+            return {
+                "name": palette_data.get('name', yaml_file.stem),
+                "file": yaml_file.name,
+                "metadata": metadata,
+                "color_count": len(colors),
+                "colors": colors
+            }
+        except Exception as e:
+            print(f"Warning: Could not load palette from {yaml_file}: {e}")
+            return None
+    
+    def _read_index_cache(self) -> Dict[str, Dict[str, Any]]:
+        try:
+            with open(self._index_cache_path(), 'r') as f:
+                cached = json.load(f)
+            if cached.get('version') == INDEX_VERSION and cached.get('palettes_dir') == str(self.palettes_dir.resolve()):
+                return cached['files']
+        except (OSError, ValueError, KeyError):
+            pass
+        return {}
+    
+    def _write_index_cache(self, files: Dict[str, Dict[str, Any]]):
+        cached = {'version': INDEX_VERSION, 'palettes_dir': str(self.palettes_dir.resolve()), 'files': files}
+        try:
+            atomic_write(self._index_cache_path(), lambda f: f.write(json.dumps(cached, default=str).encode()))
+        except OSError:
+            # The index is only a cache; the YAML files are parsed again next time
+            pass
+    
+    def _fallback_index(self) -> Dict[str, Dict[str, Any]]:
+        return {
+            name: {"name": name, "metadata": {}, "color_count": len(colors), "colors": colors}
+            for name, colors in self._get_fallback_palettes().items()
+        }
     
     def _get_fallback_palettes(self) -> Dict[str, List[Tuple[int, int, int]]]:
         """Fallback palettes if YAML files cannot be loaded"""
@@ -74,14 +149,33 @@ class PaletteCollection:
     
     def get_palette(self, name: str) -> List[Tuple[int, int, int]]:
         """Get a palette by name"""
-        return self.palettes.get(name.lower(), [])
+        name = name.lower()
+        if name not in self._colors:
+            entry = self._index.get(name)
+            if not entry:
+                return []
+            with stage('palette_load'):
+                colors = entry['colors'] if 'colors' in entry else self._read_palette_colors(entry['file'])
+                self._colors[name] = [tuple(color) for color in colors]
+        return self._colors[name]
+    
+    def _read_palette_colors(self, file_name: str) -> List[List[int]]:
+        """Colors of one palette YAML file, empty when it can no longer be read"""
+        try:
+            with open(self.palettes_dir / file_name, 'r') as f:
+                return (yaml.load(f, Loader=YamlLoader) or {}).get('colors', [])
+        except Exception as e:
+            print(f"Warning: Could not load palette from {self.palettes_dir / file_name}: {e}")
+            return []
     
     def list_palettes(self) -> List[str]:
         """List all available palette names"""
-        return list(self.palettes.keys())
+        return list(self._index.keys())
     
-    def create_palette_image(self, name: str) -> Image.Image:
+    def create_palette_image(self, name: str) -> 'Image.Image':
         """Create a PIL Image from a palette"""
+        # Imported here so listing palettes does not load Pillow
+        from PIL import Image
         colors = self.get_palette(name)
         if not colors:
             raise ValueError(f"Palette '{name}' not found")
@@ -91,10 +185,12 @@ class PaletteCollection:
         img.putdata(colors)
         return img.convert('P')
     
-    def get_palette_info(self, name: str) -> Dict[str, Any]:
-        """Get information about a palette"""
-        colors = self.get_palette(name)
-        if not colors:
+    def get_palette_info(self, name: str, include_colors: bool = True) -> Dict[str, Any]:
+        """Get information about a palette; without include_colors its colors are not loaded"""
+        name = name.lower()
+        entry = self._index.get(name)
+        colors = self.get_palette(name) if include_colors else None
+        if not entry or not (colors if include_colors else entry['color_count']):
             return {}
         
         # Try to load metadata from YAML file
@@ -102,7 +198,7 @@ class PaletteCollection:
         
         info = {
             "name": name,
-            "color_count": len(colors),
+            "color_count": len(colors) if include_colors else entry['color_count'],
             "colors": colors,
             "description": metadata.get("description", self._get_palette_description(name)),
             "source": metadata.get("source", "Unknown"),
@@ -111,18 +207,9 @@ class PaletteCollection:
         return info
     
     def _load_palette_metadata(self, name: str) -> Dict[str, Any]:
-        """Load metadata for a palette from its YAML file"""
-        palettes_dir = Path(__file__).parent / "palettes"
-        yaml_file = palettes_dir / f"{name}.yaml"
-        
-        if not yaml_file.exists():
-            return {}
-        
-        try:
-            with open(yaml_file, 'r') as f:
-                return yaml.safe_load(f)
-        except Exception:
-            return {}
+        """Metadata for a palette from its YAML file, as recorded in the index"""
+        entry = self._index.get(name)
+        return entry['metadata'] if entry else {}
     
     def _get_palette_description(self, name: str) -> str:
         """Get description for a palette"""
@@ -0,0 +1,217 @@
+"""
+Pipelined batch processing: reader, compute and writer threads connected by bounded queues
+"""
+
+import queue
+import threading
+import traceback
+from PIL import Image
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import profiling
+from batch import BatchTask, task_job
+from palette_swap import ImagePalette, _downscaled_path, permutation_path, process_picture, write_image
+from profiling import stage
+
+# End of stream marker passed along the queues
+_DONE = object()
+
+class _Ticket:
+    """Outputs and error of one task, finished once compute and all its writes are done"""
+
+    def __init__(self, index: int, task: BatchTask):
+        self.index = index
+        self.task = task
+        self.outputs: List[Path] = []
+        self.error: Optional[str] = None
+        # Held by the compute stage until it has queued every write
+        self.pending = 1
+
+class _Stopped(Exception):
+    pass
+
+def _put(target: queue.Queue, item: Any, stop: threading.Event):
+    """Blocking put that gives up once the pipeline is stopped"""
+    while True:
+        if stop.is_set():
+            raise _Stopped()
+        try:
+            target.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            pass
+
+def _get(source: queue.Queue, stop: threading.Event) -> Any:
+    """Blocking get that gives up once the pipeline is stopped"""
+    while True:
+        if stop.is_set():
+            raise _Stopped()
+        try:
+            return source.get(timeout=0.1)
+        except queue.Empty:
+            pass
+
+def process_pipelined(tasks: List[BatchTask], palettes: Optional[List[ImagePalette]] = None, prefetch: int = 4, readers: int = 2, writers: int = 2, ordered: bool = False, show_traceback: bool = False, profile: bool = False, **options: Any) -> Iterator[Tuple[BatchTask, Optional[str], List[Path]]]:
+    """
+    Run tasks like batch.process_batch in one process, overlapping I/O with processing.
+
+    Reader threads open and decode the next prefetch inputs, one compute
+    thread processes them with a CompiledJob (one per set of contrasts and
+    saturations), and writer threads encode and save the results; the
+    stages are connected by bounded queues, so at most
+    prefetch decoded inputs and 2 * writers results wait in memory. Pillow
+    releases the GIL while decoding, compressing and doing file I/O, so
+    these overlap with the NumPy and Pillow work of the compute stage.
+    Directories, animated images and tiled runs are processed by
+    process_picture in the compute thread.
+
+    Yields (task, error, outputs) as tasks finish, or in task order with
+    ordered. options are the process_picture arguments, including the
+    output encoding options (compress_level, optimize, png_strategy, indexed
+    and scale_metadata) used by the writers.
+    """
+    if profile:
+        profiling.enable()
+    # Compiled jobs by (contrasts, saturations), shared by all the tasks
+    jobs = {}
+    compress_level = options.get('compress_level', 6)
+    optimize = options.get('optimize', False)
+    png_strategy = options.get('png_strategy')
+    indexed = options.get('indexed', False)
+    scale_metadata = options.get('scale_metadata', False)
+    save_downscaled = options.get('save_downscaled', True)
+    save_full_size = options.get('save_full_size', True)
+
+    stop = threading.Event()
+    inputs: queue.Queue = queue.Queue()
+    decoded: queue.Queue = queue.Queue(maxsize=max(1, prefetch))
+    writes: queue.Queue = queue.Queue(maxsize=2 * max(1, writers))
+    finished: queue.Queue = queue.Queue()
+    lock = threading.Lock()
+
+    def fail(ticket: _Ticket, error: Exception):
+        detail = traceback.format_exc() if show_traceback else ""
+        with lock:
+            if ticket.error is None:
+                ticket.error = f"{error}\n{detail}".rstrip()
+
+    def release(ticket: _Ticket):
+        with lock:
+            ticket.pending -= 1
+            done = ticket.pending == 0
+        if done:
+            finished.put(ticket)
+
+    def read():
+        # Still images are decoded here; None leaves the input to process_picture
+        try:
+            while True:
+                ticket = inputs.get()
+                if ticket is _DONE:
+                    break
+                image = None
+                input_path = ticket.task[0]
+                try:
+                    with profiling.attribute(str(input_path)), stage('decode'):
+                        if not input_path.is_dir() and not options.get('tiled'):
+                            image = Image.open(input_path)
+                            if getattr(image, 'is_animated', False):
+                                image.close()
+                                image = None
+                            else:
+                                image = image.convert('RGB')
+                except Exception as e:
+                    fail(ticket, e)
+                _put(decoded, (ticket, image), stop)
+            _put(decoded, _DONE, stop)
+        except _Stopped:
+            pass
+
+    def compute():
+        try:
+            remaining = readers
+            while remaining:
+                item = _get(decoded, stop)
+                if item is _DONE:
+                    remaining -= 1
+                    continue
+                ticket, image = item
+                input_path, output_path, contrasts, saturations = ticket.task
+                try:
+                    with profiling.image_scope(str(input_path)):
+                        if ticket.error is not None:
+                            pass
+                        elif image is None:
+                            ticket.outputs.extend(process_picture(
+                                input_path, output_path, saturation=saturations, constrast=contrasts,
+                                palettes=palettes, job=task_job(jobs, options, palettes, contrasts, saturations), **options
+                            ))
+                        else:
+                            job = task_job(jobs, options, palettes, contrasts, saturations)
+                            for params, processed_image in job.apply(image):
+                                path = permutation_path(output_path, params['name'])
+                                if save_downscaled:
+                                    with lock:
+                                        ticket.pending += 1
+                                    _put(writes, (ticket, processed_image, _downscaled_path(path), None, params['size'] if scale_metadata else None), stop)
+                                if save_full_size:
+                                    with lock:
+                                        ticket.pending += 1
+                                    _put(writes, (ticket, processed_image, path, params['size'], None), stop)
+                except _Stopped:
+                    raise
+                except Exception as e:
+                    fail(ticket, e)
+                release(ticket)
+            for _ in range(writers):
+                _put(writes, _DONE, stop)
+        except _Stopped:
+            pass
+
+    def write():
+        try:
+            while True:
+                item = _get(writes, stop)
+                if item is _DONE:
+                    break
+                ticket, image, path, size, original_size = item
+                try:
+                    with profiling.attribute(str(ticket.task[0])), stage('save_full_size' if size else 'save_downscaled'):
+                        write_image(image, path, size, None, compress_level, optimize, png_strategy, indexed, original_size)
+                    with lock:
+                        ticket.outputs.append(path)
+                except Exception as e:
+                    fail(ticket, e)
+                release(ticket)
+        except _Stopped:
+            pass
+
+    tickets = [_Ticket(index, task) for index, task in enumerate(tasks)]
+    for ticket in tickets:
+        inputs.put(ticket)
+    for _ in range(readers):
+        inputs.put(_DONE)
+    threads = [threading.Thread(target=read, daemon=True) for _ in range(readers)]
+    threads.append(threading.Thread(target=compute, daemon=True))
+    threads += [threading.Thread(target=write, daemon=True) for _ in range(writers)]
+    for thread in threads:
+        thread.start()
+
+    try:
+        waiting: Dict[int, _Ticket] = {}
+        next_index = 0
+        for _ in tickets:
+            ticket = finished.get()
+            if not ordered:
+                yield ticket.task, ticket.error, ticket.outputs
+                continue
+            waiting[ticket.index] = ticket
+            while next_index in waiting:
+                ticket = waiting.pop(next_index)
+                next_index += 1
+                yield ticket.task, ticket.error, ticket.outputs
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
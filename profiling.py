@@ -0,0 +1,160 @@
+"""
+Lightweight per-stage timing of the processing pipeline
+"""
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+from typing import Any, ContextManager, Dict, Iterator, List, Optional
+
+# Stage recorded around the whole processing of one image, the parent of the other stages
+IMAGE_STAGE = 'image'
+
+class Profiler:
+    """
+    Collects one event per timed stage: its name, the image being processed,
+    and its start and duration in nanoseconds of a system-wide monotonic
+    clock, so events from worker processes can be merged into one timeline.
+    """
+
+    def __init__(self):
+        self.events: List[Dict[str, Any]] = []
+        # Each thread attributes its stages to its own current image
+        self._local = threading.local()
+
+    @property
+    def image(self) -> Optional[str]:
+        return getattr(self._local, 'image', None)
+
+    @image.setter
+    def image(self, label: Optional[str]):
+        self._local.image = label
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            self.events.append({
+                'name': name,
+                'image': self.image,
+                'start_ns': start,
+                'duration_ns': time.perf_counter_ns() - start,
+                'pid': os.getpid(),
+                'tid': threading.get_ident(),
+            })
+
+    @contextmanager
+    def image_scope(self, label: str) -> Iterator[None]:
+        """Attribute the stages run inside to the image label"""
+        previous, self.image = self.image, label
+        try:
+            with self.stage(IMAGE_STAGE):
+                yield
+        finally:
+            self.image = previous
+
+    @contextmanager
+    def attribute(self, label: str) -> Iterator[None]:
+        """Attribute the stages run inside to the image label, without timing an image"""
+        previous, self.image = self.image, label
+        try:
+            yield
+        finally:
+            self.image = previous
+
+    def drain(self) -> List[Dict[str, Any]]:
+        """Remove and return the recorded events"""
+        events, self.events = self.events, []
+        return events
+
+    def extend(self, events: List[Dict[str, Any]]):
+        self.events.extend(events)
+
+    def stage_summary(self) -> Dict[str, Dict[str, float]]:
+        """Calls, total, mean and max milliseconds of every stage over the run"""
+        summary: Dict[str, Dict[str, float]] = {}
+        for event in self.events:
+            if event['name'] == IMAGE_STAGE:
+                continue
+            stats = summary.setdefault(event['name'], {'calls': 0, 'total_ms': 0.0, 'max_ms': 0.0})
+            duration = event['duration_ns'] / 1e6
+            stats['calls'] += 1
+            stats['total_ms'] += duration
+            stats['max_ms'] = max(stats['max_ms'], duration)
+        for stats in summary.values():
+            stats['mean_ms'] = stats['total_ms'] / stats['calls']
+        return summary
+
+    def image_summary(self) -> Dict[str, Dict[str, float]]:
+        """Milliseconds of every stage, and in total, per image"""
+        summary: Dict[str, Dict[str, float]] = {}
+        for event in self.events:
+            if event['image'] is None:
+                continue
+            stats = summary.setdefault(event['image'], {})
+            name = 'total' if event['name'] == IMAGE_STAGE else event['name']
+            stats[name] = stats.get(name, 0.0) + event['duration_ns'] / 1e6
+        return summary
+
+    def write_json(self, path: Path):
+        """Save the stage and image summaries along with the raw events"""
+        data = {'stages': self.stage_summary(), 'images': self.image_summary(), 'events': self.events}
+        path.write_text(json.dumps(data, indent=1), encoding='utf-8')
+
+    def write_chrome_trace(self, path: Path):
+        """Save the events in the Chrome trace format, viewable in chrome://tracing or Perfetto"""
+        origin = min((event['start_ns'] for event in self.events), default=0)
+        trace = [{
+            'name': event['name'],
+            'cat': 'pxltr',
+            'ph': 'X',
+            'ts': (event['start_ns'] - origin) / 1000,
+            'dur': event['duration_ns'] / 1000,
+            'pid': event['pid'],
+            'tid': event['tid'],
+            'args': {'image': event['image']},
+        } for event in self.events]
+        path.write_text(json.dumps({'traceEvents': trace, 'displayTimeUnit': 'ms'}), encoding='utf-8')
+
+_profiler: Optional[Profiler] = None
+# Shared no-op context returned while profiling is disabled
+_disabled = nullcontext()
+
+def enable() -> Profiler:
+    """Start profiling in this process, keeping the current profiler if there is one"""
+    global _profiler
+    if _profiler is None:
+        _profiler = Profiler()
+    return _profiler
+
+def disable() -> Optional[Profiler]:
+    """Stop profiling, returning the profiler with the recorded events"""
+    global _profiler
+    profiler, _profiler = _profiler, None
+    return profiler
+
+def active() -> Optional[Profiler]:
+    return _profiler
+
+def stage(name: str) -> ContextManager[None]:
+    """Time the enclosed code as a stage; costs a global lookup when profiling is disabled"""
+    if _profiler is None:
+        return _disabled
+    return _profiler.stage(name)
+
+def image_scope(label: str) -> ContextManager[None]:
+    """Attribute the enclosed stages to an image"""
+    if _profiler is None:
+        return _disabled
+    return _profiler.image_scope(label)
+
+def attribute(label: str) -> ContextManager[None]:
+    """Attribute the enclosed stages to an image timed elsewhere, e.g. in another thread"""
+    if _profiler is None:
+        return _disabled
+    return _profiler.attribute(label)
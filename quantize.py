@@ -0,0 +1,242 @@
+"""
+NumPy palette quantization: nearest-color search and cached lookup tables
+"""
+
+import hashlib
+import numpy as np
+from PIL import Image
+from pathlib import Path
+from typing import Dict, Optional, Sequence, Tuple, Union
+from cache import atomic_write, get_cache_dir
+from colorspace import convert_colors
+
+# Bump when the table layout or distance computation changes
+LUT_FORMAT_VERSION = 1
+LUT_BITS = (5, 6, 8)
+METRICS = ('rgb', 'redmean', 'cielab', 'oklab')
+# Upper bound for the temporary distance matrices of one nearest-color search
+DEFAULT_MEMORY_BUDGET = 64 * 1024 * 1024
+# Pixels sampled to decide whether an image has few enough colors to match them once each
+UNIQUE_SAMPLE_SIZE = 4096
+
+def palette_array(colors: Sequence[Tuple[int, int, int]]) -> np.ndarray:
+    """Palette colors as a (K, 3) uint8 array"""
+    array = np.asarray(colors, dtype=np.uint8).reshape(-1, 3)
+    if not 0 < len(array) <= 256:
+        raise ValueError(f"Palettes must have between 1 and 256 colors, got {len(array)}")
+    return array
+
+def nearest_palette_indices(pixels: np.ndarray, palette: np.ndarray, metric: str = 'rgb', memory_budget: int = DEFAULT_MEMORY_BUDGET) -> np.ndarray:
+    """
+    Index of the nearest palette color for every pixel.
+
+    Pixels are matched in chunks sized so the temporary distance matrices stay
+    within memory_budget bytes, whatever the image size.
+
+    Args:
+        pixels: (N, 3) array of RGB values
+        palette: (K, 3) uint8 palette
+        metric: 'rgb' for Euclidean RGB distance, 'redmean' for the low-cost
+                perceptual weighting of RGB differences, 'cielab' or 'oklab'
+                for Euclidean distance in those color spaces
+        memory_budget: Maximum bytes of temporary arrays per chunk
+
+    Returns:
+        (N,) uint8 array of palette indices
+    """
+    if metric not in METRICS:
+        raise ValueError(f"Unknown color metric '{metric}', expected one of {', '.join(METRICS)}")
+
+    pixels = pixels.reshape(-1, 3)
+    space = 'rgb' if metric == 'redmean' else metric
+    palette_f = convert_colors(palette, space)
+    # |c|^2 is the same for every palette entry, so |p|^2 - 2 c.p ranks like |c - p|^2;
+    # in RGB all terms are integers below 2**24 and therefore exact in float32
+    palette_norms = (palette_f ** 2).sum(axis=1)
+    # float32 distance matrix and matmul result per pixel, plus the squared differences for redmean
+    bytes_per_pixel = len(palette) * 4 * (6 if metric == 'redmean' else 2) + 24
+    chunk_size = max(1, memory_budget // bytes_per_pixel)
+    indices = np.empty(len(pixels), dtype=np.uint8)
+    for start in range(0, len(pixels), chunk_size):
+        chunk = convert_colors(pixels[start:start + chunk_size], space)
+        if metric == 'redmean':
+            diff = chunk[:, None, :] - palette_f[None, :, :]
+            diff *= diff
+            mean_red = (chunk[:, None, 0] + palette_f[None, :, 0]) / 2
+            distances = (2 + mean_red / 256) * diff[..., 0] + 4 * diff[..., 1] + (2 + (255 - mean_red) / 256) * diff[..., 2]
+        else:
+            distances = palette_norms - 2 * (chunk @ palette_f.T)
+        indices[start:start + chunk_size] = distances.argmin(axis=1)
+    return indices
+
+def unique_colors(pixels: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Distinct colors of an (..., 3) uint8 array as a (U, 3) array, and the
+    index of every pixel's color among them, shaped like the pixels.
+    """
+    packed = (pixels[..., 0].astype(np.uint32) << 16) | (pixels[..., 1].astype(np.uint32) << 8) | pixels[..., 2]
+    values, inverse = np.unique(packed.ravel(), return_inverse=True)
+    colors = np.stack([values >> 16, (values >> 8) & 0xff, values & 0xff], axis=1).astype(np.uint8)
+    return colors, inverse.reshape(packed.shape)
+
+def has_few_colors(pixels: np.ndarray, ratio: float = 0.25) -> bool:
+    """
+    Whether an (..., 3) uint8 array likely has far fewer colors than pixels.
+
+    Counts the distinct colors of an evenly spaced sample of pixels, which is
+    much cheaper than finding all of them: pixel art and sprite sheets repeat
+    a handful of colors, photos rarely repeat one.
+    """
+    flat = pixels.reshape(-1, 3)
+    sample = flat[::max(1, len(flat) // UNIQUE_SAMPLE_SIZE)]
+    return len(sample) > 1 and len(unique_colors(sample)[0]) <= ratio * len(sample)
+
+def quantize_image(image: Image.Image, colors: Sequence[Tuple[int, int, int]], metric: str = 'rgb', memory_budget: int = DEFAULT_MEMORY_BUDGET) -> Image.Image:
+    """
+    Map an image to the nearest palette colors under metric, returning a 'P' image.
+
+    Images with few distinct colors have each color matched once and the
+    results scattered back to the pixels, so the nearest-color search costs
+    O(colors) instead of O(pixels); the output is the same either way.
+    """
+    palette = palette_array(colors)
+    pixels = np.asarray(image.convert('RGB'))
+    if has_few_colors(pixels):
+        image_colors, inverse = unique_colors(pixels)
+        indices = nearest_palette_indices(image_colors, palette, metric, memory_budget)[inverse]
+    else:
+        indices = nearest_palette_indices(pixels, palette, metric, memory_budget)
+    return indices_to_image(indices.reshape(pixels.shape[:2]), palette)
+
+class PaletteLUT:
+    """
+    Precomputed RGB to palette index table.
+
+    The table has 2**(3*bits) entries, one per RGB cell after dropping the low
+    8 - bits bits of each channel, so mapping an image is a single gather.
+    """
+
+    def __init__(self, colors: np.ndarray, table: np.ndarray, bits: int, metric: str = 'rgb'):
+        self.colors = colors
+        self.table = table
+        self.bits = bits
+        self.metric = metric
+
+    @classmethod
+    def build(cls, colors: Sequence[Tuple[int, int, int]], bits: int = 6, metric: str = 'rgb') -> 'PaletteLUT':
+        """Compute the table by matching the center of every RGB cell"""
+        if bits not in LUT_BITS:
+            raise ValueError(f"LUT bits must be one of {LUT_BITS}, got {bits}")
+        palette = palette_array(colors)
+        shift = 8 - bits
+        levels = (np.arange(1 << bits, dtype=np.uint16) << shift) + ((1 << shift) >> 1)
+        table = np.empty(1 << (3 * bits), dtype=np.uint8)
+        # One red plane at a time keeps the cell grid small
+        plane = np.empty((1 << bits, 1 << bits, 3), dtype=np.uint8)
+        plane[..., 1] = levels[:, None]
+        plane[..., 2] = levels[None, :]
+        plane_size = 1 << (2 * bits)
+        for red in range(1 << bits):
+            plane[..., 0] = levels[red]
+            table[red * plane_size:(red + 1) * plane_size] = nearest_palette_indices(plane, palette, metric)
+        return cls(palette, table, bits, metric)
+
+    @classmethod
+    def load(cls, colors: Sequence[Tuple[int, int, int]], bits: int = 6, metric: str = 'rgb', cache_dir: Optional[Path] = None) -> 'PaletteLUT':
+        """
+        Load the table from the on-disk cache, building and storing it on a miss.
+
+        Tables are keyed by a hash of the palette contents, bits and metric, and
+        are memory-mapped so processes using the same palette share one copy.
+        """
+        palette = palette_array(colors)
+        cache_path = (cache_dir or get_cache_dir() / 'lut') / f"{lut_key(palette, bits, metric)}.npy"
+        if cache_path.exists():
+            try:
+                table = np.load(cache_path, mmap_mode='r')
+                if table.shape == (1 << (3 * bits),):
+                    return cls(palette, table, bits, metric)
+            except (OSError, ValueError):
+                pass
+
+        lut = cls.build(palette, bits, metric)
+        try:
+            atomic_write(cache_path, lambda f: np.save(f, lut.table))
+        except OSError as e:
+            print(f"Warning: Could not cache palette LUT in {cache_path.parent}: {e}")
+        return lut
+
+    def lookup(self, pixels: np.ndarray) -> np.ndarray:
+        """Palette indices for an (..., 3) uint8 RGB array"""
+        shift = 8 - self.bits
+        index = (pixels[..., 0] >> shift).astype(np.intp) << (2 * self.bits)
+        index |= (pixels[..., 1] >> shift).astype(np.intp) << self.bits
+        index |= pixels[..., 2] >> shift
+        return self.table[index]
+
+    def apply(self, image: Image.Image) -> Image.Image:
+        """Map an RGB image to a 'P' image using the palette colors"""
+        indices = self.lookup(np.asarray(image.convert('RGB')))
+        return indices_to_image(indices, self.colors)
+
+def lut_key(palette: np.ndarray, bits: int, metric: str) -> str:
+    """Cache key identifying a table by palette content, bits and metric"""
+    digest = hashlib.sha256(palette.tobytes())
+    digest.update(f"{bits}:{metric}:{LUT_FORMAT_VERSION}".encode())
+    return digest.hexdigest()[:32]
+
+def indices_to_image(indices: np.ndarray, colors: np.ndarray) -> Image.Image:
+    """Build a 'P' image from an index array and its (K, 3) palette"""
+    image = Image.fromarray(np.ascontiguousarray(indices, dtype=np.uint8), 'P')
+    image.putpalette(colors.tobytes())
+    return image
+
+_loaded_luts: Dict[Tuple[str, int, str], PaletteLUT] = {}
+
+def get_palette_lut(colors: Sequence[Tuple[int, int, int]], bits: int = 6, metric: str = 'rgb') -> PaletteLUT:
+    """Process-wide cached PaletteLUT.load"""
+    palette = palette_array(colors)
+    key = (palette.tobytes().hex(), bits, metric)
+    if key not in _loaded_luts:
+        _loaded_luts[key] = PaletteLUT.load(palette, bits, metric)
+    return _loaded_luts[key]
+
+QUANTIZERS = ('pillow', 'lut', 'numpy')
+
+class PaletteMapper:
+    """
+    Palette matching settings: the engine, its color metric and resources.
+
+    'pillow' leaves matching to Image.quantize, 'lut' uses a cached PaletteLUT
+    and 'numpy' searches the nearest color of every pixel directly.
+    """
+
+    def __init__(self, quantizer: str = 'pillow', metric: str = 'rgb', lut_bits: int = 6, memory_budget: int = DEFAULT_MEMORY_BUDGET):
+        if quantizer not in QUANTIZERS:
+            raise ValueError(f"Unknown quantizer '{quantizer}', expected one of {', '.join(QUANTIZERS)}")
+        if metric not in METRICS:
+            raise ValueError(f"Unknown color metric '{metric}', expected one of {', '.join(METRICS)}")
+        self.quantizer = quantizer
+        self.metric = metric
+        self.lut_bits = lut_bits
+        self.memory_budget = memory_budget
+
+    def prepare(self, colors: Sequence[Tuple[int, int, int]]) -> Union[PaletteLUT, np.ndarray, Sequence[Tuple[int, int, int]]]:
+        """
+        Palette colors in the form map() matches against without further setup:
+        the cached PaletteLUT for 'lut', a (K, 3) array for 'numpy' and the
+        colors unchanged for 'pillow'.
+        """
+        if self.quantizer == 'lut':
+            return get_palette_lut(colors, self.lut_bits, self.metric)
+        if self.quantizer == 'numpy':
+            return palette_array(colors)
+        return colors
+
+    def map(self, image: Image.Image, colors: Union[PaletteLUT, Sequence[Tuple[int, int, int]]]) -> Image.Image:
+        """Map an image to the nearest palette colors, or colors from prepare(), returning a 'P' image"""
+        if isinstance(colors, PaletteLUT):
+            return colors.apply(image)
+        if self.quantizer == 'lut':
+            return get_palette_lut(colors, self.lut_bits, self.metric).apply(image)
+        return quantize_image(image, colors, self.metric, self.memory_budget)
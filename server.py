@@ -0,0 +1,313 @@
+"""
+Long-running HTTP server processing images sent in request bodies
+"""
+
+import asyncio
+import io
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, Deque, Dict, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+from PIL import Image
+
+from downscale import DOWNSCALE_METHODS
+from enhance import ENHANCERS
+from palette_swap import DITHER_NAMES, ImagePalette, encode_image, process_image
+from palettes import PaletteCollection
+from quantize import DEFAULT_MEMORY_BUDGET, METRICS, QUANTIZERS, PaletteMapper
+
+OUTPUT_FORMATS = {'png': 'image/png', 'webp': 'image/webp', 'qoi': 'image/qoi', 'gif': 'image/gif', 'bmp': 'image/bmp'}
+# Latencies kept for the metrics percentiles
+LATENCY_WINDOW = 1000
+
+class RequestError(ValueError):
+    """Invalid request, answered with a 4xx status"""
+
+    def __init__(self, message: str, status: int = 400):
+        super().__init__(message)
+        self.status = status
+
+def parse_params(query: Dict[str, list]) -> Dict[str, Any]:
+    """Processing parameters of a /process request from its query string"""
+    def get(name: str, default: Any = None, convert=str) -> Any:
+        values = query.get(name)
+        if not values:
+            return default
+        try:
+            return convert(values[-1])
+        except ValueError:
+            raise RequestError(f"Invalid value for {name}: {values[-1]!r}")
+
+    params = {
+        'width': get('width', 256, int),
+        'palette': get('palette'),
+        'dither': get('dither', 'none'),
+        'colors': get('colors', 0, int),
+        'contrast': get('contrast', 1.0, float),
+        'saturation': get('saturation', 1.0, float),
+        'quantizer': get('quantizer', 'pillow'),
+        'metric': get('metric', 'rgb'),
+        'lut_bits': get('lut_bits', 6, int),
+        'auto_detect_pixel_size': get('auto_detect', 'false').lower() in ('1', 'true', 'yes'),
+        'detect_samples': get('detect_samples', 0, int),
+        'downscale': get('downscale', 'nearest'),
+        'enhancer': get('enhance', 'pillow'),
+        'output': get('output', 'full'),
+        'format': get('format', 'png').lower(),
+    }
+    if params['width'] < 1:
+        raise RequestError("width must be at least 1")
+    if params['detect_samples'] < 0:
+        raise RequestError("detect_samples must not be negative")
+    if params['dither'] not in DITHER_NAMES:
+        raise RequestError(f"Unknown dither '{params['dither']}', expected one of {', '.join(DITHER_NAMES)}")
+    if params['quantizer'] not in QUANTIZERS:
+        raise RequestError(f"Unknown quantizer '{params['quantizer']}', expected one of {', '.join(QUANTIZERS)}")
+    if params['metric'] not in METRICS:
+        raise RequestError(f"Unknown metric '{params['metric']}', expected one of {', '.join(METRICS)}")
+    if params['downscale'] not in DOWNSCALE_METHODS:
+        raise RequestError(f"Unknown downscale '{params['downscale']}', expected one of {', '.join(DOWNSCALE_METHODS)}")
+    if params['enhancer'] not in ENHANCERS:
+        raise RequestError(f"Unknown enhance '{params['enhancer']}', expected one of {', '.join(ENHANCERS)}")
+    if params['output'] not in ('full', 'downscaled'):
+        raise RequestError("output must be 'full' or 'downscaled'")
+    if params['format'] not in OUTPUT_FORMATS:
+        raise RequestError(f"Unknown format '{params['format']}', expected one of {', '.join(OUTPUT_FORMATS)}")
+    return params
+
+# Built-in palettes of a worker process, loaded once and reused by every request
+_worker_collection: Optional[PaletteCollection] = None
+_worker_palettes: Dict[str, ImagePalette] = {}
+_worker_memory_budget = DEFAULT_MEMORY_BUDGET
+
+def _init_worker(memory_budget: int = DEFAULT_MEMORY_BUDGET):
+    global _worker_collection, _worker_memory_budget
+    _worker_collection = PaletteCollection()
+    _worker_memory_budget = memory_budget
+
+def _worker_palette(name: str) -> ImagePalette:
+    name = name.lower()
+    if name not in _worker_palettes:
+        collection = _worker_collection or PaletteCollection()
+        if name not in collection.list_palettes():
+            raise RequestError(f"Palette not found: {name}", 404)
+        _worker_palettes[name] = ImagePalette(name, collection.create_palette_image(name), collection.get_palette(name))
+    return _worker_palettes[name]
+
+def render(data: bytes, params: Dict[str, Any]) -> bytes:
+    """Process one encoded image with the parameters of parse_params, returning the encoded result"""
+    try:
+        image = Image.open(io.BytesIO(data))
+        if getattr(image, 'is_animated', False):
+            raise RequestError("Animated images are not supported by the server")
+        image = image.convert('RGB')
+    except (OSError, Image.DecompressionBombError) as e:
+        raise RequestError(f"Cannot decode image: {e}")
+    palette = _worker_palette(params['palette']) if params['palette'] else None
+    mapper = PaletteMapper(params['quantizer'], params['metric'], params['lut_bits'], _worker_memory_budget)
+
+    results = process_image(
+        image, params['width'], [DITHER_NAMES[params['dither']]], [params['colors']],
+        [params['saturation']], [params['contrast']], [palette] if palette else None,
+        params['auto_detect_pixel_size'], mapper, downscale=params['downscale'], enhancer=params['enhancer'],
+        detect_samples=params['detect_samples']
+    )
+    result, processed = next(results)
+    size = result['size'] if params['output'] == 'full' else None
+    return encode_image(processed, params['format'].upper(), size)
+
+def _render_job(data: bytes, params: Dict[str, Any]) -> Tuple[int, bytes, str]:
+    """render for worker processes, returning (status, body, content type) instead of raising"""
+    try:
+        return 200, render(data, params), OUTPUT_FORMATS[params['format']]
+    except RequestError as e:
+        return e.status, json.dumps({'error': str(e)}).encode(), 'application/json'
+    except Exception as e:
+        return 500, json.dumps({'error': f"{type(e).__name__}: {e}"}).encode(), 'application/json'
+
+class ServerMetrics:
+    """Request counters and latencies reported by /metrics"""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.in_flight = 0
+        self.latencies: Deque[float] = deque(maxlen=LATENCY_WINDOW)
+        self.queue_waits: Deque[float] = deque(maxlen=LATENCY_WINDOW)
+
+    @staticmethod
+    def _percentiles(values: Deque[float]) -> Dict[str, float]:
+        if not values:
+            return {}
+        ordered = sorted(values)
+        pick = lambda q: ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000
+        return {'mean_ms': sum(ordered) / len(ordered) * 1000, 'p50_ms': pick(0.5), 'p95_ms': pick(0.95), 'p99_ms': pick(0.99), 'max_ms': ordered[-1] * 1000}
+
+    def snapshot(self, queue: 'asyncio.Queue', workers: int) -> Dict[str, Any]:
+        return {
+            'uptime_s': time.monotonic() - self.started,
+            'workers': workers,
+            'queue_depth': queue.qsize(),
+            'queue_capacity': queue.maxsize,
+            'in_flight': self.in_flight,
+            'completed': self.completed,
+            'failed': self.failed,
+            'rejected': self.rejected,
+            'latency': self._percentiles(self.latencies),
+            'queue_wait': self._percentiles(self.queue_waits),
+        }
+
+class PaletteServer:
+    """
+    HTTP front end on asyncio with a process pool back end.
+
+    POST /process takes an encoded image as the body and processing
+    parameters in the query string (width, palette, dither, colors, contrast,
+    saturation, quantizer, metric, lut_bits, auto_detect, detect_samples,
+    downscale, enhance, output, format) and answers with the encoded result.
+    Requests wait in a bounded queue; when it is full they are refused with
+    503 so clients back off instead of piling up. Workers load the palettes
+    once and keep palette lookup tables between requests. GET /metrics
+    reports the queue depth and latencies, GET /palettes the built-in
+    palettes and GET /health liveness.
+    """
+
+    def __init__(self, jobs: int = 1, queue_size: int = 64, max_body: int = 64 * 1024 * 1024, memory_budget: int = DEFAULT_MEMORY_BUDGET):
+        self.jobs = jobs or os.cpu_count() or 1
+        self.queue_size = queue_size
+        self.max_body = max_body
+        self.memory_budget = memory_budget
+        self.metrics = ServerMetrics()
+        self.queue: Optional[asyncio.Queue] = None
+        self.executor: Optional[ProcessPoolExecutor] = None
+        self._dispatchers = []
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self, host: str = '127.0.0.1', port: int = 8765, socket_path: Optional[Path] = None) -> asyncio.AbstractServer:
+        self.queue = asyncio.Queue(self.queue_size)
+        self.executor = ProcessPoolExecutor(self.jobs, initializer=_init_worker, initargs=(self.memory_budget,))
+        self._dispatchers = [asyncio.create_task(self._dispatch()) for _ in range(self.jobs)]
+        if socket_path:
+            self._server = await asyncio.start_unix_server(self._handle_connection, path=str(socket_path))
+        else:
+            self._server = await asyncio.start_server(self._handle_connection, host, port)
+        return self._server
+
+    async def close(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+        for dispatcher in self._dispatchers:
+            dispatcher.cancel()
+        if self.executor:
+            self.executor.shutdown(cancel_futures=True)
+
+    async def _dispatch(self):
+        """Feed queued requests to the pool, one at a time per worker"""
+        loop = asyncio.get_running_loop()
+        while True:
+            data, params, future, enqueued = await self.queue.get()
+            self.metrics.queue_waits.append(time.monotonic() - enqueued)
+            self.metrics.in_flight += 1
+            try:
+                result = await loop.run_in_executor(self.executor, _render_job, data, params)
+            except Exception as e:
+                # The worker itself died
+                result = (500, json.dumps({'error': str(e)}).encode(), 'application/json')
+            finally:
+                self.metrics.in_flight -= 1
+            if not future.done():
+                future.set_result(result)
+
+    async def _process(self, data: bytes, params: Dict[str, Any]) -> Tuple[int, bytes, str]:
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self.queue.put_nowait((data, params, future, time.monotonic()))
+        except asyncio.QueueFull:
+            self.metrics.rejected += 1
+            return 503, json.dumps({'error': 'Server busy, retry later'}).encode(), 'application/json'
+        return await future
+
+    async def _route(self, method: str, target: str, body: bytes) -> Tuple[int, bytes, str]:
+        url = urlsplit(target)
+        if url.path == '/health' and method == 'GET':
+            return 200, b'{"status": "ok"}', 'application/json'
+        if url.path == '/metrics' and method == 'GET':
+            return 200, json.dumps(self.metrics.snapshot(self.queue, self.jobs)).encode(), 'application/json'
+        if url.path == '/palettes' and method == 'GET':
+            return 200, json.dumps(PaletteCollection().list_palettes()).encode(), 'application/json'
+        if url.path == '/process' and method == 'POST':
+            if not body:
+                raise RequestError("Request body must contain an image")
+            params = parse_params(parse_qs(url.query))
+            started = time.monotonic()
+            status, data, content_type = await self._process(body, params)
+            if status == 200:
+                self.metrics.completed += 1
+                self.metrics.latencies.append(time.monotonic() - started)
+            elif status != 503:
+                self.metrics.failed += 1
+            return status, data, content_type
+        raise RequestError(f"No route for {method} {url.path}", 404)
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Serve HTTP/1.1 requests on one connection until the client closes it"""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, target, version = request_line.decode('latin-1').split(maxsplit=2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                keep_alive = headers.get('connection', '').lower() != 'close' and version.strip() == 'HTTP/1.1'
+
+                try:
+                    length = int(headers.get('content-length', 0))
+                    if length > self.max_body:
+                        raise RequestError(f"Request body larger than {self.max_body} bytes", 413)
+                    body = await reader.readexactly(length) if length else b''
+                    status, data, content_type = await self._route(method.upper(), target, body)
+                except RequestError as e:
+                    status, data, content_type = e.status, json.dumps({'error': str(e)}).encode(), 'application/json'
+                    keep_alive = keep_alive and e.status != 413
+                except ValueError:
+                    status, data, content_type = 400, b'{"error": "Malformed request"}', 'application/json'
+                    keep_alive = False
+
+                reason = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 413: 'Payload Too Large', 500: 'Internal Server Error', 503: 'Service Unavailable'}.get(status, '')
+                head = [f"HTTP/1.1 {status} {reason}", f"Content-Type: {content_type}", f"Content-Length: {len(data)}"]
+                if status == 503:
+                    head.append("Retry-After: 1")
+                head.append(f"Connection: {'keep-alive' if keep_alive else 'close'}")
+                writer.write(("\r\n".join(head) + "\r\n\r\n").encode('latin-1') + data)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+async def serve(host: str = '127.0.0.1', port: int = 8765, socket_path: Optional[Path] = None, jobs: int = 1, queue_size: int = 64, max_body: int = 64 * 1024 * 1024, memory_budget: int = DEFAULT_MEMORY_BUDGET, ready=None):
+    """Run a PaletteServer until cancelled; ready, if given, is called with the bound address"""
+    server = PaletteServer(jobs, queue_size, max_body, memory_budget)
+    listener = await server.start(host, port, socket_path)
+    try:
+        if ready:
+            ready(socket_path or listener.sockets[0].getsockname())
+        await listener.serve_forever()
+    finally:
+        await server.close()
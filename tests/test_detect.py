@@ -0,0 +1,35 @@
+"""
+Sampled pixel size detection and its confidence
+"""
+
+import numpy as np
+from PIL import Image
+
+from detect import decision_confidence, detect_pixel_size_sampled
+from palette_swap import choose_pixel_size, detect_pixel_size
+
+def test_exact_scores_are_certain():
+    # 2 passes the threshold but 8 has the best adjusted score without passing it, so the size is 1
+    scores = {8: 0.55, 2: 0.61}
+    assert choose_pixel_size(scores) == 1
+    assert decision_confidence(scores, {8: 0.0, 2: 0.0}) == 1.0
+
+def test_sampled_confidence_of_size_one():
+    # A clear size 1: every score far under the threshold
+    assert decision_confidence({4: 0.1, 2: 0.2}, {4: 0.01, 2: 0.01}) > 0.99
+
+def test_exhaustive_matches_detect_pixel_size():
+    rng = np.random.default_rng(0)
+    blocks = rng.integers(0, 256, size=(40, 40, 3), dtype=np.uint8)
+    image = Image.fromarray(np.repeat(np.repeat(blocks, 4, axis=0), 4, axis=1))
+    result = detect_pixel_size_sampled(image, samples=0)
+    assert result['pixel_size'] == detect_pixel_size(image) == 4
+    assert result['exhaustive'] and result['confidence'] == 1.0
+
+def test_sampling_stops_early():
+    rng = np.random.default_rng(1)
+    blocks = rng.integers(0, 256, size=(300, 300, 3), dtype=np.uint8)
+    image = Image.fromarray(np.repeat(np.repeat(blocks, 4, axis=0), 4, axis=1))
+    result = detect_pixel_size_sampled(image, samples=4096, confidence=0.95)
+    assert result['pixel_size'] == 4
+    assert result['confidence'] >= 0.95 and result['samples'] < 4096
@@ -0,0 +1,49 @@
+"""
+CLI startup: lazily imported modules stay unloaded, and the literal choice lists of cli.py match the constants they copy
+"""
+
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import click
+import pytest
+
+import bench
+import cli
+from downscale import DOWNSCALE_METHODS
+from enhance import ENHANCERS
+from palette_swap import DITHER_NAMES
+from quantize import LUT_BITS, METRICS, QUANTIZERS
+
+CLI_PATH = Path(__file__).resolve().parent.parent / 'cli.py'
+
+# Options whose choices are written out in cli.py, with the values they mirror
+OPTION_CHOICES = {
+    'downscale': list(DOWNSCALE_METHODS),
+    'enhancer': list(ENHANCERS),
+    'quantizer': list(QUANTIZERS),
+    'metric': list(METRICS),
+    'lut_bits': [str(bits) for bits in LUT_BITS],
+    # 'both' runs none and floyd
+    'dither': list(DITHER_NAMES) + ['both'],
+    'kinds': list(bench.IMAGE_KINDS),
+}
+
+@pytest.mark.parametrize('args', bench.STARTUP_COMMANDS, ids=' '.join)
+def test_startup_skips_lazy_modules(args, tmp_path):
+    env = dict(os.environ, PXLTR_CACHE_DIR=str(tmp_path))
+    traced = subprocess.run([sys.executable, '-X', 'importtime', str(CLI_PATH), *args], env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, check=True)
+    modules = bench.parse_importtime(traced.stderr)
+    assert [name for name in bench.STARTUP_FORBIDDEN if name in modules] == []
+
+def test_choice_constants_match_modules():
+    assert bench.cli_choice_mismatches() == []
+
+@pytest.mark.parametrize('command', sorted(cli.cli.commands))
+def test_option_choices_match_modules(command):
+    for param in cli.cli.commands[command].params:
+        if isinstance(param.type, click.Choice) and param.name in OPTION_CHOICES:
+            assert sorted(param.type.choices) == sorted(OPTION_CHOICES[param.name]), f"{command} --{param.name}"
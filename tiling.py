@@ -0,0 +1,274 @@
+"""
+Tiled processing of very large images within a memory budget
+"""
+
+import struct
+import numpy as np
+from PIL import Image
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+from palette_swap import CompiledJob, Dither, ImagePalette, _dither_list, _downscale_size, _downscaled_path, permutation_path
+from dither import DitherMethod
+from downscale import block_reduce, block_size
+from encoding import StripPngWriter, original_size_metadata
+from profiling import stage
+from quantize import DEFAULT_MEMORY_BUDGET, PaletteMapper
+
+# Dithers where every output pixel only depends on its own input pixel and position
+BLOCK_LOCAL_DITHERS = (Image.Dither.NONE, DitherMethod.BAYER)
+
+def nearest_indices(src_length: int, dst_length: int) -> np.ndarray:
+    """
+    Source index sampled by each destination index in a NEAREST resize.
+
+    This reproduces the coordinate accumulation of Pillow's resize exactly,
+    including its float32 scale; positions past the source end, which Pillow
+    leaves black, are -1.
+    """
+    step = float(np.float32(src_length)) / dst_length
+    steps = np.full(dst_length, step)
+    steps[0] = step * 0.5
+    indices = np.add.accumulate(steps).astype(np.int64)
+    indices[indices >= src_length] = -1
+    return indices
+
+class StripSource:
+    """
+    (H, W, 3) uint8 pixels read a few rows at a time.
+
+    pixels is any array-like supporting row gathers: a memory map of an
+    uncompressed file, or a decoded image for formats that cannot be mapped.
+    """
+
+    def __init__(self, pixels: np.ndarray, bgr: bool = False):
+        self.pixels = pixels
+        self.bgr = bgr
+
+    @property
+    def size(self) -> Tuple[int, int]:
+        return self.pixels.shape[1], self.pixels.shape[0]
+
+    def read_rows(self, rows: np.ndarray) -> np.ndarray:
+        """Pixels of the given rows as an (R, W, 3) array"""
+        strip = np.asarray(self.pixels[rows])[..., :3]
+        return np.ascontiguousarray(strip[..., ::-1] if self.bgr else strip)
+
+def _read_ppm(path: Path) -> StripSource:
+    with open(path, 'rb') as f:
+        header = f.read(512)
+    fields = []
+    position = 2
+    if header[:2] != b'P6':
+        raise ValueError(f"Only binary RGB (P6) PPM files can be memory-mapped: {path}")
+    while len(fields) < 3:
+        while header[position:position + 1].isspace():
+            position += 1
+        if header[position:position + 1] == b'#':
+            position = header.index(b'\n', position)
+            continue
+        end = position
+        while not header[end:end + 1].isspace():
+            end += 1
+        fields.append(int(header[position:end]))
+        position = end
+    width, height, maxval = fields
+    if maxval != 255:
+        raise ValueError(f"Only 8-bit PPM files can be memory-mapped: {path}")
+    # A single whitespace byte separates the header from the pixels
+    return StripSource(np.memmap(path, np.uint8, 'r', position + 1, (height, width, 3)))
+
+def _read_bmp(path: Path) -> StripSource:
+    with open(path, 'rb') as f:
+        header = f.read(54)
+    if header[:2] != b'BM':
+        raise ValueError(f"Not a BMP file: {path}")
+    offset, = struct.unpack_from('<I', header, 10)
+    width, height, _, bits, compression = struct.unpack_from('<iiHHI', header, 18)
+    if bits not in (24, 32) or compression not in (0, 3):
+        raise ValueError(f"Only uncompressed 24 or 32-bit BMP files can be memory-mapped: {path}")
+    channels = bits // 8
+    stride = (width * channels + 3) & ~3
+    rows = np.memmap(path, np.uint8, 'r', offset, (abs(height), stride))
+    pixels = rows[:, :width * channels].reshape(abs(height), width, channels)
+    # Positive heights are stored bottom-up
+    return StripSource(pixels[::-1] if height > 0 else pixels, bgr=True)
+
+def open_strip_source(path: Path) -> StripSource:
+    """
+    Open an image for strip reads.
+
+    NPY ((H, W, 3) uint8), binary PPM and uncompressed BMP files are
+    memory-mapped, so only the rows actually read are loaded. Other formats
+    are compressed and are decoded whole by Pillow.
+    """
+    suffix = path.suffix.lower()
+    if suffix == '.npy':
+        pixels = np.load(path, mmap_mode='r')
+        if pixels.dtype != np.uint8 or pixels.ndim != 3 or pixels.shape[2] < 3:
+            raise ValueError(f"NPY images must be (H, W, 3) uint8 arrays, got {pixels.shape} {pixels.dtype}")
+        return StripSource(pixels)
+    if suffix == '.ppm':
+        return _read_ppm(path)
+    if suffix == '.bmp':
+        return _read_bmp(path)
+    with Image.open(path) as image:
+        if getattr(image, 'is_animated', False):
+            raise ValueError("Tiled processing does not support animated images")
+        return StripSource(np.asarray(image.convert('RGB')))
+
+def _image_rows(image: Image.Image) -> np.ndarray:
+    return np.asarray(image if image.mode in ('RGB', 'P') else image.convert('RGB'))
+
+def _pad_columns(rows: np.ndarray) -> np.ndarray:
+    # An extra black column that the -1 indices of nearest_indices land on
+    padding = np.zeros((len(rows), 1) + rows.shape[2:], dtype=rows.dtype)
+    return np.concatenate([rows, padding], axis=1)
+
+def _is_block_local(mapper: PaletteMapper, dithers: List[Dither], colors_list: List[int], palettes_list: List[Optional[ImagePalette]]) -> bool:
+    """
+    Whether every permutation maps each pixel independently of the others.
+
+    Adaptive palettes, error diffusion and color count reduction depend on
+    the whole image, and Pillow's palette mapping may pick colors outside
+    the palette that the color count reduction then merges.
+    """
+    return (
+        mapper.quantizer != 'pillow'
+        and all(palettes_list)
+        and all(d in BLOCK_LOCAL_DITHERS for d in dithers)
+        and not any(colors_list)
+    )
+
+def process_picture_tiled(input_path: Path, output_path: Path, downscale_width_resolution: int, dither: Union[int, Sequence[Dither]], colors: Optional[List[int]] = None, saturation: Optional[List[float]] = None, constrast: Optional[List[float]] = None, palettes: Optional[List[ImagePalette]] = None, auto_detect_pixel_size: bool = False, mapper: Optional[PaletteMapper] = None, save_downscaled: bool = True, save_full_size: bool = True, downscale: str = 'nearest', compress_level: int = 6, enhancer: str = 'pillow', png_strategy: Optional[str] = None, scale_metadata: bool = False, detect_samples: int = 0) -> List[Path]:
+    """
+    Process an image like process_picture while keeping memory use bounded.
+
+    The source is read in strips of rows (memory-mapped for NPY, PPM and BMP
+    files) and both outputs are written as PNG in strips, so the full-size
+    result never exists in memory. When every permutation is block-local
+    (lut or numpy quantizer, only palettes, no or Bayer dithering and no
+    color count), the downscaled image is also processed strip by strip,
+    with strips sized from the mapper's memory budget; the results are
+    identical to the untiled path. Other permutations need the whole
+    downscaled image, which is then processed at once. Returns the paths of
+    all the files written. Block downscale methods (see
+    downscale.block_reduce) read whole blocks of rows and need a size that
+    divides the image. png_strategy and scale_metadata apply to the PNG
+    writers as in process_picture.
+    """
+    if output_path.suffix.lower() != '.png':
+        raise ValueError(f"Tiled processing writes PNG files, got {output_path.name}")
+    mapper = mapper or PaletteMapper()
+    budget = mapper.memory_budget or DEFAULT_MEMORY_BUDGET
+    contrasts = constrast if constrast else [1.0]
+    saturations = saturation if saturation else [1.0]
+    dithers = _dither_list(dither)
+    colors_list = colors if colors else [0]
+    palettes_list = palettes if palettes else [None]
+
+    with stage('decode'):
+        source = open_strip_source(input_path)
+    og_width, og_height = source.size
+    sample = None
+    if auto_detect_pixel_size:
+        # Detection looks at the top rows only, as many as fit in the budget
+        sample_rows = max(1, min(og_height, budget // (og_width * 3 * 4)))
+        sample = Image.fromarray(source.read_rows(np.arange(sample_rows)))
+    width, height = _downscale_size(sample, downscale_width_resolution, auto_detect_pixel_size, (og_width, og_height), detect_samples)
+
+    down_rows = nearest_indices(og_height, height)
+    down_columns = nearest_indices(og_width, width)
+    up_rows = nearest_indices(height, og_height)
+    up_columns = nearest_indices(width, og_width)
+    # -1 only ever appears at the end, past the last sampled row
+    valid_up_rows = up_rows[up_rows >= 0]
+
+    block = None
+    if downscale != 'nearest':
+        block = block_size((og_width, og_height), (width, height))
+        if block is None:
+            raise ValueError(f"Tiled {downscale} downscaling needs a size dividing {og_width}x{og_height}, got {width}x{height}")
+
+    def read_downscaled(start: int, stop: int) -> Image.Image:
+        if block:
+            # Source rows are read a few blocks at a time, with room for the reduction's temporaries
+            step = max(1, budget // (og_width * block[1] * 3 * 8))
+            reduced = [
+                block_reduce(source.read_rows(np.arange(row * block[1], min(stop, height, row + step) * block[1])), block, downscale)
+                for row in range(start, min(stop, height), step)
+            ]
+            return Image.fromarray(np.concatenate(reduced))
+        rows = down_rows[start:stop]
+        valid = rows[rows >= 0]
+        strip = np.zeros((len(rows), width, 3), dtype=np.uint8)
+        if len(valid):
+            strip[:len(valid)] = _pad_columns(source.read_rows(valid))[:, down_columns]
+        return Image.fromarray(strip)
+
+    if _is_block_local(mapper, dithers, colors_list, palettes_list):
+        # Room for the strip, its enhanced copies and every permutation result
+        permutations = len(contrasts) * len(saturations) * len(dithers) * len(palettes_list)
+        strip_height = max(1, budget // (width * 3 * (permutations + 8)))
+    else:
+        strip_height = height
+    # Rows of the full-size output built at once from the downscaled strip
+    upscale_height = max(1, budget // (og_width * 3 * 3))
+
+    contrast_mean = None
+    if strip_height < height and any(c != 1.0 for c in contrasts):
+        # Contrast pivots around the mean gray of the whole downscaled image
+        histogram = np.zeros(256, dtype=np.int64)
+        for start in range(0, height, strip_height):
+            histogram += np.array(read_downscaled(start, start + strip_height).convert('L').histogram())
+        contrast_mean = int(float((histogram * np.arange(256)).sum()) / (width * height) + 0.5)
+
+    # Palettes are prepared once for all the strips
+    job = CompiledJob(None, dithers, colors_list, saturations, contrasts, palettes_list, mapper=mapper, enhancer=enhancer)
+    # Downscaled and full-size writer for every permutation, None for skipped outputs
+    writers: Dict[Path, Tuple[Optional[StripPngWriter], Optional[StripPngWriter]]] = {}
+    try:
+        for start in range(0, height, strip_height):
+            stop = min(height, start + strip_height)
+            with stage('downscale'):
+                strip = read_downscaled(start, stop)
+            # Full-size rows sampling this strip
+            up_start, up_stop = np.searchsorted(valid_up_rows, [start, stop])
+            for params, processed_image in job.permutations(strip, None, contrast_mean, (0, start)):
+                processed_path = permutation_path(output_path, params['name'])
+                rows = _image_rows(processed_image)
+                if processed_path not in writers:
+                    palette = processed_image.getpalette() if processed_image.mode == 'P' else None
+                    writers[processed_path] = (
+                        StripPngWriter(_downscaled_path(processed_path), (width, height), processed_image.mode, palette, compress_level, strategy=png_strategy, text=original_size_metadata((width, height), (og_width, og_height)) if scale_metadata else None) if save_downscaled else None,
+                        StripPngWriter(processed_path, (og_width, og_height), processed_image.mode, palette, compress_level, strategy=png_strategy) if save_full_size else None,
+                    )
+                downscaled_writer, writer = writers[processed_path]
+                if downscaled_writer:
+                    with stage('save_downscaled'):
+                        downscaled_writer.write(rows)
+                if writer:
+                    with stage('save_full_size'):
+                        padded = _pad_columns(rows)
+                        for chunk_start in range(up_start, up_stop, upscale_height):
+                            chunk_rows = up_rows[chunk_start:min(up_stop, chunk_start + upscale_height)] - start
+                            writer.write(padded[chunk_rows][:, up_columns])
+        # Full-size rows past the downscaled image are black, as in Pillow's resize
+        missing = og_height - len(valid_up_rows)
+        for _, writer in writers.values():
+            for chunk_start in range(0, missing if writer else 0, upscale_height):
+                count = min(upscale_height, missing - chunk_start)
+                writer.write(np.zeros((count, og_width) + ((3,) if writer.mode == 'RGB' else ()), dtype=np.uint8))
+    except BaseException:
+        for strip_writers in writers.values():
+            for strip_writer in strip_writers:
+                if strip_writer:
+                    strip_writer.abort()
+        raise
+    written = []
+    for strip_writers in writers.values():
+        for strip_writer in strip_writers:
+            if strip_writer:
+                strip_writer.close()
+                written.append(strip_writer.path)
+    return written